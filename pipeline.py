@@ -0,0 +1,124 @@
+import queue
+import threading
+import time
+
+_STOP = object()  # end of the stream, forwarded from stage to stage
+
+
+class Stage:
+    """
+    One stage of a Pipeline, a thread that takes the items of its inbox, or of the source iterator for the first
+    stage, in order and puts fn(item) in its outbox. Counts the items, the time spent in fn and the inbox depth.
+    """
+
+    def __init__(self, name, fn, get, outbox, stop):
+        self.name = name
+        self.fn = fn
+        self.get = get
+        self.outbox = outbox
+        self.stop = stop
+        self.inbox = None
+        self.count = 0
+        self.busy = 0.
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.elapsed = 0.  # from the start to the last item done
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                if self.inbox is not None:
+                    depth = self.inbox.qsize()
+                    self.depth_sum += depth
+                    self.max_depth = max(self.max_depth, depth)
+                tick = time.perf_counter()
+                item = self.get()
+                if item is _STOP:
+                    break
+                if self.inbox is not None:
+                    tick = time.perf_counter()  # waiting for the previous stage is not busy time
+                item = self.fn(item) if self.fn is not None else item
+                self.busy += time.perf_counter() - tick
+                self.count += 1
+                self.elapsed = time.perf_counter() - start
+                if self.outbox is not None:
+                    self._put(item)
+        except BaseException as e:  # also exit() of a stage, raised again by Pipeline.run
+            self.error = e
+            self.stop.set()
+        finally:
+            if self.outbox is not None:
+                self._put(_STOP)
+
+    def summary(self):
+        fps = self.count / self.elapsed if self.elapsed else 0.
+        busy = 1E3 * self.busy / self.count if self.count else 0.
+        s = f"{self.name} {self.count} frames {fps:.1f}fps {busy:.1f}ms/frame"
+        if self.inbox is not None:
+            s += f" queue {self.depth_sum / max(self.count, 1):.1f} (max {self.max_depth})"
+        return s
+
+
+class Pipeline:
+    """
+    Runs the stages of a frame loop in their own threads, linked by bounded queues, so that e.g. the drawing and the
+    writing of a frame overlap with the detection of the next one. Every stage handles the frames one at a time in the
+    order of the source, so a tracker still sees its frames in order. An exception in a stage stops the pipeline and is
+    raised again by run.
+
+        pipeline = Pipeline(enumerate(dataset), [("detect", detect), ("track", track), ("sink", sink)], maxsize=2)
+        pipeline.run()
+        LOGGER.info(pipeline.summary())
+
+    Parameters
+    ----------
+    source : iterable
+        Items of the first stage, read in a "decode" stage of its own.
+    stages : list of (str, callable)
+        Name and function of every stage, fn(item) is the item of the next stage.
+    maxsize : int
+        Size of the queues between the stages.
+    """
+
+    def __init__(self, source, stages, maxsize=2):
+        self.stop = threading.Event()
+        iterator = iter(source)
+        queues = [queue.Queue(maxsize=max(1, maxsize)) for _ in stages]
+        self.stages = [Stage("decode", None, lambda: next(iterator, _STOP), queues[0], self.stop)]
+        for k, (name, fn) in enumerate(stages):
+            stage = Stage(name, fn, self._getter(queues[k]), queues[k + 1] if k + 1 < len(queues) else None, self.stop)
+            stage.inbox = queues[k]
+            self.stages.append(stage)
+
+    def _getter(self, inbox):
+        def get():
+            while not self.stop.is_set():
+                try:
+                    return inbox.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return _STOP
+        return get
+
+    def run(self):
+        for stage in self.stages:
+            stage.thread.start()
+        for stage in self.stages:
+            stage.thread.join()
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+    def summary(self):
+        return ", ".join(stage.summary() for stage in self.stages)
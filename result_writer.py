@@ -0,0 +1,136 @@
+import struct
+import time
+
+import numpy as np
+
+# columns of a result row, frame is the 0-based frame index
+RESULT_COLUMNS = ("frame", "id", "left", "top", "width", "height", "conf", "class", "index")
+RESULT_SUFFIXES = {"mot": ".txt", "kitti": ".txt", "bin": ".bin"}
+
+# names of the detector classes in KITTI tracking files, the other names are written as they are
+KITTI_TYPES = {"person": "pedestrian", "bicycle": "cyclist"}
+
+_MAGIC = b"EMAPRES1"
+
+
+def _mot(rows, names):
+    # "%g " * 10 of frame + 1, id, left, top, w, h, -1, -1, -1, index like the former per line writes
+    rows[:, 0] += 1
+    return ("%g %g %g %g %g %g -1 -1 -1 %g \n" * len(rows)) % tuple(rows[:, [0, 1, 2, 3, 4, 5, 8]].ravel().tolist())
+
+
+def _gt(rows, names):
+    rows[:, 0] += 1
+    return ("%g %g %g %g %g %g 1 1 1 \n" * len(rows)) % tuple(rows[:, :6].ravel().tolist())
+
+
+def _kitti(rows, names):
+    # frame id type truncated occluded alpha left top right bottom height width length x y z rotation_y score
+    lines = []
+    for frame, id, left, top, w, h, conf, c, _ in rows.tolist():
+        c = int(c)
+        name = "dontcare" if c < 0 or names is None else KITTI_TYPES.get(names[c], names[c])
+        lines.append(
+            "%d %d %s -1 -1 -10 %.2f %.2f %.2f %.2f -1 -1 -1 -1000 -1000 -1000 -10 %.6f\n"
+            % (frame, id, name, left, top, left + w, top + h, conf)
+        )
+    return "".join(lines)
+
+
+_FORMATTERS = {"mot": _mot, "gt": _gt, "kitti": _kitti}
+
+
+class ResultWriter:
+    """
+    Result file of one sequence. The rows are buffered in a preallocated array and appended to the file in blocks,
+    when the buffer is full, every flush_interval seconds and on close, so a crashed run keeps all but its last
+    seconds of results. The file is opened once per block instead of once per row.
+
+        writer = ResultWriter(save_dir / "seq.txt", fmt="mot")
+        writer.write(frame_idx, id, left, top, w, h, conf, cls, i)
+        writer.close()
+
+    Parameters
+    ----------
+    path : str or Path
+        File the blocks are appended to, it is only created with the first block.
+    fmt : str
+        mot, the MOT challenge txt byte for byte as the former per line writes, gt, the gt.txt of the eval mode, kitti,
+        a KITTI tracking txt, or bin, a binary columnar file read back by read_results.
+    names : dict or list
+        Class names of the detector, for the types of the kitti format.
+    buffer_size : int
+        Rows of the buffer.
+    flush_interval : float
+        Seconds after which a write flushes the buffer, None to flush only full buffers.
+    """
+
+    def __init__(self, path, fmt="mot", names=None, buffer_size=1024, flush_interval=1.):
+        if fmt not in _FORMATTERS and fmt != "bin":
+            raise ValueError(f"unknown result format {fmt}, use one of mot, gt, kitti, bin")
+        self.path = str(path)
+        self.fmt = fmt
+        self.names = names
+        self.flush_interval = flush_interval
+        self.rows = np.empty((max(1, buffer_size), len(RESULT_COLUMNS)), dtype=np.float64)
+        self.count = 0
+        self.written = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, frame, id, left, top, width, height, conf=-1, cls=-1, index=0):
+        self.rows[self.count] = (frame, id, left, top, width, height, conf, cls, index)
+        self.count += 1
+        if self.count == len(self.rows) or (
+            self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.count == 0:
+            return
+        rows = self.rows[: self.count].copy()
+        if self.fmt == "bin":
+            with open(self.path, "ab") as f:
+                if f.tell() == 0:
+                    names = " ".join(RESULT_COLUMNS).encode()
+                    f.write(_MAGIC + struct.pack("<I", len(names)) + names)
+                f.write(struct.pack("<I", len(rows)) + rows.T.tobytes())
+        else:
+            with open(self.path, "a") as f:
+                f.write(_FORMATTERS[self.fmt](rows, self.names))
+        self.written += self.count
+        self.count = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_results(path):
+    """Columns of a bin result file, a dict of float64 arrays keyed by the names of RESULT_COLUMNS"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[: len(_MAGIC)] != _MAGIC:
+        raise ValueError(f"{path} is not a bin result file")
+    (size,) = struct.unpack_from("<I", data, len(_MAGIC))
+    offset = len(_MAGIC) + 4
+    columns = data[offset: offset + size].decode().split()
+    offset += size
+    blocks = []
+    while offset + 4 <= len(data):
+        (n,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        end = offset + 8 * n * len(columns)
+        if end > len(data):  # block cut by a crash in the middle of a flush
+            break
+        blocks.append(np.frombuffer(data, dtype=np.float64, count=n * len(columns), offset=offset).reshape(len(columns), n))
+        offset = end
+    table = np.concatenate(blocks, axis=1) if blocks else np.empty((len(columns), 0))
+    return {name: table[k] for k, name in enumerate(columns)}
+
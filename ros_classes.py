@@ -1,5 +1,7 @@
 
 import queue
+import threading
+import time
 
 import rospy
 import cv2
@@ -12,23 +14,168 @@ from nav_msgs.msg import Odometry
 # from my_tracker.msg import ImageDetectionMessage
 import numpy as np
 from collections import deque
+
+DROP_POLICIES = ("oldest", "newest", "reject")
+
+
+class StampSynchronizer:
+    """
+    Pairs the messages of several topics by stamp into bundles, one per message of the reference topic.
+
+    Every topic has a buffer of at most buffer_size messages. When a buffer is full, drop_policy picks the
+    message that is dropped: "oldest" drops the oldest buffered message, "newest" the newest buffered one,
+    and "reject" the incoming one. The matched bundles are kept in a buffer of the same size and policy.
+
+    A reference message is matched with the closest message of every other topic whose stamp is within
+    slop seconds. It is discarded as a mismatch once a topic has a newer message outside the slop and no
+    message within it. Messages of the other topics that are too old for every later reference message are
+    discarded as mismatches too.
+
+    The messages of the unstamped topics, e.g. a Float32MultiArray without a header, are not matched by stamp
+    and not held to the slop. A reference message is paired with the newest unstamped message received at or
+    before it, on the local receive clock, and is discarded as a mismatch when there is none yet. The paired
+    message stays buffered for the next reference messages until a newer one arrives, so a topic published
+    slower than the reference repeats its last message.
+
+    Per topic, stats counts the received, matched, dropped and mismatched messages. It also keeps the lag of
+    the last matched message behind the reference stamp and the largest absolute lag, in seconds.
+
+    get(latest=True) is the real-time mode: it returns the newest bundle and skips the older ones. Every
+    bundle records in "skipped" how many bundles were skipped before it.
+    """
+
+    def __init__(self, topics, reference=None, slop=0.05, buffer_size=30, drop_policy="oldest", unstamped=()):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Invalid drop policy {drop_policy}; must be one of {DROP_POLICIES}")
+        self.topics = list(topics)
+        self.reference = self.topics[0] if reference is None else reference
+        self.slop = slop
+        self.unstamped = set(unstamped)
+        self.paired = {}  # last message of every unstamped topic paired with a reference message
+        self.buffer_size = max(1, int(buffer_size))
+        self.drop_policy = drop_policy
+        self.buffers = {topic: deque() for topic in self.topics}  # (stamp, message, received), oldest first
+        self.bundles = deque()
+        self.dropped_bundles = 0
+        self.skipped_bundles = 0
+        self.stats = {topic: dict(received=0, matched=0, dropped=0, mismatched=0, lag=0., max_lag=0.)
+                      for topic in self.topics}
+        self.condition = threading.Condition()
+
+    def _push(self, buffer, item):
+        # append to a bounded buffer, returns the number of dropped items
+        if len(buffer) < self.buffer_size:
+            buffer.append(item)
+            return 0
+        if self.drop_policy == "reject":
+            return 1
+        if self.drop_policy == "oldest":
+            buffer.popleft()
+        else:
+            buffer.pop()
+        buffer.append(item)
+        return 1
+
+    def put(self, topic, stamp, message):
+        """Buffer a message, the stamp of the unstamped topics is ignored and may be None"""
+        with self.condition:
+            self.stats[topic]["received"] += 1
+            self.stats[topic]["dropped"] += self._push(self.buffers[topic], (stamp, message, time.monotonic()))
+            if self._match():
+                self.condition.notify_all()
+
+    def _match(self):
+        matched = False
+        references = self.buffers[self.reference]
+        while references:
+            stamp, received = references[0][0], references[0][2]
+            picks, waiting, hopeless = {}, False, False
+            for topic in self.topics:
+                if topic == self.reference:
+                    continue
+                buffer = self.buffers[topic]
+                if topic in self.unstamped:
+                    before = [k for k in range(len(buffer)) if buffer[k][2] <= received]
+                    if before:
+                        picks[topic] = before[-1]
+                    else:
+                        hopeless = True  # nothing received before the reference message, later ones never pair
+                    continue
+                while buffer and buffer[0][0] < stamp - self.slop:
+                    buffer.popleft()
+                    self.stats[topic]["mismatched"] += 1
+                within = [k for k in range(len(buffer)) if buffer[k][0] <= stamp + self.slop]
+                if within:
+                    picks[topic] = min(within, key=lambda k: abs(buffer[k][0] - stamp))
+                elif buffer:
+                    hopeless = True  # only newer messages, this reference message never matches
+                else:
+                    waiting = True
+            if hopeless:
+                references.popleft()
+                self.stats[self.reference]["mismatched"] += 1
+                continue
+            if waiting:
+                break
+            bundle = {"stamp": stamp, self.reference: references.popleft()[1]}
+            self.stats[self.reference]["matched"] += 1
+            for topic, k in picks.items():
+                buffer, stats = self.buffers[topic], self.stats[topic]
+                for _ in range(k):  # skipped for a closer message
+                    if buffer.popleft() is not self.paired.get(topic):
+                        stats["mismatched"] += 1
+                if topic in self.unstamped:
+                    # kept for the next reference messages, the lag is on the receive clock
+                    self.paired[topic] = buffer[0]
+                    topic_stamp, bundle[topic], topic_received = buffer[0]
+                    lag = topic_received - received
+                else:
+                    topic_stamp, bundle[topic], _ = buffer.popleft()
+                    lag = topic_stamp - stamp
+                stats["matched"] += 1
+                stats["lag"] = lag
+                stats["max_lag"] = max(stats["max_lag"], abs(stats["lag"]))
+            self.dropped_bundles += self._push(self.bundles, bundle)
+            matched = True
+        return matched
+
+    def get(self, timeout=None, latest=False):
+        """
+        Oldest matched bundle, or the newest one skipping the others if latest, a dict of the stamp, the message of
+        every topic and the number of skipped bundles. None after timeout seconds.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.bundles) > 0, timeout):
+                return None
+            if not latest:
+                bundle = self.bundles.popleft()
+                bundle["skipped"] = 0
+                return bundle
+            bundle = self.bundles.pop()
+            bundle["skipped"] = len(self.bundles)
+            self.skipped_bundles += len(self.bundles)
+            self.bundles.clear()
+            return bundle
+
+    def summary(self):
+        topics = ", ".join(f"{topic} {s['received']} received, {s['matched']} matched, {s['dropped']} dropped, "
+                           f"{s['mismatched']} mismatched, lag {1e3 * s['lag']:.1f}ms (max {1e3 * s['max_lag']:.1f}ms)"
+                           for topic, s in self.stats.items())
+        return f"{topics}; {self.dropped_bundles} bundles dropped, {self.skipped_bundles} skipped"
+
+
 class image_converter:
-    def __init__(self, is_track_publish_activated=0):
-    #initialize a queue to store cv_image from callback
-        DELAY_FRAMES = 1
-        self.cv_image_queue = queue.Queue()
-        self.cv_image_internal_queue = deque(maxlen=DELAY_FRAMES)
+    def __init__(self, is_track_publish_activated=0, sync_slop=0.05, sync_buffer=30, sync_policy="oldest"):
+        #color, depth and odometry messages are paired by stamp, the images are decoded once matched
+        #the ground truth has no header, a color frame gets the newest ground truth received before it
+        self.synchronizer = StampSynchronizer(("color", "depth", "odom", "gt"), slop=sync_slop,
+                                              buffer_size=sync_buffer, drop_policy=sync_policy, unstamped=("gt",))
         self.sim_reset_queue = queue.Queue()
-        self.depth_image_queue = queue.Queue()
-        self.depth_image_internal_queue = deque(maxlen=DELAY_FRAMES)
-        self.odom_queue = queue.Queue()
-        self.odom_internal_queue = deque(maxlen=DELAY_FRAMES)
-        self.gt_queue = queue.Queue()
-        self.gt_internal_queue = deque(maxlen=1)
 
         self.is_track_publish_activated = is_track_publish_activated
         if self.is_track_publish_activated == 1:
-            from my_tracker.msg import ImageDetectionMessage
+            from my_tracker.msg import ImageDetectionMessage, TrackBox
+            self.ImageDetectionMessage, self.TrackBox = ImageDetectionMessage, TrackBox
             self.track_publisher = rospy.Publisher("/image_tracks",ImageDetectionMessage, queue_size=10)
 
         self.bridge = CvBridge()
@@ -38,6 +185,12 @@ class image_converter:
         self.odom_sub = rospy.Subscriber("/odometry/filtered",Odometry,self.odom_callback)
         self.sub_gt = rospy.Subscriber('/carla_tracks', Float32MultiArray, self.callback_gt)
 
+    @staticmethod
+    def stamp(data):
+        #header stamp in seconds, None for the messages without a header (Float32MultiArray)
+        header = getattr(data, "header", None)
+        return header.stamp.to_sec() if header is not None else None
+
     def process_gt(self, gt_raw):
         #gt_raw is a Float32MultiArray
         #get every five elements and convert them to a list of dictionary, each element is (id, min_x, min_y, max_x, max_y)
@@ -48,50 +201,65 @@ class image_converter:
 
 
     def callback_gt(self, data):
-        self.gt_internal_queue.append(data)
-        self.gt_queue.put(self.process_gt(self.gt_internal_queue[0]))
+        self.synchronizer.put("gt", self.stamp(data), data)
 
     def sim_reset_callback(self,data):
         print("sim_reset_callback")
         self.sim_reset_queue.put(data)
     def callback(self,data):
-        try:
-            cv_image = self.bridge.compressed_imgmsg_to_cv2(data, "passthrough")
-            self.cv_image_internal_queue.append(cv_image)
-            self.cv_image_queue.put(self.cv_image_internal_queue[0])
-            
-            # cv_image = self.bridge.imgmsg_to_cv2(data, "bgr8")
-            # self.cv_image_queue.put(cv_image)
-        except CvBridgeError as e:
-            print(e)
+        self.synchronizer.put("color", self.stamp(data), data)
 
     def depth_image_callback(self,data):
-        try:
-            cv_image = self.bridge.compressed_imgmsg_to_cv2(data, "passthrough")
-            # cv_image = self.bridge.imgmsg_to_cv2(data, "bgr8")
-            #data is Float32MultiArray and has a layout, convert it to numpy array
-            # cv_image = np.array(data.data).reshape(data.layout.dim[0].size,data.layout.dim[1].size)
-            self.depth_image_internal_queue.append(cv_image)
-            self.depth_image_queue.put(self.depth_image_internal_queue[0])
-            # self.depth_image_queue.put(cv_image)
-        except CvBridgeError as e:
-            print(e)
+        self.synchronizer.put("depth", self.stamp(data), data)
 
     def odom_callback(self,data):
-        self.odom_internal_queue.append(data)
-        self.odom_queue.put(self.odom_internal_queue[0])
-        # if len(self.odom_internal_queue) > 1:
-        #     if np.abs(self.odom_internal_queue[0].header.stamp.to_time() - self.odom_internal_queue[1].header.stamp.to_time()) < 1e-5:
-        #         print("*********************timestamp of odom headers the same**************************")
-            # if hash(str(self.odom_internal_queue[0])) == hash(str(self.odom_internal_queue[1])):
-            #     print("*********************odom headers the same**************************")
-
-        # self.odom_queue.put(data)
+        self.synchronizer.put("odom", self.stamp(data), data)
 
+    def get_synced(self, timeout=None, latest=False):
+        #next bundle of the color image, depth image, odometry and ground truth of one stamp, None after timeout
+        #latest skips to the newest bundle, "skipped" counts the bundles skipped since the previous one
+        skipped = 0
+        while True:
+            bundle = self.synchronizer.get(timeout, latest)
+            if bundle is None:
+                return None
+            skipped += bundle["skipped"]
+            try:
+                color = self.bridge.compressed_imgmsg_to_cv2(bundle["color"], "passthrough")
+                depth = self.bridge.compressed_imgmsg_to_cv2(bundle["depth"], "passthrough")
+            except CvBridgeError as e:
+                print(e)
+                skipped += 1
+                continue
+            return {"stamp": bundle["stamp"], "color": color, "depth": depth, "odom": bundle["odom"],
+                    "gt": self.process_gt(bundle["gt"]), "skipped": skipped}
 
+    def publish_tracks(self, im0, tracks, stamp=None, image="raw"):
+        #publish the tracks (x1, y1, x2, y2, track_id, class, conf, ...) of the frame on /image_tracks
+        #image "raw" sends the bgr8 bytes of im0, "jpeg" the encoded frame and "none" the tracks only
+        message = self.ImageDetectionMessage()
+        message.header.stamp = rospy.Time.from_sec(stamp) if stamp is not None else rospy.Time.now()
+        message.im_height, message.im_width = im0.shape[:2]
+        if image == "raw":
+            message.encoding = "bgr8"
+            message.im_data = np.ascontiguousarray(im0).tobytes()
+        elif image == "jpeg":
+            message.encoding = "jpeg"
+            message.im_data = cv2.imencode(".jpg", im0)[1].tobytes()
+        else:
+            message.encoding = ""
+            message.im_data = b""
+        for row in tracks if tracks is not None else []:
+            track = self.TrackBox()
+            track.x1, track.y1, track.x2, track.y2 = (float(v) for v in row[:4])
+            track.track_id = int(row[4])
+            track.class_id = int(row[5])
+            track.conf = float(row[6])
+            message.tracks.append(track)
+        self.track_publisher.publish(message)
 
     def get_queue_size(self):
-        return self.cv_image_queue.qsize()
+        return len(self.synchronizer.bundles)
 
     # (rows,cols,channels) = cv_image.shape
     # if cols > 60 and rows > 60 :
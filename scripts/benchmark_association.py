@@ -0,0 +1,105 @@
+"""Benchmark of the vectorized OC-SORT association bookkeeping against the former Python loops,
+with the per-stage timing breakdown of `associate_kitti`.
+
+    python scripts/benchmark_association.py --sizes 50 200 500
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.ocsort.association import (associate_kitti, association_timer, category_mask, filter_matches,
+                                         linear_assignment)
+
+
+def loop_filter_matches(matched_indices, iou_matrix, iou_threshold):
+    """The unmatched sets and low IoU filtering of the former associate functions."""
+    unmatched_detections = []
+    for d in range(iou_matrix.shape[0]):
+        if(d not in matched_indices[:,0]):
+            unmatched_detections.append(d)
+    unmatched_trackers = []
+    for t in range(iou_matrix.shape[1]):
+        if(t not in matched_indices[:,1]):
+            unmatched_trackers.append(t)
+    matches = []
+    for m in matched_indices:
+        if(iou_matrix[m[0], m[1]]<iou_threshold):
+            unmatched_detections.append(m[0])
+            unmatched_trackers.append(m[1])
+        else:
+            matches.append(m.reshape(1,2))
+    if(len(matches)==0):
+        matches = np.empty((0,2),dtype=int)
+    else:
+        matches = np.concatenate(matches,axis=0)
+    return matches, np.array(unmatched_detections), np.array(unmatched_trackers)
+
+
+def loop_category_mask(det_cates, trk_cates):
+    cate_matrix = np.zeros((len(det_cates), len(trk_cates)))
+    for i in range(len(det_cates)):
+        for j in range(len(trk_cates)):
+            if det_cates[i] != trk_cates[j]:
+                cate_matrix[i][j] = -1e6
+    return cate_matrix
+
+
+def random_scene(n, rng):
+    """n tracks and about n detections of them, some missed and some new"""
+    xy = rng.uniform(0, 1800, (n, 2))
+    wh = rng.uniform(10, 80, (n, 2))
+    trks = np.c_[xy, xy + wh, rng.integers(0, 3, n)]
+    keep = rng.random(n) > 0.1
+    dets = trks[keep, :4] + rng.normal(0, 3, (keep.sum(), 4))
+    new = rng.uniform(0, 1800, (n // 10, 2))
+    dets = np.r_[dets, np.c_[new, new + 40]]
+    dets = np.c_[dets, rng.uniform(0.3, 1, len(dets))].astype(np.float32)
+    cates = np.r_[trks[keep, 4], rng.integers(0, 3, n // 10)]
+    prev = np.c_[trks[:, :4] - rng.normal(0, 3, (n, 4)), np.ones(n)]
+    velocities = rng.normal(0, 1, (n, 2))
+    return dets, trks, cates, velocities, prev
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    print(f"{'size':>6} {'loop post [ms]':>15} {'post [ms]':>10} {'loop gate [ms]':>15} {'gate [ms]':>10} "
+          f"{'lapjv [ms]':>11}  associate_kitti stages")
+    for n in opt.sizes:
+        dets, trks, cates, velocities, prev = random_scene(n, rng)
+        iou_matrix = np.clip(1 - np.abs(dets[:, None, 0] - trks[None, :, 0]) / 20, 0, 1)
+        matched_indices = linear_assignment(-iou_matrix)
+        loop, vectorized = loop_filter_matches(matched_indices, iou_matrix, 0.3), filter_matches(matched_indices, iou_matrix, 0.3)
+        assert all(np.array_equal(a, b) for a, b in zip(loop, vectorized))
+        assert np.array_equal(loop_category_mask(cates, trks[:, 4]), category_mask(cates, trks[:, 4]))
+        t_loop_post = time_it(lambda: loop_filter_matches(matched_indices, iou_matrix, 0.3), opt.repeat)
+        t_post = time_it(lambda: filter_matches(matched_indices, iou_matrix, 0.3), opt.repeat)
+        t_loop_gate = time_it(lambda: loop_category_mask(cates, trks[:, 4]), max(1, opt.repeat // 10))
+        t_gate = time_it(lambda: category_mask(cates, trks[:, 4]), opt.repeat)
+        t_solve = time_it(lambda: linear_assignment(-iou_matrix), opt.repeat)
+        association_timer.reset()
+        for _ in range(opt.repeat):
+            associate_kitti(dets, trks, cates, 0.3, velocities, prev, 0.2)
+        print(f"{n:>6} {1e3 * t_loop_post:>15.3f} {1e3 * t_post:>10.3f} {1e3 * t_loop_gate:>15.3f} {1e3 * t_gate:>10.3f} "
+              f"{1e3 * t_solve:>11.3f}  {association_timer.summary()}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 500], help='number of tracks')
+    parser.add_argument('--repeat', type=int, default=50, help='calls timed per size')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,119 @@
+"""Accuracy and latency of the Deep OC-SORT sparse optical flow CMC settings on the MOT17-mini sequences.
+
+The affines of every setting are compared to the former full resolution CMC with 3000 corners, the
+error is the mean displacement in pixels of the frame corners mapped by both affines.
+
+    python scripts/benchmark_cmc.py --settings 1,3000 2,1000 4,500
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / 'trackers' / 'deepocsort'))  # cmc alone, without the ReID models of the tracker
+from cmc import CMCComputer, box_mask
+
+
+class LoopSparseFlow(object):
+    """The former sparse flow CMC at full resolution with 3000 corners."""
+
+    def __init__(self, minimum_features=10):
+        self.minimum_features = minimum_features
+        self.prev_img = None
+        self.prev_desc = None
+        self.sparse_flow_param = dict(maxCorners=3000, qualityLevel=0.01, minDistance=1, blockSize=3,
+                                      useHarrisDetector=False, k=0.04)
+
+    def compute_affine(self, img, bbox):
+        frame = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        mask = box_mask(frame.shape, bbox)
+        A = np.eye(2, 3)
+        keypoints = cv2.goodFeaturesToTrack(frame, mask=mask, **self.sparse_flow_param)
+        if self.prev_img is None:
+            self.prev_img, self.prev_desc = frame, keypoints
+            return A
+        matched_kp, status, err = cv2.calcOpticalFlowPyrLK(self.prev_img, frame, self.prev_desc, None)
+        status = status.reshape(-1).astype(bool)
+        prev_points = self.prev_desc.reshape(-1, 2)[status]
+        curr_points = matched_kp.reshape(-1, 2)[status]
+        if prev_points.shape[0] > self.minimum_features:
+            A, _ = cv2.estimateAffinePartial2D(prev_points, curr_points, method=cv2.RANSAC)
+        if A is None:
+            A = np.eye(2, 3)
+        self.prev_img, self.prev_desc = frame, keypoints
+        return A
+
+
+def load_sequences(root):
+    """(name, frames, detections per frame) of the sequences under root"""
+    sequences = []
+    for seq in sorted(p for p in Path(root).iterdir() if p.is_dir()):
+        files = sorted((seq / seq.name).glob('*.jpg'))
+        frames = [cv2.imread(str(f)) for f in files]
+        det = np.loadtxt(seq / 'det' / 'det.txt', delimiter=',', ndmin=2)
+        boxes = []
+        for i in range(1, len(frames) + 1):
+            d = det[det[:, 0] == i, 2:6]
+            boxes.append(np.c_[d[:, :2], d[:, :2] + d[:, 2:]])
+        sequences.append((seq.name, frames, boxes))
+    return sequences
+
+
+def corner_error(A, B, shape):
+    """Mean distance in pixels between the frame corners mapped by the affines A and B"""
+    h, w = shape[:2]
+    corners = np.array([[0, 0, w, w], [0, h, 0, h]], dtype=np.float64)
+    return np.linalg.norm((A[:, :2] - B[:, :2]) @ corners + (A[:, 2:] - B[:, 2:]), axis=0).mean()
+
+
+def run(cmc, sequences, make, repeat):
+    """Affines and fastest mean per-frame latency of a fresh CMC of every sequence"""
+    latency = np.inf
+    for _ in range(repeat):
+        affines, times = [], []
+        for name, frames, boxes in sequences:
+            computer = make()
+            for i, (frame, bbox) in enumerate(zip(frames, boxes)):
+                start = time.perf_counter()
+                affines.append(cmc(computer, frame, bbox, f'{name}:{i + 1}'))
+                times.append(time.perf_counter() - start)
+        latency = min(latency, np.mean(times))
+    return affines, latency
+
+
+def sparse(downscale, max_corners):
+    def make():
+        return CMCComputer(downscale=downscale, max_corners=max_corners, cache_path=None)
+    return make
+
+
+def main(opt):
+    sequences = load_sequences(opt.source)
+    shapes = [frame.shape for _, frames, _ in sequences for frame in frames]
+    reference, t_reference = run(lambda c, f, b, tag: c.compute_affine(f, b), sequences, LoopSparseFlow, opt.repeat)
+    print(f"{'downscale':>10} {'corners':>8} {'latency [ms]':>13} {'speedup':>8} {'mean err [px]':>14} {'max err [px]':>13}")
+    print(f"{'former':>10} {3000:>8} {1e3 * t_reference:>13.2f} {1:>8.2f} {0:>14.3f} {0:>13.3f}")
+    for setting in opt.settings:
+        downscale, max_corners = (int(v) for v in setting.split(','))
+        affines, t = run(lambda c, f, b, tag: c.compute_affine(f, b, tag), sequences, sparse(downscale, max_corners), opt.repeat)
+        errors = [corner_error(A, B, shape) for A, B, shape in zip(affines, reference, shapes)]
+        print(f'{downscale:>10} {max_corners:>8} {1e3 * t:>13.2f} {t_reference / t:>8.2f} '
+              f'{np.mean(errors):>14.3f} {np.max(errors):>13.3f}')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', type=str, default=str(ROOT / 'assets' / 'MOT17-mini' / 'train'), help='MOT sequences directory')
+    parser.add_argument('--settings', type=str, nargs='+', default=['1,3000', '2,3000', '2,1000', '2,500', '4,500'],
+                        help='downscale,max_corners of the CMC')
+    parser.add_argument('--repeat', type=int, default=3, help='runs over the sequences, the fastest is reported')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,204 @@
+"""Throughput of the vectorized LiDAR depth image generation of the KITTI loader.
+
+Projects a synthetic KITTI-shaped Velodyne scan (64 beams, ~120k points, 1242x375 image)
+with `generate_depth` and reports the frames per second, optionally next to the former
+per-point / per-pixel loop implementation kept below as the reference.
+
+    python scripts/benchmark_depth.py --frames 20 --upsample 1 2 --reference
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent))
+import kitti_loader_utils as utils
+
+WIDTH, HEIGHT = 1242, 375
+# calibration of KITTI tracking sequence 0000
+K_CAM2 = np.array([[721.5377, 0., 609.5593],
+                   [0., 721.5377, 172.854],
+                   [0., 0., 1.]])
+TR_VELO_CAM = np.array([[7.533745e-03, -9.999714e-01, -6.166020e-04, -4.069766e-03],
+                        [1.480249e-02, 7.280733e-04, -9.998902e-01, -7.631618e-02],
+                        [9.998621e-01, 7.523790e-03, 1.480755e-02, -2.717806e-01],
+                        [0., 0., 0., 1.]])
+
+
+def synthetic_scan(rng, beams=64, points_per_beam=1900):
+    """A Velodyne HDL-64E like scan: 64 rings from +2 to -24.8 deg of elevation over a ground plane and boxes."""
+    elevation = np.deg2rad(np.linspace(2., -24.8, beams))[:, None]
+    azimuth = np.linspace(-np.pi, np.pi, points_per_beam, endpoint=False)[None, :] + rng.normal(0, 1e-3, (beams, points_per_beam))
+    # range to the ground 1.73m below the sensor, capped at 80m, with random obstacles in front of it
+    ground = np.where(elevation < 0, 1.73 / np.sin(-np.minimum(elevation, -1e-3)), 80.)
+    ranges = np.minimum(ground, 80.) * np.ones_like(azimuth)
+    for _ in range(30):
+        center, width, depth = rng.uniform(-np.pi, np.pi), rng.uniform(0.02, 0.3), rng.uniform(3, 60)
+        hit = (np.abs(np.angle(np.exp(1j * (azimuth - center)))) < width) & (elevation > -np.arctan2(1.73, depth))
+        ranges = np.where(hit, np.minimum(ranges, depth), ranges)
+    ranges = ranges + rng.normal(0, 0.02, ranges.shape)
+    keep = rng.random(ranges.shape) > 0.05  # dropped returns
+    x = (ranges * np.cos(elevation) * np.cos(azimuth))[keep]
+    y = (ranges * np.cos(elevation) * np.sin(azimuth))[keep]
+    z = (ranges * np.sin(elevation) * np.ones_like(azimuth))[keep]
+    velo = np.c_[x, y, z, np.ones_like(x)].astype(np.float32)
+    velo[:, 3] = 1.
+    return velo
+
+
+def depth_args(velo, upsample):
+    return dict(velodata=velo, intr_raw=np.hstack((K_CAM2, np.zeros((3, 1)))), M_velo2cam=TR_VELO_CAM,
+                width=WIDTH, height=HEIGHT, params={"filtering": 1, "upsample": upsample})
+
+
+def loop_upsample_velodyne(velodata_cam, params):
+    """The per-point binning and per-bin regeneration loops `upsample_velodyne` used before it was vectorized."""
+    total_vbeams = params.get('total_vbeams', 128)
+    total_hbeams = params.get('total_hbeams', 1500)
+    vbeam_fov = params.get('vbeam_fov', 0.2)
+    hbeam_fov = params.get('hbeam_fov', 0.08)
+    phioffset = 10
+    scale = params.get('upsample', 1.0)
+
+    vscale = 1.0
+    hscale = 1.0
+    vbeams = int(total_vbeams * vscale)
+    hbeams = int(total_hbeams * hscale)
+    vf = vbeam_fov / vscale
+    hf = hbeam_fov / hscale
+    rmap = np.zeros((vbeams, hbeams), dtype=np.float32)
+
+    # Cast to Angles
+    rtp = np.zeros((velodata_cam.shape[0], 3))
+    rtp[:, 0] = np.sqrt(np.sum(np.square(velodata_cam), axis=1))
+    rtp[:, 1] = np.arctan2(velodata_cam[:, 0], velodata_cam[:, 2]) * (180 / np.pi)
+    rtp[:, 2] = np.arcsin(velodata_cam[:, 1] / rtp[:, 0]) * (180 / np.pi) - phioffset
+
+    # Bin Data
+    for i in range(rtp.shape[0]):
+        r, theta, phi = rtp[i]
+        thetabin = int(((theta / hf) + hbeams / 2) + 0.5)
+        phibin = int(((phi / vf) + vbeams / 2) + 0.5)
+        if not (0 <= thetabin < hbeams and 0 <= phibin < vbeams):
+            continue
+        current_r = rmap[phibin, thetabin]
+        if r < current_r or current_r == 0:
+            rmap[phibin, thetabin] = r
+
+    # Upsample
+    vscale = vscale * scale
+    hscale = hscale * scale
+    vbeams = int(total_vbeams * vscale)
+    hbeams = int(total_hbeams * hscale)
+    vf = vbeam_fov / vscale
+    hf = hbeam_fov / hscale
+    rmap = cv2.resize(rmap, (0, 0), fx=hscale, fy=vscale, interpolation=cv2.INTER_NEAREST)
+
+    # Regenerate
+    xyz_new = np.ones((rmap.size, 4))
+    for phibin in range(rmap.shape[0]):
+        for thetabin in range(rmap.shape[1]):
+            i = phibin * rmap.shape[1] + thetabin
+            phi = ((phibin - (vbeams / 2)) * vf + phioffset) * (np.pi / 180)
+            theta = ((thetabin - (hbeams / 2)) * hf) * (np.pi / 180)
+            r = rmap[phibin, thetabin]
+            xyz_new[i, 0] = r * np.cos(phi) * np.sin(theta)
+            xyz_new[i, 1] = r * np.sin(phi)
+            xyz_new[i, 2] = r * np.cos(phi) * np.cos(theta)
+
+    return xyz_new
+
+
+def loop_generate_depth(velodata, intr_raw, M_velo2cam, width, height, params):
+    """The per-point z-buffer and per-pixel occlusion filter loops `generate_depth` used before it was vectorized."""
+    upsample = params.get('upsample', 1.0)
+    filtering = params.get('filtering', 1)
+
+    # Transform to Camera Frame
+    velodata_cam = (M_velo2cam @ velodata.T).T
+
+    # Remove points behind camera
+    valid_indices = velodata_cam[:, 2] >= 0.1
+    velodata_cam = velodata_cam[valid_indices]
+
+    # Upsample
+    if upsample > 1:
+        velodata_cam = loop_upsample_velodyne(velodata_cam, params)
+
+    # Project and Generate Pixels
+    velodata_cam_proj = (intr_raw @ velodata_cam.T).T
+    velodata_cam_proj[:, 0] /= velodata_cam_proj[:, 2]
+    velodata_cam_proj[:, 1] /= velodata_cam_proj[:, 2]
+
+    # Z Buffer assignment
+    dmap_raw = np.zeros((height, width))
+    for i in range(velodata_cam_proj.shape[0]):
+        u, v = (int(velodata_cam_proj[i, 0] + 0.5), int(velodata_cam_proj[i, 1] + 0.5)) if not np.isnan(velodata_cam_proj[i, 0]) and not np.isnan(velodata_cam_proj[i, 1]) else (0, 0)
+        if not (0 <= u < width and 0 <= v < height):
+            continue
+        z = velodata_cam_proj[i, 2]
+        if z < dmap_raw[v, u] or dmap_raw[v, u] == 0:
+            dmap_raw[v, u] = z
+
+    # Filtering
+    dmap_cleaned = np.zeros((height, width))
+    offset = filtering
+    for v in range(offset, height - offset - 1):
+        for u in range(offset, width - offset - 1):
+            z = dmap_raw[v, u]
+            bad = False
+
+            # Check neighbors
+            for vv in range(v - offset, v + offset + 1):
+                for uu in range(u - offset, u + offset + 1):
+                    if vv == v and uu == u:
+                        continue
+                    zn = dmap_raw[vv, uu]
+                    if zn == 0:
+                        continue
+                    if zn - z < -1:
+                        bad = True
+                        break
+
+            if not bad:
+                dmap_cleaned[v, u] = z
+
+    return dmap_cleaned
+
+
+def time_fps(fn, scans, upsample):
+    start = time.perf_counter()
+    for velo in scans:
+        fn(**depth_args(velo, upsample))
+    return len(scans) / (time.perf_counter() - start)
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    scans = [synthetic_scan(rng) for _ in range(opt.frames)]
+    print(f"{len(scans[0])} points per scan, {WIDTH}x{HEIGHT} depth image")
+    print(f"{'upsample':>9} {'vectorized [fps]':>17} {'loop [fps]':>11} {'speedup':>9} {'identical':>10}")
+    for upsample in opt.upsample:
+        fps = time_fps(utils.generate_depth, scans, upsample)
+        if opt.reference:
+            ref = loop_generate_depth(**depth_args(scans[0], upsample))
+            identical = np.array_equal(ref, utils.generate_depth(**depth_args(scans[0], upsample)))
+            loop_fps = time_fps(loop_generate_depth, scans[:1], upsample)
+            print(f"{upsample:>9} {fps:>17.1f} {loop_fps:>11.3f} {fps / loop_fps:>8.0f}x {str(identical):>10}")
+        else:
+            print(f"{upsample:>9} {fps:>17.1f} {'-':>11} {'-':>9} {'-':>10}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20, help='synthetic scans timed per setting')
+    parser.add_argument('--upsample', type=float, nargs='+', default=[1, 2])
+    parser.add_argument('--reference', action='store_true', help='also time the loop implementation on one scan')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
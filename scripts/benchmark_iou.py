@@ -0,0 +1,80 @@
+"""Benchmark of the shared IoU kernel against the former nested-loop bbox_ious.
+
+    python scripts/benchmark_iou.py --sizes 10 100 500
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.iou_kernels import box_iou
+
+
+def loop_bbox_ious(boxes, query_boxes):
+    """The nested Python loop bbox_ious of the ByteTrack family of trackers."""
+    N = boxes.shape[0]
+    K = query_boxes.shape[0]
+    overlaps = np.zeros((N, K), dtype=np.float32)
+    for k in range(K):
+        box_area = (
+            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
+            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+        )
+        for n in range(N):
+            iw = (
+                min(boxes[n, 2], query_boxes[k, 2]) -
+                max(boxes[n, 0], query_boxes[k, 0]) + 1
+            )
+            if iw > 0:
+                ih = (
+                    min(boxes[n, 3], query_boxes[k, 3]) -
+                    max(boxes[n, 1], query_boxes[k, 1]) + 1
+                )
+                if ih > 0:
+                    ua = float(
+                        (boxes[n, 2] - boxes[n, 0] + 1) *
+                        (boxes[n, 3] - boxes[n, 1] + 1) +
+                        box_area - iw * ih
+                    )
+                    overlaps[n, k] = iw * ih / ua
+    return overlaps
+
+
+def random_boxes(n, rng):
+    xy = rng.uniform(0, 900, (n, 2))
+    wh = rng.uniform(10, 150, (n, 2))
+    return np.ascontiguousarray(np.c_[xy, xy + wh], dtype=np.float32)
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    print(f"{'size':>10} {'loop [ms]':>12} {'kernel [ms]':>13} {'speedup':>9} {'max |diff|':>12}")
+    for n in opt.sizes:
+        a, b = random_boxes(n, rng), random_boxes(n, rng)
+        out = np.zeros((n, n), dtype=np.float32)
+        diff = np.max(np.abs(loop_bbox_ious(a, b) - box_iou(a, b, out=out, offset=1.)))
+        repeat = max(1, opt.repeat // n)
+        t_loop = time_it(lambda: loop_bbox_ious(a, b), repeat)
+        t_kernel = time_it(lambda: box_iou(a, b, out=out, offset=1.), opt.repeat)
+        print(f"{f'{n}x{n}':>10} {1e3 * t_loop:>12.3f} {1e3 * t_kernel:>13.3f} {t_loop / t_kernel:>8.0f}x {diff:>12.2e}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--repeat', type=int, default=100, help='kernel calls timed per size')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,84 @@
+"""Micro-benchmark of the EMAP Kalman filter prediction step.
+
+Compares the batched `KalmanFilter.multi_predict` against the former per-track
+loop and reports the per-frame cost for a growing number of tracks.
+
+    python scripts/benchmark_kalman.py --tracks 1 10 50 100 500
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.emap.kalman_filter import KalmanFilter
+
+IMG_WIDTH = 960
+IMG_HEIGHT = 540
+FOCAL_LENGTH = 480.0
+
+
+def loop_multi_predict(kf, mean, covariance, control_signal):
+    """The per-track prediction loop that `multi_predict` used before it was batched."""
+    mean, covariance = mean.copy(), covariance.copy()
+    std_pos = [kf._q1 * mean[:, 3], kf._q1 * mean[:, 3], 1e-2 * mean[:, 3], kf._q1 * mean[:, 3]]
+    std_vel = [kf._q4 * mean[:, 3], kf._q4 * mean[:, 3], 1e-5 * mean[:, 3], kf._q4 * mean[:, 3]]
+    sqr = np.square(np.r_[std_pos, std_vel]).T
+    for i in range(len(mean)):
+        this_motion_cov = np.diag(sqr[i])
+        this_motion_mat = kf.calculate_motion_mat(mean[i])
+        this_control_mat = kf.calculate_control_mat(mean[i])
+        mean_rot_applied = np.dot(control_signal[i][0], this_control_mat.T)[0]
+        depth_control_mat = kf.calculate_depth_control_mat(mean[i], control_signal[i])
+        mean_trans_applied = np.dot(control_signal[i][1], depth_control_mat.T)[0]
+        mean[i] = np.dot(mean[i], this_motion_mat.T) + mean_rot_applied + mean_trans_applied
+        covariance[i] = np.linalg.multi_dot((
+            this_motion_mat, covariance[i], this_motion_mat.T)) + this_motion_cov
+    return mean, covariance
+
+
+def random_tracks(kf, n, rng):
+    """Build n plausible track states and their (yaw_dot, D_dot, depth) control inputs."""
+    boxes = np.c_[rng.uniform(0, IMG_WIDTH, n), rng.uniform(0, IMG_HEIGHT, n),
+                  rng.uniform(0.3, 2.0, n), rng.uniform(20, 200, n)]
+    means, covs = zip(*[kf.initiate(box) for box in boxes])
+    means = np.asarray(means)
+    means[:, 4:] = rng.normal(0, 1, (n, 4))
+    depth = rng.uniform(2, 60, n)
+    depth[rng.random(n) < 0.2] = 0  # tracks without a valid depth reading
+    control = np.c_[np.full(n, 0.01), np.full(n, 0.8), depth]
+    return means, np.asarray(covs), control
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    kf = KalmanFilter(IMG_WIDTH, IMG_HEIGHT, FOCAL_LENGTH)
+    print(f"{'tracks':>8} {'loop [ms]':>12} {'batched [ms]':>14} {'speedup':>9} {'max |diff|':>12}")
+    for n in opt.tracks:
+        mean, cov, control = random_tracks(kf, n, rng)
+        ref_mean, ref_cov = loop_multi_predict(kf, mean, cov, control)
+        new_mean, new_cov = kf.multi_predict(mean.copy(), cov.copy(), control)
+        diff = max(np.max(np.abs(ref_mean - new_mean)), np.max(np.abs(ref_cov - new_cov)))
+        t_loop = time_it(lambda: loop_multi_predict(kf, mean, cov, control), opt.repeat)
+        t_batch = time_it(lambda: kf.multi_predict(mean.copy(), cov.copy(), control), opt.repeat)
+        print(f"{n:>8} {1e3 * t_loop:>12.3f} {1e3 * t_batch:>14.3f} {t_loop / t_batch:>8.1f}x {diff:>12.2e}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, nargs='+', default=[1, 10, 50, 100, 200, 500])
+    parser.add_argument('--repeat', type=int, default=50, help='frames timed per track count')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
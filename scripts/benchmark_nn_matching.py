@@ -0,0 +1,101 @@
+"""Latency of the StrongSORT appearance gallery, partial_fit and distance of a frame, with the
+gallery tensor of NearestNeighborDistanceMetric against the former dict of per-target sample lists.
+
+    python scripts/benchmark_nn_matching.py --targets 10 50 100 --budget 100 --device cpu
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / 'trackers' / 'strongsort'))
+from sort.nn_matching import NearestNeighborDistanceMetric, _nn_cosine_distance
+
+
+class LoopNearestNeighborDistanceMetric(object):
+    """The former cosine metric, the samples of every target stacked again at every distance call"""
+
+    def __init__(self, matching_threshold, budget=None):
+        self.matching_threshold = matching_threshold
+        self.budget = budget
+        self.samples = {}
+
+    def partial_fit(self, features, targets, active_targets):
+        for feature, target in zip(features, targets):
+            self.samples.setdefault(target, []).append(feature)
+            if self.budget is not None:
+                self.samples[target] = self.samples[target][-self.budget:]
+        self.samples = {k: self.samples[k] for k in active_targets}
+
+    def distance(self, features, targets):
+        cost_matrix = np.zeros((len(targets), len(features)))
+        for i, target in enumerate(targets):
+            cost_matrix[i, :] = _nn_cosine_distance(self.samples[target], features)
+        return cost_matrix
+
+
+def unit(x):
+    return (x / np.linalg.norm(x, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def make_frames(n_targets, n_frames, dim, rng):
+    """Per frame the smoothed features of the confirmed tracks and the detection features, a tenth
+    of the targets replaced by new ones every 10 frames"""
+    ids = np.arange(n_targets)
+    means = unit(rng.standard_normal((n_targets, dim)))
+    frames = []
+    for i in range(n_frames):
+        if i % 10 == 9:
+            leaving = rng.choice(n_targets, max(1, n_targets // 10), replace=False)
+            ids[leaving] = ids.max() + 1 + np.arange(len(leaving))
+            means[leaving] = unit(rng.standard_normal((len(leaving), dim)))
+        tracks = unit(means + 0.1 * rng.standard_normal(means.shape))
+        detections = unit(means + 0.2 * rng.standard_normal(means.shape))
+        frames.append((tracks, ids.copy(), detections))
+    return frames
+
+
+def run(metric, frames):
+    """Mean per-frame latency of partial_fit and distance, and the cost matrices of all the targets and of a fifth of them"""
+    costs, t_fit, t_distance = [], [], []
+    for tracks, ids, detections in frames:
+        start = time.perf_counter()
+        metric.partial_fit(tracks, ids, list(ids))
+        t_fit.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        costs.append(metric.distance(detections, ids))
+        costs.append(metric.distance(detections, ids[::5]))  # a level of the matching cascade
+        t_distance.append(time.perf_counter() - start)
+    return costs, np.mean(t_fit), np.mean(t_distance)
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    print(f"{'targets':>8} {'former fit/dist [ms]':>21} {'gallery fit/dist [ms]':>22} {'speedup':>8} {'max diff':>9}")
+    for n_targets in opt.targets:
+        frames = make_frames(n_targets, opt.frames, opt.dim, rng)
+        loop, t_fit_loop, t_dist_loop = run(LoopNearestNeighborDistanceMetric(0.2, opt.budget), frames)
+        metric = NearestNeighborDistanceMetric('cosine', 0.2, opt.budget, device=opt.device)
+        gallery, t_fit, t_dist = run(metric, frames)
+        diff = max(np.abs(a - b).max() for a, b in zip(loop, gallery))
+        print(f'{n_targets:>8} {1e3 * t_fit_loop:>10.2f} / {1e3 * t_dist_loop:>7.2f} {1e3 * t_fit:>11.2f} / {1e3 * t_dist:>7.2f} '
+              f'{(t_fit_loop + t_dist_loop) / (t_fit + t_dist):>8.2f} {diff:>9.2e}')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--targets', type=int, nargs='+', default=[10, 50, 100], help='confirmed tracks per frame')
+    parser.add_argument('--budget', type=int, default=100, help='nn_budget, samples kept per target')
+    parser.add_argument('--dim', type=int, default=512, help='ReID feature dimension')
+    parser.add_argument('--frames', type=int, default=300, help='frames per run')
+    parser.add_argument('--device', type=str, default='cpu', help='device of the gallery, i.e. cuda:0 or cpu')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -0,0 +1,93 @@
+"""Benchmark of the batched OC-SORT KalmanBoxBank against per-track KalmanFilterNew objects.
+
+Times one predict (with the EMAP ego-motion control terms) and one update of every track,
+the Kalman filter work of an OCSort.update frame, for a growing number of tracks.
+
+    python scripts/benchmark_ocsort_bank.py --tracks 10 100 1000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.ocsort.kalmanfilter import KalmanFilterNew
+from trackers.ocsort.state_bank import KalmanBoxBank
+
+IMG_WIDTH = 960
+IMG_HEIGHT = 540
+
+
+def random_states(n, rng):
+    """n boxes [u, v, s, r] with random velocities, their (yaw_dot, D_dot, depth) control inputs and measurements"""
+    z = np.c_[rng.uniform(0, IMG_WIDTH, n), rng.uniform(0, IMG_HEIGHT, n),
+              rng.uniform(200, 20000, n), rng.uniform(0.3, 2.0, n)]
+    velocity = rng.normal(0, 1, (n, 3))
+    depth = rng.uniform(2, 60, n)
+    depth[rng.random(n) < 0.2] = 0  # tracks without a valid depth reading
+    control = np.c_[np.full(n, 0.01), np.full(n, 0.8), depth]
+    measurement = z + rng.normal(0, 1, (n, 4)) * [2, 2, 50, 0.01]
+    return z, velocity, control, measurement
+
+
+def make_filters(bank, z, velocity):
+    """One KalmanFilterNew per track set up like the former KalmanBoxTracker.__init__"""
+    filters = []
+    for i in range(len(z)):
+        kf = KalmanFilterNew(dim_x=7, dim_z=4)
+        kf.F, kf.H, kf.R, kf.Q = bank.F, bank.H, bank.R.copy(), bank.Q.copy()
+        kf.P = bank.P0.copy()
+        kf.x[:4, 0] = z[i]
+        kf.x[4:, 0] = velocity[i]
+        filters.append(kf)
+    return filters
+
+
+def loop_step(filters, control, measurement):
+    for kf, c, m in zip(filters, control, measurement):
+        kf.predict(control_input=c)
+        kf.update(m.reshape(4, 1))
+
+
+def bank_step(bank, rows, control, measurement):
+    bank.predict(rows, control)
+    bank.update(rows, measurement)
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    print(f"{'tracks':>8} {'per-track [ms]':>15} {'bank [ms]':>10} {'speedup':>9} {'max |diff|':>12}")
+    for n in opt.tracks:
+        z, velocity, control, measurement = random_states(n, rng)
+        bank = KalmanBoxBank(capacity=n)
+        rows = np.array([bank.attach(zi) for zi in z])
+        bank.x[rows, 4:] = velocity
+        filters = make_filters(bank, z, velocity)
+        loop_step(filters, control, measurement)
+        bank_step(bank, rows, control, measurement)
+        diff = max(max(np.max(np.abs(kf.x[:, 0] - bank.x[row])), np.max(np.abs(kf.P - bank.P[row])))
+                   for kf, row in zip(filters, rows))
+        repeat = max(1, opt.repeat // n)
+        t_loop = time_it(lambda: loop_step(filters, control, measurement), repeat)
+        t_bank = time_it(lambda: bank_step(bank, rows, control, measurement), opt.repeat)
+        print(f"{n:>8} {1e3 * t_loop:>15.3f} {1e3 * t_bank:>10.3f} {t_loop / t_bank:>8.1f}x {diff:>12.2e}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=100, help='frames timed per track count')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
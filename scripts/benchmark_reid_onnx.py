@@ -0,0 +1,70 @@
+"""CPU latency of the ONNX ReID model against the number of crops, running the batches as bucket sized chunks
+through the preallocated IOBinding buffers of ReIDDetectMultiBackend against a session run at the exact batch size.
+
+    python trackers/reid_export.py --weights osnet_x0_25_msmt17.pt --include onnx --dynamic
+    python scripts/benchmark_reid_onnx.py --weights osnet_x0_25_msmt17.onnx --threads 1 2 4
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / 'yolov8'))
+sys.path.append(str(ROOT / 'trackers' / 'strongsort'))
+from reid_multibackend import ReIDDetectMultiBackend
+
+
+def loop_session_run(model, im_batch):
+    """The former ONNX inference, a fresh input of the exact batch size at every call"""
+    session = model.session
+    return session.run([session.get_outputs()[0].name], {session.get_inputs()[0].name: im_batch})[0]
+
+
+def time_it(fn, batches, repeat):
+    """Mean latency of fn over the batches"""
+    for im_batch in batches:
+        fn(im_batch)  # first run of the shape
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for im_batch in batches:
+            fn(im_batch)
+    return (time.perf_counter() - start) / (repeat * len(batches))
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    for threads in opt.threads:
+        model = ReIDDetectMultiBackend(weights=Path(opt.weights), device=torch.device('cpu'), onnx_threads=threads or None)
+        print(f"{model.session.get_session_options().intra_op_num_threads} intra-op threads, buckets {model.onnx_buckets}")
+        print(f"{'crops':>6} {'exact [ms]':>11} {'bucketed [ms]':>14} {'per crop [ms]':>14} {'max diff':>9}")
+        # the crop counts of a stream of frames, every call with a new batch size
+        mixed = [rng.standard_normal((n, 3, *model.image_size), dtype=np.float32)
+                 for n in rng.integers(1, max(opt.crops) + 1, 20)]
+        for n in opt.crops:
+            batches = [rng.standard_normal((n, 3, *model.image_size), dtype=np.float32)]
+            diff = np.abs(loop_session_run(model, batches[0]) - model._onnx_run(batches[0])).max()
+            t_exact = time_it(lambda x: loop_session_run(model, x), batches, opt.repeat)
+            t_bucketed = time_it(model._onnx_run, batches, opt.repeat)
+            print(f'{n:>6} {1e3 * t_exact:>11.2f} {1e3 * t_bucketed:>14.2f} {1e3 * t_bucketed / n:>14.3f} {diff:>9.2e}')
+        t_exact = time_it(lambda x: loop_session_run(model, x), mixed, max(1, opt.repeat // 5))
+        t_bucketed = time_it(model._onnx_run, mixed, max(1, opt.repeat // 5))
+        n = np.mean([len(x) for x in mixed])
+        print(f"{'mixed':>6} {1e3 * t_exact:>11.2f} {1e3 * t_bucketed:>14.2f} {1e3 * t_bucketed / n:>14.3f}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='osnet_x0_25_msmt17.onnx', help='ONNX ReID model with a dynamic batch')
+    parser.add_argument('--crops', type=int, nargs='+', default=[1, 2, 4, 8, 13, 16, 24, 32, 48, 64], help='crops per call')
+    parser.add_argument('--threads', type=int, nargs='+', default=[0], help='intra-op threads, 0 for the CPUs of the process')
+    parser.add_argument('--repeat', type=int, default=10, help='calls timed per batch')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
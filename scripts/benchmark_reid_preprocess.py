@@ -0,0 +1,81 @@
+"""Benchmark of the batched ReID preprocessing of the boxes of a frame against the crop by crop
+PIL preprocessing, with the forward pass of the ReID model for scale, on the MOT17-mini sequences.
+
+    python scripts/benchmark_reid_preprocess.py --weights osnet_x0_25_msmt17.pt --device cpu
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / 'yolov8'))
+sys.path.append(str(ROOT / 'trackers' / 'strongsort'))
+sys.path.append(str(ROOT / 'scripts'))
+from reid_multibackend import ReIDDetectMultiBackend
+from benchmark_cmc import load_sequences
+
+
+def loop_crops(img, boxes):
+    """The crops of the former _get_features of the trackers"""
+    return [img[y1:y2, x1:x2] for x1, y1, x2, y2 in boxes]
+
+
+def int_boxes(bbox, shape):
+    """Integer xyxy boxes clipped to the frame, like the _xywh_to_xyxy of the trackers"""
+    h, w = shape[:2]
+    boxes = np.trunc(bbox).astype(int)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w - 1)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h - 1)
+    return boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - start) / repeat
+
+
+def main(opt):
+    model = ReIDDetectMultiBackend(weights=Path(opt.weights), device=torch.device(opt.device), fp16=opt.half)
+    frames = [(frame, int_boxes(bbox, frame.shape)) for _, frames, boxes in load_sequences(opt.source)
+              for frame, bbox in zip(frames, boxes)]
+    t_loop, t_batched, t_forward, diffs, sims = [], [], [], [], []
+    with torch.no_grad():
+        for frame, boxes in frames:
+            if len(boxes) == 0:
+                continue
+            loop, t = time_it(lambda: model._preprocess(loop_crops(frame, boxes)), opt.repeat)
+            t_loop.append(t)
+            batched, t = time_it(lambda: model._preprocess_boxes(frame, boxes), opt.repeat)
+            t_batched.append(t)
+            diffs.append((loop - batched).abs().mean().item())
+            features, t = time_it(lambda: model(frame, boxes), opt.repeat)
+            t_forward.append(t - t_batched[-1])
+            sims.append(torch.nn.functional.cosine_similarity(model(loop_crops(frame, boxes)).float(),
+                                                              features.float()).min().item())
+    n = np.mean([len(boxes) for _, boxes in frames])
+    print(f'{len(t_loop)} frames, {n:.1f} crops per frame on {opt.device}')
+    print(f'PIL preprocess {1e3 * np.mean(t_loop):.2f}ms, batched preprocess {1e3 * np.mean(t_batched):.2f}ms, '
+          f'model forward {1e3 * np.mean(t_forward):.2f}ms')
+    print(f'mean abs difference of the normalized crops {np.mean(diffs):.4f}, '
+          f'min cosine similarity of the features {np.min(sims):.4f}')
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default='osnet_x0_25_msmt17.pt', help='ReID model weights')
+    parser.add_argument('--device', type=str, default='cpu', help='cuda device, i.e. cuda:0 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--source', type=str, default=str(ROOT / 'assets' / 'MOT17-mini' / 'train'), help='MOT sequences directory')
+    parser.add_argument('--repeat', type=int, default=5, help='calls timed per frame')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
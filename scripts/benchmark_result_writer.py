@@ -0,0 +1,75 @@
+"""Benchmark of the buffered ResultWriter against the former open, write and close per result line of track.py.
+
+    python scripts/benchmark_result_writer.py --frames 1000 --tracks 30
+"""
+import argparse
+import filecmp
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from result_writer import ResultWriter
+
+
+def loop_write(path, frames):
+    """The per line appends of the MOT results in track.py."""
+    for frame_idx, outputs in enumerate(frames):
+        for output in outputs:
+            with open(path, "a") as f:
+                f.write(
+                    ("%g " * 10 + "\n")
+                    % (frame_idx + 1, output[4], output[0], output[1], output[2] - output[0], output[3] - output[1],
+                       -1, -1, -1, 0)
+                )
+
+
+def buffered_write(path, frames, fmt="mot"):
+    with ResultWriter(path, fmt=fmt, names={0: "person"}) as writer:
+        for frame_idx, outputs in enumerate(frames):
+            for output in outputs:
+                writer.write(frame_idx, output[4], output[0], output[1], output[2] - output[0], output[3] - output[1],
+                             output[6], output[5], 0)
+
+
+def random_frames(n_frames, n_tracks, rng):
+    # x1, y1, x2, y2, id, cls, conf rows in float32 like the tracker outputs
+    frames = []
+    for _ in range(n_frames):
+        xy = rng.uniform(0, 1800, (n_tracks, 2))
+        wh = rng.uniform(10, 300, (n_tracks, 2))
+        ids = np.arange(1, n_tracks + 1)[:, None]
+        frames.append(np.c_[xy, xy + wh, ids, np.zeros((n_tracks, 1)), rng.uniform(0, 1, (n_tracks, 1))]
+                      .astype(np.float32))
+    return frames
+
+
+def main(opt):
+    frames = random_frames(opt.frames, opt.tracks, np.random.default_rng(0))
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        loop_write(os.path.join(tmp, "loop.txt"), frames)
+        t_loop = time.perf_counter() - start
+        print(f"{opt.frames} frames of {opt.tracks} tracks, open per line {1e3 * t_loop:.1f} ms")
+        for fmt in ("mot", "kitti", "bin"):
+            path = os.path.join(tmp, f"{fmt}.{'bin' if fmt == 'bin' else 'txt'}")
+            start = time.perf_counter()
+            buffered_write(path, frames, fmt)
+            t = time.perf_counter() - start
+            same = f", same bytes {filecmp.cmp(path, os.path.join(tmp, 'loop.txt'), shallow=False)}" if fmt == "mot" else ""
+            print(f"{fmt:>6} writer {1e3 * t:.1f} ms {t_loop / t:.1f}x{same}, {os.path.getsize(path)} bytes")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--tracks', type=int, default=30)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
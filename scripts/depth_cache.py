@@ -0,0 +1,153 @@
+"""On-disk cache of the LiDAR depth images generated by the KITTI loader.
+
+The depth images of a sequence are stored in one float16 (frames, height, width) `.npy`
+memmap next to a per-frame "filled" flag array, so later runs read them back zero-copy
+instead of projecting the Velodyne scans again. Every store is keyed by the cache version,
+the sequence, the calibration used for the projection, the depth generation parameters and
+the image size, so changing any of them (or bumping CACHE_VERSION) starts a new store.
+
+    python scripts/depth_cache.py --report
+    python scripts/depth_cache.py --clear --sequence 0000
+    python scripts/depth_cache.py --clear --stale
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+CACHE_VERSION = 1
+DEFAULT_ROOT = Path(__file__).resolve().parents[1] / 'runs' / 'depth_cache'
+
+
+def cache_key(sequence, calib_arrays, params, shape):
+    """Versioned hash of everything the depth images of a sequence depend on"""
+    digest = hashlib.sha1()
+    digest.update(f'v{CACHE_VERSION}/{sequence}/{shape[0]}x{shape[1]}/'.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for array in calib_arrays:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _open_memmap(path, dtype, shape):
+    """Open the .npy memmap at path, creating it atomically if it does not exist yet"""
+    if not path.exists():
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape).flush()
+        os.replace(tmp, path)
+    return np.lib.format.open_memmap(path, mode='r+')
+
+
+class DepthCache(object):
+    """
+    Memory-mapped depth image store of one sequence.
+
+    Parameters
+    ----------
+    root : str or Path
+        Cache directory, the store goes in root/<sequence>/<key>.npy.
+    sequence : str
+        KITTI sequence, e.g. "0000".
+    n_frames : int
+        Number of frames of the sequence.
+    shape : tuple
+        (height, width) of the depth images.
+    calib_arrays : list of ndarray
+        Calibration matrices used to project the scans.
+    params : dict
+        Parameters of `generate_depth`.
+
+    """
+
+    def __init__(self, root, sequence, n_frames, shape, calib_arrays, params):
+        self.key = cache_key(sequence, calib_arrays, params, shape)
+        directory = Path(root) / sequence
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f'{self.key}.npy'
+        meta = directory / f'{self.key}.json'
+        if not meta.exists():
+            meta.write_text(json.dumps({'version': CACHE_VERSION, 'sequence': sequence, 'frames': n_frames,
+                                        'shape': list(shape), 'params': params}))
+        self.depth = _open_memmap(self.path, np.float16, (n_frames,) + tuple(shape))
+        self.filled = _open_memmap(directory / f'{self.key}.filled.npy', np.uint8, (n_frames,))
+
+    def __contains__(self, frame_index):
+        return bool(self.filled[frame_index])
+
+    def get(self, frame_index):
+        """Return the cached depth image of the frame as a read-only memmap view, None if it is not cached"""
+        if not self.filled[frame_index]:
+            return None
+        depth = self.depth[frame_index]
+        depth.flags.writeable = False
+        return depth
+
+    def put(self, frame_index, depth):
+        """Store the depth image of the frame and return its cached (float16) view"""
+        self.depth[frame_index] = depth
+        self.depth.flush()
+        # the flag is only set once the image is on disk, so a crashed run never leaves half written frames
+        self.filled[frame_index] = 1
+        self.filled.flush()
+        return self.get(frame_index)
+
+
+def entries(root=DEFAULT_ROOT, sequence=None):
+    """Metadata of all the stores in the cache, optionally of one sequence only"""
+    for meta in sorted(Path(root).glob(f'{sequence or "*"}/*.json')):
+        info = json.loads(meta.read_text())
+        store, filled = meta.with_suffix('.npy'), meta.with_suffix('.filled.npy')
+        info['key'] = meta.stem
+        info['bytes'] = sum(p.stat().st_size for p in (store, filled, meta) if p.exists())
+        info['cached'] = int(np.count_nonzero(np.load(filled, mmap_mode='r'))) if filled.exists() else 0
+        info['paths'] = [store, filled, meta]
+        yield info
+
+
+def report(root=DEFAULT_ROOT, sequence=None):
+    total = 0
+    print(f"{'sequence':>8} {'key':>16} {'version':>7} {'frames':>13} {'size [MB]':>10}  params")
+    for info in entries(root, sequence):
+        total += info['bytes']
+        stale = '' if info['version'] == CACHE_VERSION else ' (stale)'
+        print(f"{info['sequence']:>8} {info['key']:>16} {info['version']:>7} {info['cached']:>6}/{info['frames']:<6} "
+              f"{info['bytes'] / 1e6:>10.1f}  {info['params']}{stale}")
+    print(f"total {total / 1e6:.1f} MB in {root}")
+    return total
+
+
+def clear(root=DEFAULT_ROOT, sequence=None, stale=False):
+    """Delete the cached depth images, of one sequence or only the stores of older cache versions if asked"""
+    if not stale:
+        target = Path(root) / sequence if sequence else Path(root)
+        if target.exists():
+            shutil.rmtree(target)
+        return
+    for info in entries(root, sequence):
+        if info['version'] != CACHE_VERSION:
+            for path in info['paths']:
+                path.unlink(missing_ok=True)
+
+
+def main(opt):
+    if opt.clear:
+        clear(opt.root, opt.sequence, opt.stale)
+    report(opt.root, opt.sequence)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=Path, default=DEFAULT_ROOT, help='depth cache directory')
+    parser.add_argument('--sequence', type=str, default=None, help='only this sequence, e.g. 0000')
+    parser.add_argument('--report', action='store_true', help='print the size of the cache (default)')
+    parser.add_argument('--clear', action='store_true', help='delete the cached depth images')
+    parser.add_argument('--stale', action='store_true', help='with --clear, only delete older cache versions')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_opt())
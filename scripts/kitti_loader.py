@@ -9,11 +9,15 @@ import cv2
 import numpy as np
 
 import sys
+import threading
+import time
 sys.path.append("../")
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from ultralytics.yolo.data.augment import LetterBox
 import kitti_loader_utils as utils
+from depth_cache import DepthCache
 
 class KittiLoader:
     """Load KittiMOT dataset
@@ -69,6 +73,11 @@ class KittiLoader:
         auto (bool, optional): _description_. Defaults to True.
         transforms (_type_, optional): _description_. Defaults to None.
         **kwargs: depth_image: bool, if True, depth image is generated from velodyne data
+                  depth_cache: str, optional directory the generated depth images are cached in (see depth_cache.py),
+                               later runs read them back from there instead of projecting the velodyne data again
+                  prefetch: int, number of frames decoded ahead by background threads while iterating, 0 to load
+                            every frame synchronously (default)
+                  prefetch_workers: int, number of prefetch threads. Defaults to 2.
 
 """
     def __init__(self, kitii_base_path: str, sequence: str, imgsz=640, stride=32, auto=True, transforms=None, **kwargs):
@@ -83,6 +92,13 @@ class KittiLoader:
         self.stride = stride
         self.auto = auto
         self.kwargs = kwargs
+        self.depth_cache = None
+        self._depth_cache_lock = threading.Lock()
+        self.prefetch = kwargs.get("prefetch", 0)
+        self.prefetch_workers = kwargs.get("prefetch_workers", 2)
+        self._pool = None
+        self._pending = None
+        self.wait_time, self.frames_waited, self.frames_prefetched = 0., 0, 0
         # Find all the data files
         self._get_file_lists()
         self._load_calib()
@@ -223,53 +239,68 @@ class KittiLoader:
             https://github.com/noahcao/OC_SORT/blob/7a390a5f35dbbb45df6cd584588c216aea527248/tools/run_ocsort_public.py#L101
 
         """
+        rows = []
         for seq_file in self.dets_files:
             cats = ['Pedestrian', 'Car', 'Cyclist', "Van", "Truck"]
             cat_ids = {cat: i for i, cat in enumerate(cats)}
 
             print("starting seq {}".format(self.sequence))
-            seq_trks = np.empty((0, 18))
-            seq_file = open(seq_file)
-            lines = seq_file.readlines()
-            line_count = 0 
-            for line in lines:
-                # print("{}/{}".format(line_count,len(lines)))
-                line_count+=1
-                line = line.strip()
-                tmps = line.strip().split()
-                tmps[2] = cat_ids[tmps[2]]
-                trk = np.array([float(d) for d in tmps])
-                trk = np.expand_dims(trk, axis=0)
-                seq_trks = np.concatenate([seq_trks, trk], axis=0)
-        self.seq_trks = seq_trks
+            with open(seq_file) as f:
+                for line in f:
+                    tmps = line.strip().split()
+                    if not tmps:
+                        continue
+                    tmps[2] = cat_ids[tmps[2]]
+                    rows.append([float(d) for d in tmps])
+        self._index_by_frame(np.array(rows, dtype=np.float64).reshape(-1, 18))
     
     def _load_gt(self):
         """Load ground truth tracks from file."""
+        rows = []
         for seq_file in self.gt_files:
             cats = ['Pedestrian', 'Car']
             cat_ids = {cat: i for i, cat in enumerate(cats)}
 
             print("starting seq {}".format(self.sequence))
-            seq_trks = np.empty((0, 17))
-            seq_file = open(seq_file)
-            lines = seq_file.readlines()
-            line_count = 0 
-            for line in lines:
-                # print("{}/{}".format(line_count,len(lines)))
-                line_count+=1
-                line = line.strip()
-                tmps = line.strip().split()
-                if tmps[2] not in cats:
-                    continue
-                tmps[2] = cat_ids[tmps[2]]
-                trk = np.array([float(d) for d in tmps])
-                trk = np.expand_dims(trk, axis=0)
-                seq_trks = np.concatenate([seq_trks, trk], axis=0)
-        self.seq_trks = seq_trks
-
-            
+            with open(seq_file) as f:
+                for line in f:
+                    tmps = line.strip().split()
+                    if not tmps or tmps[2] not in cats:
+                        continue
+                    tmps[2] = cat_ids[tmps[2]]
+                    rows.append([float(d) for d in tmps])
+        self._index_by_frame(np.array(rows, dtype=np.float64).reshape(-1, 17))
+
+    def _index_by_frame(self, seq_trks):
+        """Sort the rows by frame (keeping the file order within a frame) and index the row range of every frame"""
+        frames = seq_trks[:, 0].astype(np.int64)
+        order = np.argsort(frames, kind='stable')
+        self.seq_trks = seq_trks[order]
+        n_frames = max(len(self), int(frames.max()) + 1 if len(frames) else 0)
+        # rows of frame f are seq_trks[frame_offsets[f]:frame_offsets[f + 1]]
+        self.frame_offsets = np.searchsorted(frames[order], np.arange(n_frames + 1))
+
+    def _frame_rows(self, frame_index):
+        """Rows of seq_trks of the frame"""
+        if not 0 <= frame_index < len(self.frame_offsets) - 1:
+            return self.seq_trks[:0]
+        return self.seq_trks[self.frame_offsets[frame_index]:self.frame_offsets[frame_index + 1]]
+
+    def _open_depth_cache(self, shape, intr_raw, params):
+        with self._depth_cache_lock:
+            if self.depth_cache is None:
+                self.depth_cache = DepthCache(self.kwargs["depth_cache"], self.sequence, len(self), shape,
+                                              [self.calib.Tr_velo_cam, intr_raw], params)
+        return self.depth_cache
+
     def __getitem__(self, frame_index):
         """Return the data from a particular frame_index."""
+        data = self._load_frame(frame_index)
+        self.extra_output = data[5]
+        return data
+
+    def _load_frame(self, frame_index):
+        """Load and preprocess the data of a frame, this runs in the prefetch threads when prefetching."""
         # Load the data from disk
         cam2_0 = cv2.imread(self.cam2_files[frame_index].strip())
 
@@ -279,9 +310,15 @@ class KittiLoader:
         upsampled_params = {"filtering": 1, "upsample": 1}
         intr_raw = np.hstack((self.calib.K_cam2, np.zeros((3, 1))))
         if self.kwargs.get("depth_image", False):
-            depthmap = utils.generate_depth(velodata=velo, M_velo2cam=self.calib.Tr_velo_cam, 
-                                            width=cam2_0.shape[1], height=cam2_0.shape[0],
-                                            intr_raw=intr_raw, params=upsampled_params)
+            if self.kwargs.get("depth_cache") is not None and self.depth_cache is None:
+                self._open_depth_cache(cam2_0.shape[:2], intr_raw, upsampled_params)
+            depthmap = self.depth_cache.get(frame_index) if self.depth_cache is not None else None
+            if depthmap is None:
+                depthmap = utils.generate_depth(velodata=velo, M_velo2cam=self.calib.Tr_velo_cam, 
+                                                width=cam2_0.shape[1], height=cam2_0.shape[0],
+                                                intr_raw=intr_raw, params=upsampled_params)
+                if self.depth_cache is not None:
+                    depthmap = self.depth_cache.put(frame_index, depthmap)
             # depthmap = depthmap / np.max(depthmap)
             # depthmap = utils.bilinear_interpolation(depthmap, width=cam2_0.shape[1], height=cam2_0.shape[0])
             # depthmap = utils.approx_depth(velodata=velo, M_velo2cam=self.calib.Tr_velo_cam,
@@ -294,7 +331,7 @@ class KittiLoader:
         if "testing" in self.base_path:
             _det_ind = list(range(6,10)) + [-2, -1]
             # Assuming that the frame index starts with 0 in detection file
-            dets = self.seq_trks[np.where(self.seq_trks[:,0]==frame_index)][:,_det_ind]
+            dets = self._frame_rows(frame_index)[:,_det_ind]
             # Apply the data transformations
             gt = None
 
@@ -302,7 +339,7 @@ class KittiLoader:
         else:
             dets = None
             _gt_ind = [1] + list(range(6,10))
-            gt_values = self.seq_trks[np.where(self.seq_trks[:,0]==frame_index)][:,_gt_ind]
+            gt_values = self._frame_rows(frame_index)[:,_gt_ind]
             gt_keys = ["id", "min_x", "min_y", "max_x", "max_y"]
             gt  = [dict(zip(gt_keys, gt_value)) for gt_value in gt_values]
 
@@ -316,26 +353,71 @@ class KittiLoader:
             cam2 = np.ascontiguousarray(cam2)  # contiguous
         
         
-        self.extra_output = {"depth_image": depthmap, "velodyne": velo, "oxt": oxt, "dets": dets, "gt": gt} #TODO: add gt
+        extra_output = {"depth_image": depthmap, "velodyne": velo, "oxt": oxt, "dets": dets, "gt": gt} #TODO: add gt
 
-        return self.base_path, cam2, [cam2_0], None, "", self.extra_output
+        return self.base_path, cam2, [cam2_0], None, "", extra_output
     
     def __iter__(self):
         """Return the iterator object."""
         self.index = 0
+        if self.prefetch > 0:
+            self._start_prefetch()
         return self
 
     def __next__(self):
         """Return the next sequence."""
         # Get the data from the next index
-        data = self.__getitem__(self.index)
+        if self._pending is not None:
+            data = self._next_prefetched()
+        else:
+            data = self.__getitem__(self.index)
 
         # Increment the index and loop if necessary
         self.index += 1
         if self.index >= len(self):
+            self._stop_prefetch()
             raise StopIteration
 
         return data
+
+    def _start_prefetch(self):
+        """Start decoding the next `prefetch` frames in the background, the frames are still returned in order"""
+        self._stop_prefetch()
+        self._pool = ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix="kitti_prefetch")
+        self._pending = deque()
+        self._next_submitted = self.index
+        self.wait_time, self.frames_waited, self.frames_prefetched = 0., 0, 0
+        self._submit_prefetch()
+
+    def _submit_prefetch(self):
+        # the last frame is never returned by __next__, so it is not loaded either
+        while len(self._pending) < self.prefetch and self._next_submitted < len(self) - 1:
+            self._pending.append(self._pool.submit(self._load_frame, self._next_submitted))
+            self._next_submitted += 1
+
+    def _next_prefetched(self):
+        if not self._pending:
+            return None
+        future = self._pending.popleft()
+        if not future.done():
+            # time the consumer sits idle waiting for the loader
+            start = time.perf_counter()
+            future.result()
+            self.wait_time += time.perf_counter() - start
+            self.frames_waited += 1
+        data = future.result()
+        self.frames_prefetched += 1
+        self.extra_output = data[5]
+        self._submit_prefetch()
+        return data
+
+    def _stop_prefetch(self):
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool, self._pending = None, None
+        print(f"prefetch: waited {self.wait_time:.2f}s on {self.frames_waited} of {self.frames_prefetched} frames "
+              f"({1E3 * self.wait_time / max(self.frames_prefetched, 1):.1f}ms per frame)")
     
     def __len__(self):
         """Return the number of frames loaded."""
@@ -76,6 +76,34 @@ def transform_from_rot_trans(R, t):
     t = t.reshape(3, 1)
     return np.vstack((np.hstack([R, t]), [0, 0, 0, 1]))
 
+def zbuffer(rows, cols, values, shape, dtype=np.float64):
+    """Image of the smallest of the values that fall in each (row, col) pixel, 0 where none does.
+    Out of bounds pixels are ignored. Like the sequential z-buffer, a 0 value resets its pixel,
+    so only the values after the last 0 of every pixel count."""
+    buffer = np.zeros(shape, dtype=dtype)
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    pixels = rows[inside] * shape[1] + cols[inside]
+    values = values[inside]
+    zeros = np.flatnonzero(values == 0)
+    if len(zeros):
+        last_zero = np.full(buffer.size, -1)
+        np.maximum.at(last_zero, pixels[zeros], zeros)
+        after = np.arange(len(pixels)) > last_zero[pixels]
+        pixels, values = pixels[after], values[after]
+    # sort by pixel then value, the first entry of every pixel is its closest point
+    order = np.lexsort((values, pixels))
+    pixels = pixels[order]
+    first = np.ones(len(pixels), dtype=bool)
+    first[1:] = pixels[1:] != pixels[:-1]
+    buffer.flat[pixels[first]] = values[order][first]
+    return buffer
+
+def _round_half_up(x):
+    """int(x + 0.5) of every element, i.e. rounded half up and truncated towards zero, -1 where x is not finite"""
+    x = x + 0.5
+    finite = np.isfinite(x)
+    return np.where(finite, np.trunc(np.where(finite, x, 0)), -1).astype(np.int64)
+
 def upsample_velodyne(velodata_cam, params):
     total_vbeams = params.get('total_vbeams', 128)
     total_hbeams = params.get('total_hbeams', 1500)
@@ -90,7 +118,6 @@ def upsample_velodyne(velodata_cam, params):
     hbeams = int(total_hbeams * hscale)
     vf = vbeam_fov / vscale
     hf = hbeam_fov / hscale
-    rmap = np.zeros((vbeams, hbeams), dtype=np.float32)
 
     # Cast to Angles
     rtp = np.zeros((velodata_cam.shape[0], 3))
@@ -98,16 +125,10 @@ def upsample_velodyne(velodata_cam, params):
     rtp[:, 1] = np.arctan2(velodata_cam[:, 0], velodata_cam[:, 2]) * (180 / np.pi)
     rtp[:, 2] = np.arcsin(velodata_cam[:, 1] / rtp[:, 0]) * (180 / np.pi) - phioffset
 
-    # Bin Data
-    for i in range(rtp.shape[0]):
-        r, theta, phi = rtp[i]
-        thetabin = int(((theta / hf) + hbeams / 2) + 0.5)
-        phibin = int(((phi / vf) + vbeams / 2) + 0.5)
-        if not (0 <= thetabin < hbeams and 0 <= phibin < vbeams):
-            continue
-        current_r = rmap[phibin, thetabin]
-        if r < current_r or current_r == 0:
-            rmap[phibin, thetabin] = r
+    # Bin Data, keeping the closest range of every bin
+    thetabin = _round_half_up((rtp[:, 1] / hf) + hbeams / 2)
+    phibin = _round_half_up((rtp[:, 2] / vf) + vbeams / 2)
+    rmap = zbuffer(phibin, thetabin, rtp[:, 0], (vbeams, hbeams), dtype=np.float32)
 
     # Upsample
     vscale = vscale * scale
@@ -119,16 +140,12 @@ def upsample_velodyne(velodata_cam, params):
     rmap = cv2.resize(rmap, (0, 0), fx=hscale, fy=vscale, interpolation=cv2.INTER_NEAREST)
 
     # Regenerate
+    phi = ((np.arange(rmap.shape[0]) - (vbeams / 2)) * vf + phioffset) * (np.pi / 180)
+    theta = ((np.arange(rmap.shape[1]) - (hbeams / 2)) * hf) * (np.pi / 180)
     xyz_new = np.ones((rmap.size, 4))
-    for phibin in range(rmap.shape[0]):
-        for thetabin in range(rmap.shape[1]):
-            i = phibin * rmap.shape[1] + thetabin
-            phi = ((phibin - (vbeams / 2)) * vf + phioffset) * (np.pi / 180)
-            theta = ((thetabin - (hbeams / 2)) * hf) * (np.pi / 180)
-            r = rmap[phibin, thetabin]
-            xyz_new[i, 0] = r * np.cos(phi) * np.sin(theta)
-            xyz_new[i, 1] = r * np.sin(phi)
-            xyz_new[i, 2] = r * np.cos(phi) * np.cos(theta)
+    xyz_new[:, 0] = (rmap * np.cos(phi)[:, None] * np.sin(theta)).ravel()
+    xyz_new[:, 1] = (rmap * np.sin(phi)[:, None]).ravel()
+    xyz_new[:, 2] = (rmap * np.cos(phi)[:, None] * np.cos(theta)).ravel()
 
     return xyz_new
 
@@ -152,38 +169,22 @@ def generate_depth(velodata, intr_raw, M_velo2cam, width, height, params):
     velodata_cam_proj[:, 0] /= velodata_cam_proj[:, 2]
     velodata_cam_proj[:, 1] /= velodata_cam_proj[:, 2]
 
-    # Z Buffer assignment
-    dmap_raw = np.zeros((height, width))
-    for i in range(velodata_cam_proj.shape[0]):
-        u, v = (int(velodata_cam_proj[i, 0] + 0.5), int(velodata_cam_proj[i, 1] + 0.5)) if not np.isnan(velodata_cam_proj[i, 0]) and not np.isnan(velodata_cam_proj[i, 1]) else (0, 0)
-        if not (0 <= u < width and 0 <= v < height):
-            continue
-        z = velodata_cam_proj[i, 2]
-        if z < dmap_raw[v, u] or dmap_raw[v, u] == 0:
-            dmap_raw[v, u] = z
-
-    # Filtering
-    dmap_cleaned = np.zeros((height, width))
+    # Z Buffer assignment, points with a nan pixel coordinate go to (0, 0)
+    u = _round_half_up(velodata_cam_proj[:, 0])
+    v = _round_half_up(velodata_cam_proj[:, 1])
+    nan_pixel = np.isnan(velodata_cam_proj[:, 0]) | np.isnan(velodata_cam_proj[:, 1])
+    u[nan_pixel] = v[nan_pixel] = 0
+    dmap_raw = zbuffer(v, u, velodata_cam_proj[:, 2], (height, width))
+
+    # Filtering, drop the pixels that have a neighbor more than 1m closer (occluded points)
     offset = filtering
-    for v in range(offset, height - offset - 1):
-        for u in range(offset, width - offset - 1):
-            z = dmap_raw[v, u]
-            bad = False
-
-            # Check neighbors
-            for vv in range(v - offset, v + offset + 1):
-                for uu in range(u - offset, u + offset + 1):
-                    if vv == v and uu == u:
-                        continue
-                    zn = dmap_raw[vv, uu]
-                    if zn == 0:
-                        continue
-                    if zn - z < -1:
-                        bad = True
-                        break
-
-            if not bad:
-                dmap_cleaned[v, u] = z
+    size = 2 * offset + 1
+    neighbors_min = cv2.erode(np.where(dmap_raw == 0, np.inf, dmap_raw), np.ones((size, size), dtype=np.uint8),
+                              borderType=cv2.BORDER_REPLICATE)
+    occluded = neighbors_min - dmap_raw < -1
+    dmap_cleaned = np.zeros((height, width))
+    inner = np.s_[offset:height - offset - 1, offset:width - offset - 1]
+    dmap_cleaned[inner] = np.where(occluded[inner], 0, dmap_raw[inner])
 
     return dmap_cleaned
 
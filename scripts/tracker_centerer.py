@@ -117,16 +117,22 @@ class track_centerizer:
 
     def track_callback(self,data):
         # print("track_callback")
-        image = data.im_data
         image_width = data.im_width
         self.image_width = image_width
         image_height = data.im_height
-        tracks_data = data.tracks_data   
-        np_image = np.array(list(image)).reshape((image_height,image_width,3))
-        np_image = np_image.astype(np.uint8)
-        self.my_image = np_image
+        #flat (x1, y1, x2, y2, track_id) list of the tracks for track_data_parser
+        tracks_data = [v for t in data.tracks for v in (t.x1, t.y1, t.x2, t.y2, t.track_id)]
         self.tracks_data.append(tracks_data)
-        self.annotated_frames.append(np_image)
+        #the frame is raw bgr8 bytes, a jpeg, or not published
+        if data.encoding == "jpeg":
+            np_image = cv2.imdecode(np.frombuffer(data.im_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        elif data.encoding:
+            np_image = np.frombuffer(data.im_data, dtype=np.uint8).reshape((image_height,image_width,3))
+        else:
+            np_image = None
+        if np_image is not None:
+            self.my_image = np_image
+            self.annotated_frames.append(np_image)
         #if the length of the annotated_frames is more than 4, just keep the last 4 frames
         if len(self.annotated_frames) > 4:
             self.annotated_frames = self.annotated_frames[-4:]
@@ -86,6 +86,8 @@ from yolov8.ultralytics.yolo.utils.plotting import Annotator, colors, save_one_b
 
 from trackers.multi_tracker_zoo import create_tracker
 from ros_classes import image_converter
+from pipeline import Pipeline
+from result_writer import RESULT_SUFFIXES, ResultWriter
 
 
 def add_noise2tensor(tensor, image_shape, noise_scale=9 / 10):
@@ -175,6 +177,13 @@ def run(
     op_mode="eval",
     use_odometry=0,
     use_depth=0,
+    realtime=False,  # ROS: track the newest synchronized frame, skipping the stale ones
+    ros_publish_image="raw",  # frame of the /image_tracks messages: raw, jpeg or none
+    pipeline=False,  # run decode, detect, track and sink in threads linked by bounded queues
+    pipeline_queue=2,  # frames queued between the pipeline stages
+    save_format="mot",  # format of the --save-txt results: mot, kitti or bin
+    prefetch=0,  # KITTI: frames decoded ahead by background threads, 0 loads them on demand
+    depth_cache=None,  # KITTI: directory the depth images generated for --use-depth are cached in
 ):
     # OP_MODE = "EVAL" #YOLO or EVAL; EVAL uses the ground truth detections
     is_ros = isinstance(source, image_converter)
@@ -193,6 +202,9 @@ def run(
     )
     if is_url and is_file:
         source = check_file(source)  # download
+    if pipeline and show_vid:
+        # cv2.imshow would run in the sink thread while LoadStreams calls cv2.waitKey in the decode thread
+        raise ValueError("--show-vid cannot be combined with --pipeline, HighGUI must stay on the main thread")
 
     # Directories
     if not isinstance(yolo_weights, list):  # single yolo model
@@ -227,7 +239,7 @@ def run(
     # Dataloader
     bs = 1
     if webcam:
-        show_vid = check_imshow(warn=True)
+        show_vid = not pipeline and check_imshow(warn=True)
         if is_ros:
             dataset = LoadStreams(
                 source_copy,
@@ -236,6 +248,7 @@ def run(
                 auto=pt,
                 transforms=getattr(model.model, "transforms", None),
                 vid_stride=vid_stride,
+                realtime=realtime,
             )
         else:
             dataset = LoadStreams(
@@ -255,7 +268,9 @@ def run(
             stride=stride,
             auto=pt,
             transforms=getattr(model.model, "transforms", None),
-            depth_image=False,
+            depth_image=bool(use_depth),
+            prefetch=prefetch,
+            depth_cache=depth_cache,
         )
     else:
         dataset = LoadImages(
@@ -269,6 +284,8 @@ def run(
     vid_path, vid_writer, txt_path = [None] * bs, [None] * bs, [None] * bs
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
 
+    # name of the sequence in the tracker caches, the MOT sequences keep their frames in <sequence>/img1
+    sequence = Path(source).parent.name if Path(source).name == "img1" else Path(source).stem
     # Create as many strong sort instances as there are video sources
     tracker_list = []
     for i in range(bs):
@@ -280,6 +297,9 @@ def run(
             half,
             use_depth=use_depth,
             use_odometry=use_odometry,
+            # the streams are live, their frames are never run again and the caches stay in memory
+            sequence="live" if webcam else sequence,
+            cache=not webcam,
         )
         tracker_list.append(
             tracker,
@@ -293,7 +313,19 @@ def run(
     # model.warmup(imgsz=(1 if pt else bs, 3, *imgsz))  # warmup
     seen, windows, dt = 0, [], (Profile(), Profile(), Profile(), Profile())
     curr_frames, prev_frames = [None] * bs, [None] * bs
-    for frame_idx, batch in enumerate(dataset):
+    last = {}  # frame_idx and im0 of the last frame written by the sink
+
+    # one buffered writer per result file of the sequence, the rows are appended in blocks
+    txt_path = str(project / text_file_name / text_file_name)  # im.txt
+    gt_path = str(save_dir / "gt")
+    os.makedirs(gt_path, exist_ok=True)
+    gt_writer = ResultWriter(gt_path + "/gt.txt", fmt="gt")
+    txt_writer = ResultWriter(txt_path + RESULT_SUFFIXES[save_format], fmt=save_format, names=names) if save_txt else None
+
+    def detect(item):
+        # preprocessing, inference and NMS of a batch, the boxes are scaled to the frames
+        frame_idx, batch = item
+        extra_output = None
         # if is ros node
         if is_ros or "kitti" in source:
             path, im, im0s, vid_cap, s, extra_output = batch
@@ -301,7 +333,7 @@ def run(
         else:
             path, im, im0s, vid_cap, s = batch
 
-        visualize = (
+        visualize_path = (
             increment_path(save_dir / Path(path[0]).stem, mkdir=True)
             if visualize
             else False
@@ -315,20 +347,11 @@ def run(
 
         # Inference
         with dt[1]:
-            time1 = round(time.time() * 1000)
-            # print(im.shape)
-            # create a pytorch random tensor with size of 1,3,192,320
-            my_tensor = torch.rand(1, 3, 192, 320, device=device)
-            # change my_tensor to im
-            # resize im to 192,320
-            # im = torch.nn.functional.interpolate(im, size=(192, 320), mode='bilinear', align_corners=False)
-            preds = model(im, augment=augment, visualize=visualize)
-            time2 = round(time.time() * 1000)
-            # print("inference time", time2 - time1)
+            preds = model(im, augment=augment, visualize=visualize_path)
         # Apply NMS
+        masks = []
         with dt[2]:
             if is_seg:
-                masks = []
                 nms_dets_list = non_max_suppression(
                     preds[0],
                     conf_thres,
@@ -344,12 +367,10 @@ def run(
                     preds, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det
                 )
 
-        # mkdir save_path = str(save_dir / txt_file_name /
-        # if not os.path.exists(str(project)):
-        #     os.mkdir(str(project))
         # Process detections
+        images = []
         for i, det in enumerate(nms_dets_list):  # detections per image
-            seen += 1
+            save_path = None
             if webcam or "kitti" in source:  # bs >= 1
                 p, im0 = path[i], im0s[i].copy()
                 if not is_ros:
@@ -372,23 +393,7 @@ def run(
                         p.parent.name
                     )  # get folder name containing current img
                     save_path = str(save_dir / p.parent.name)  # im.jpg, vid.mp4, ...
-            curr_frames[i] = im0
-            # if not is_ros:
-            txt_path = str(project / text_file_name / text_file_name)  # im.txt
             s += "%gx%g " % im.shape[2:]  # print string
-            imc = im0.copy() if save_crop else im0  # for save_crop
-
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
-
-            if hasattr(tracker_list[i], "tracker") and hasattr(
-                tracker_list[i].tracker, "camera_update"
-            ):
-                if (
-                    prev_frames[i] is not None and curr_frames[i] is not None
-                ):  # camera motion compensation
-                    tracker_list[i].tracker.camera_update(
-                        prev_frames[i], curr_frames[i]
-                    )
 
             if det is not None and len(det):
                 if is_seg:
@@ -425,29 +430,53 @@ def run(
                 for c in det[:, 5].unique():
                     n = (det[:, 5] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
+            images.append(
+                dict(p=p, im0=im0, det=det, txt_file_name=txt_file_name, save_path=save_path)
+            )
+        return dict(
+            frame_idx=frame_idx,
+            path=path,
+            im=im,
+            vid_cap=vid_cap,
+            s=s,
+            extra_output=extra_output,
+            masks=masks,
+            images=images,
+        )
+
+    def track(frame):
+        # tracker updates of the images of a frame, every tracker sees its frames in order
+        nonlocal seen
+        extra_output = frame["extra_output"]
+        if op_mode == "eval":
+            # the draw of the former inference step, kept so that the global RNG gives add_noise2tensor the same
+            # noise as before, drawn here in frame order so that the pipelined mode gets the same noise too
+            torch.rand(1, 3, 192, 320, device=device)
+        for i, image in enumerate(frame["images"]):
+            seen += 1
+            im0, det = image["im0"], image["det"]
+            curr_frames[i] = im0
+
+            if hasattr(tracker_list[i], "tracker") and hasattr(
+                tracker_list[i].tracker, "camera_update"
+            ):
+                if (
+                    prev_frames[i] is not None and curr_frames[i] is not None
+                ):  # camera motion compensation
+                    tracker_list[i].tracker.camera_update(
+                        prev_frames[i], curr_frames[i]
+                    )
 
                 # pass detections to strongsort
             with dt[3]:
-                # #if is ros node and reset_simulation_signal is true reset simulation
-                # if is_ros and extra_output["reset_signal"]:
-                #     print("reset simulation*********************")
-                #     tracker_list = []
-                #     for i in range(bs):
-                #         tracker = create_tracker(tracking_method, tracking_config, reid_weights, device, half)
-                #         tracker_list.append(tracker, )
-                #         if hasattr(tracker_list[i], 'model'):
-                #             if hasattr(tracker_list[i].model, 'warmup'):
-                #                 tracker_list[i].model.warmup()
-                #     outputs = [None] * bs
                 depth_image = extra_output["depth_image"]
+                odom = None
                 if "odom" in extra_output.keys() and extra_output["odom"] is not None:
                     odom = extra_output["odom"]
                 modified_gt_list = None
+                modified_annotation_gt_list = []  # for the generation of the ground truth
                 if extra_output["gt"] is not None:
                     modified_gt_list = []
-                    modified_annotation_gt_list = (
-                        []
-                    )  # for the generation of the ground truth
                     gt_list = extra_output["gt"]
                     for gt in gt_list:
                         gt_vals = list(gt.values())
@@ -493,7 +522,9 @@ def run(
                     else:
                         modified_gt_list = torch.empty((0, 6))
                 outputs[i] = None
-                track_pred_tlwhs = None
+                if is_ros and hasattr(tracker_list[i], "frame_step"):
+                    # keeps the ego-motion rates of update_time consistent across the skipped frames
+                    tracker_list[i].frame_step = extra_output["skipped_frames"] + 1
                 if (
                     hasattr(tracker_list[i], "use_depth")
                     and hasattr(tracker_list[i], "use_odometry")
@@ -522,22 +553,27 @@ def run(
                         outputs[i] = tracker_list[i].update(det.cpu(), im0)
                     elif op_mode == "eval":
                         outputs[i] = tracker_list[i].update(modified_gt_list, im0)
-            #     track_pred_tlwhs = tracker_list[i].get_all_track_predictions()
-
-            #         #what is each det element? [x1, y1, x2, y2, conf, cls, cls_conf]
-            #         # outputs[i] =  tracker_list[i].update(det.cpu(), im0)
+            image["outputs"] = outputs[i]
+            image["gt"] = modified_annotation_gt_list
+            prev_frames[i] = curr_frames[i]
+        return frame
+
+    def sink(frame):
+        # drawing, writing, publishing and display of the tracks of a frame
+        frame_idx, path, im = frame["frame_idx"], frame["path"], frame["im"]
+        vid_cap, extra_output, masks = frame["vid_cap"], frame["extra_output"], frame["masks"]
+        for i, image in enumerate(frame["images"]):
+            p, det, txt_file_name = image["p"], image["det"], image["txt_file_name"]
+            save_path, tracks = image["save_path"], image["outputs"]
+            # the sink draws on its own copy, the track stage keeps the unannotated frame for the camera motion
+            im0 = image["im0"].copy()
+            imc = im0.copy() if save_crop else im0  # for save_crop
 
-            # for track_pred in track_pred_tlwhs:
-            #     xyxy = ops.xywh2xyxy(track_pred[0:4])
-            #     track_id = track_pred[4]
-            #     #if xyxy is out of the image or if any of them is nan, do not draw it
-            #     if xyxy[0] < 0 or xyxy[1] < 0 or xyxy[2] > im0.shape[1] or xyxy[3] > im0.shape[0] or np.isnan(xyxy).any():
-            #         continue
-            # annotator.box_label(xyxy, str(track_id), color=(255, 0, 0))
+            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
 
             if det is not None and len(det):
                 # draw boxes for visualization
-                if len(outputs[i]) > 0:
+                if len(tracks) > 0:
                     if is_seg:
                         # Mask plotting
                         annotator.masks(
@@ -553,34 +589,10 @@ def run(
                             else im[i],
                         )
 
-            save_gt = True
-            gt_path = str(save_dir / "gt")  # im.txt
-            # if gt_path does not exist, create it
-            if not os.path.exists(gt_path):
-                os.makedirs(gt_path)
-            if save_gt and len(modified_annotation_gt_list) > 0:
-                for gt in modified_annotation_gt_list:
-                    this_frame_idx = frame_idx
-                    this_id = gt[0]
-                    this_x = gt[1]
-                    this_y = gt[2]
-                    this_w = gt[3] - gt[1]
-                    this_h = gt[4] - gt[2]
-                    this_msg = [
-                        this_frame_idx + 1,
-                        this_id,
-                        this_x,
-                        this_y,
-                        this_w,
-                        this_h,
-                        1,
-                        1,
-                        1,
-                    ]
-                    with open(gt_path + "/gt.txt", "a") as f:
-                        f.write(("%g " * 9 + "\n") % tuple(this_msg))
-
-            for j, (output) in enumerate(outputs[i]):
+            for gt in image["gt"]:
+                gt_writer.write(frame_idx, gt[0], gt[1], gt[2], gt[3] - gt[1], gt[4] - gt[2])
+
+            for j, (output) in enumerate(tracks):
                 bbox = output[0:4]
                 id = output[4]
                 cls = output[5]
@@ -596,28 +608,10 @@ def run(
                     depth = -1
 
                 if save_txt:
-                    # to MOT format
-                    bbox_left = output[0]
-                    bbox_top = output[1]
-                    bbox_w = output[2] - output[0]
-                    bbox_h = output[3] - output[1]
-                    # Write MOT compliant results to file
-                    with open(txt_path + ".txt", "a") as f:
-                        f.write(
-                            ("%g " * 10 + "\n")
-                            % (
-                                frame_idx + 1,
-                                id,
-                                bbox_left,  # MOT format
-                                bbox_top,
-                                bbox_w,
-                                bbox_h,
-                                -1,
-                                -1,
-                                -1,
-                                i,
-                            )
-                        )
+                    # w and h in the dtype of the tracker outputs, as the MOT files always had them
+                    txt_writer.write(
+                        frame_idx, id, output[0], output[1], output[2] - output[0], output[3] - output[1], conf, cls, i
+                    )
 
                 if save_vid or save_crop or show_vid:  # Add bbox/seg to image
                     c = int(cls)  # integer class
@@ -689,31 +683,9 @@ def run(
             if (
                 ros_package == "1"
             ):  # it means that the image_detection message type is being generated and published
-                from my_tracker.msg import ImageDetectionMessage
-
-                im0_flatten = im0.flatten().tolist()
-                im0_height = im0.shape[0]
-                im0_width = im0.shape[1]
-                image_detection_message = ImageDetectionMessage()
-                image_detection_message.im_width = im0_width
-                image_detection_message.im_height = im0_height
-                image_detection_message.im_data = im0_flatten
-                if outputs[0] is not None and len(outputs[0]) > 0:
-                    outputs[0] = np.array(outputs[0])
-                    tracks_object_bbs = outputs[0][
-                        :, :5
-                    ]  # track_id_size x (x1, y1, x2, y2, track_id)
-                    tracks_flatten = tracks_object_bbs.flatten().tolist()
-                    tracks_height = tracks_object_bbs.shape[0]
-                    tracks_width = tracks_object_bbs.shape[1]
-                    image_detection_message.tracks_width = tracks_width
-                    image_detection_message.tracks_height = tracks_height
-                    image_detection_message.tracks_data = tracks_flatten
-                else:
-                    image_detection_message.tracks_width = 0
-                    image_detection_message.tracks_height = 0
-                    image_detection_message.tracks_data = []
-                source_copy.track_publisher.publish(image_detection_message)
+                source_copy.publish_tracks(
+                    im0, frame["images"][0]["outputs"], extra_output.get("stamp"), ros_publish_image
+                )
             if show_vid:
                 if platform.system() == "Linux" and p not in windows:
                     windows.append(p)
@@ -748,10 +720,34 @@ def run(
                     )
                 vid_writer[i].write(im0)
 
-            prev_frames[i] = curr_frames[i]
+            last["frame_idx"], last["im0"] = frame_idx, im0
 
-        # Print total time (preprocessing + inference + NMS + tracking)
-        # LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{sum([dt.dt for dt in dt if hasattr(dt, 'dt')]) * 1E3:.1f}ms")
+    try:
+        if pipeline:
+            # decode -> detect -> track -> sink in threads linked by bounded queues
+            stages = Pipeline(
+                enumerate(dataset),
+                [("detect", detect), ("track", track), ("sink", sink)],
+                maxsize=pipeline_queue,
+            )
+            stages.run()
+            LOGGER.info(f"Pipeline: {stages.summary()}")
+        else:
+            for item in enumerate(dataset):
+                sink(track(detect(item)))
+
+            # Print total time (preprocessing + inference + NMS + tracking)
+            # LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{sum([dt.dt for dt in dt if hasattr(dt, 'dt')]) * 1E3:.1f}ms")
+    finally:
+        # the buffered rows of a crashed run are written too
+        gt_writer.close()
+        if txt_writer is not None:
+            txt_writer.close()
+        for i, tracker in enumerate(tracker_list):
+            if hasattr(tracker, "dump_cache"):
+                tracker.dump_cache()
+                LOGGER.info(f"Tracker caches {i}: {tracker.cache_summary()}")
+    frame_idx, im0 = last["frame_idx"], last["im0"]
 
     # Print results
     # t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
@@ -759,6 +755,11 @@ def run(
     # if save_txt or save_vid:
     #     s = f"\n{len(list((save_dir / 'tracks').glob('*.txt')))} tracks saved to {save_dir / 'tracks'}" if save_txt else ''
     #     LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
+    if is_ros:
+        LOGGER.info(f"ROS sync: {source_copy.synchronizer.summary()}; {dataset.skipped_frames} frames skipped")
+    for i, tracker in enumerate(tracker_list):
+        if getattr(tracker, "reid_scheduler", None) is not None:
+            LOGGER.info(f"Appearance on demand {i}: {tracker.reid_scheduler.summary()}")
     if update:
         strip_optimizer(yolo_weights)  # update model (to fix SourceChangeWarning)
 
@@ -772,6 +773,10 @@ def run(
         file.write("imHeight=" + str(im0.shape[0]) + "\n")
         file.write("imExt=.jpg\n")
 
+    if save_format != "mot":
+        LOGGER.info(f"Results saved to {save_dir}, only the mot format is evaluated")
+        return
+
     # /home/rosen/TrackEval/scripts/run_mot_challenge.py
     p = subprocess.Popen(
         args=[
@@ -950,6 +955,64 @@ def parse_opt():
         default=0,
         help="use emap (odometry module) for tracking",
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="run decode, detect, track and sink (drawing, writing) as stages in their own threads",
+    )
+    parser.add_argument(
+        "--pipeline-queue",
+        type=int,
+        default=2,
+        help="frames queued between the pipeline stages, 1 keeps the --realtime latency lowest",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="KITTI frames decoded ahead by background threads, 0 loads every frame on demand",
+    )
+    parser.add_argument(
+        "--depth-cache",
+        type=str,
+        default=None,
+        help="KITTI directory the depth images generated for --use-depth are cached in, reused by the next runs",
+    )
+    parser.add_argument(
+        "--save-format",
+        type=str,
+        default="mot",
+        choices=["mot", "kitti", "bin"],
+        help="format of the --save-txt results, bin is a binary columnar file read by result_writer.read_results",
+    )
+    parser.add_argument(
+        "--ros-publish-image",
+        type=str,
+        default="raw",
+        choices=["raw", "jpeg", "none"],
+        help="frame published with the tracks on /image_tracks: raw bgr8 bytes, jpeg or none for the tracks only",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="ROS: track the newest synchronized frame and skip the stale ones",
+    )
+    parser.add_argument(
+        "--sync-slop",
+        type=float,
+        default=0.05,
+        help="max stamp difference in seconds of the paired ROS color, depth, odometry and gt messages",
+    )
+    parser.add_argument(
+        "--sync-buffer", type=int, default=30, help="ROS messages buffered per topic"
+    )
+    parser.add_argument(
+        "--sync-policy",
+        type=str,
+        default="oldest",
+        choices=["oldest", "newest", "reject"],
+        help="ROS message dropped from a full buffer, the oldest or newest buffered or the incoming one",
+    )
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     opt.tracking_config = (
@@ -963,8 +1026,8 @@ def parse_opt():
     return opt
 
 
-def ros_init(is_ros_package=0):
-    ic = image_converter(is_ros_package)
+def ros_init(is_ros_package=0, sync_slop=0.05, sync_buffer=30, sync_policy="oldest"):
+    ic = image_converter(is_ros_package, sync_slop, sync_buffer, sync_policy)
     rospy.init_node("image_converter", anonymous=True)
     return ic
     # try:
@@ -983,7 +1046,8 @@ def main(opt):
     check_requirements(
         requirements=ROOT / "requirements.txt", exclude=("tensorboard", "thop")
     )
-    ic = ros_init(int(opt.ros_package))
+    sync = {k: vars(opt).pop(k) for k in ("sync_slop", "sync_buffer", "sync_policy")}
+    ic = ros_init(int(opt.ros_package), **sync)
     # opt.source = ic
     run(**vars(opt))
 
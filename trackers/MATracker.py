@@ -3,6 +3,8 @@ from collections import deque
 import numpy as np
 import copy
 
+from .depth import DepthSampler
+
 
 class MATracker (ABC):
 
@@ -11,19 +13,21 @@ class MATracker (ABC):
         self.use_depth = use_depth
         self.use_odometry = use_odometry
         self.fps = None
+        self.frame_step = 1 #camera frames since the last update, more than 1 when a real-time loader skipped stale frames
 
 
     def update_time(self, odom, frame_count):
+        #without odometry stamps the nominal frame rates are spread over the skipped frames
         if type(odom) is dict and odom["header"] == "kitti":
-            self.fps = 9.6
+            self.fps = 9.6 / self.frame_step
             return
         if odom is None:
-            self.fps = 25
+            self.fps = 25 / self.frame_step
             return
         current_time = odom.header.stamp.to_time()
         time_now = current_time
         if time_now - self.last_time_stamp == 0:
-            self.fps = 25
+            self.fps = 25 / self.frame_step
             print(f"odom header time stamp at {frame_count} is the same as the lasts time stamp")
         else:
             self.fps =  (1.0/(time_now - self.last_time_stamp))*1
@@ -40,38 +44,39 @@ class MATrack (ABC):
     yaw_dot_list = deque(maxlen=2)
     
 
+    # samples the depth of the track boxes in each depth frame, see DepthSampler for the reducers
+    depth_sampler = DepthSampler()
+
     def get_d1(self):
         #calculate the depth of the object in the depth image
-        #get the bounding box of the object in the depth image
-        #get the median of the depth values in the bounding box excluding the zeros and the nans
+        #get the robust depth of the valid (non zero and non nan) depth values in the bounding box
         #return the depth value
-        bounding_box = copy.deepcopy(self.get_tlwh())
-        #get the depth of the bounding box in the depth image
-        #clip the bounding box to the image size and remove the negative values
-        bounding_box[bounding_box < 0] = 0
-        bounding_box[np.isnan(bounding_box)] = 0
-        #if any of the bounding values is inf then set it to zero
-        # bounding_box[np.isinf(bounding_box)] = 0
-        track_depth = copy.deepcopy(MATrack.current_depth_image)[int(bounding_box[1]):int(bounding_box[1]+bounding_box[3]), int(bounding_box[0]):int(bounding_box[0]+bounding_box[2])]
-        #get the median of the depth values in the bounding box excluding the zeros and the nans
-        track_depth = track_depth[track_depth != 0]
-        track_depth = track_depth[~np.isnan(track_depth)]
-        if len(track_depth) == 0:
-            return 0
-        self.bb_depth = np.median(track_depth)
-        if self.bb_depth < 0:
+        return MATrack.multi_get_d1([self])[0]
+
+    @staticmethod
+    def multi_get_d1(tracks):
+        """Sample the depths of all the tracks in one batched call, 0 for the tracks without valid depth"""
+        if len(tracks) == 0:
+            return np.zeros(0)
+        depths = MATrack.depth_sampler.sample(np.asarray([t.get_tlwh() for t in tracks]), tracks)
+        if np.any(depths < 0):
             raise Exception("bb_depth is negative")
-        return self.bb_depth
+        for track, depth in zip(tracks, depths):
+            if depth != 0:
+                track.bb_depth = depth
+        return depths
 
     def update_depth_image(depth_image):
         if type(depth_image) is dict and depth_image["header"] == "kitti":
             this_depth_image = depth_image["depth_image"]
             MATrack.current_depth_image = this_depth_image
+            MATrack.depth_sampler.update(this_depth_image)
             return
         #convert depth image type to float32
         depth_image = depth_image.astype(np.float32)
         depth_image/=10
         MATrack.current_depth_image = depth_image
+        MATrack.depth_sampler.update(depth_image)
 
     def update_ego_motion(odom, fps_rot):
         #if odom is a dictionary and odom["header"] is "kitti" then
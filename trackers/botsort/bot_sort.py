@@ -15,6 +15,7 @@ from trackers.botsort.gmc import GMC
 from trackers.botsort.basetrack import BaseTrack, TrackState
 from trackers.botsort.kalman_filter import KalmanFilter
 from ..MATracker import MATracker, MATrack
+from ..reid_scheduler import ReIDScheduler
 
 
 # from fast_reid.fast_reid_interfece import FastReIDInterface
@@ -51,6 +52,8 @@ class STrack(BaseTrack, MATrack):
 
         self.smooth_feat = None
         self.curr_feat = None
+        self.emb_proxy = False  # curr_feat is the embedding of the track the detection overlaps, see ReIDScheduler
+        self.emb_frame = 0  # frame of the last embedding of the track
         if feat is not None:
             self.update_features(feat)
         self.features = deque([], maxlen=feat_history)
@@ -110,7 +113,7 @@ class STrack(BaseTrack, MATrack):
                     multi_mean[i][6] = 0
                     multi_mean[i][7] = 0
             if hasattr(STrack, 'current_D_dot'):
-                control_input = np.array([[STrack.current_yaw_dot, STrack.current_D_dot, st.get_d1() ]for st in stracks])
+                control_input = np.c_[np.full((len(stracks), 2), [STrack.current_yaw_dot, STrack.current_D_dot]), STrack.multi_get_d1(stracks)]
             else:
                 control_input = None
             multi_mean, multi_covariance = STrack.shared_kalman.multi_predict(multi_mean, multi_covariance, control_input)
@@ -150,12 +153,14 @@ class STrack(BaseTrack, MATrack):
             self.is_activated = True
         self.frame_id = frame_id
         self.start_frame = frame_id
+        self.emb_frame = frame_id
 
     def re_activate(self, new_track, frame_id, new_id=False):
 
         self.mean, self.covariance = self.kalman_filter.update(self.mean, self.covariance, self.tlwh_to_xywh(new_track.tlwh))
-        if new_track.curr_feat is not None:
+        if new_track.curr_feat is not None and not new_track.emb_proxy:
             self.update_features(new_track.curr_feat)
+            self.emb_frame = frame_id
         self.tracklet_len = 0
         self.state = TrackState.Tracked
         self.is_activated = True
@@ -181,8 +186,9 @@ class STrack(BaseTrack, MATrack):
 
         self.mean, self.covariance = self.kalman_filter.update(self.mean, self.covariance, self.tlwh_to_xywh(new_tlwh))
 
-        if new_track.curr_feat is not None:
+        if new_track.curr_feat is not None and not new_track.emb_proxy:
             self.update_features(new_track.curr_feat)
+            self.emb_frame = frame_id
 
         self.state = TrackState.Tracked
         self.is_activated = True
@@ -272,7 +278,9 @@ class BoTSORT(MATracker):
                 frame_rate=30,
                 lambda_=0.985,
                 use_depth=True,
-                use_odometry=True
+                use_odometry=True,
+                appearance_on_demand=False,
+                emb_refresh_stride=5
                 ):
         super().__init__(use_depth, use_odometry)
         self.tracked_stracks = []  # type: list[STrack]
@@ -298,6 +306,11 @@ class BoTSORT(MATracker):
         self.match_thresh = match_thresh
 
         self.model = ReIDDetectMultiBackend(weights=model_weights, device=device, fp16=fp16)
+        # only the detections the IoU association can not tell apart are embedded, the candidates of a track are
+        # the detections within the proximity gate of the appearance distances
+        self.reid_scheduler = ReIDScheduler(
+            iou_threshold=1 - proximity_thresh, refresh_stride=emb_refresh_stride
+        ) if appearance_on_demand else None
 
         self.gmc = GMC(method=cmc_method, verbose=[None,False])
 
@@ -359,17 +372,6 @@ class BoTSORT(MATracker):
 
         self.height, self.width = img.shape[:2]
 
-        '''Extract embeddings '''
-        features_keep = self._get_features(dets, img)
-
-        if len(dets) > 0:
-            '''Detections'''
-            
-            detections = [STrack(xyxy, s, c, f.cpu().numpy()) for
-                              (xyxy, s, c, f) in zip(dets, scores_keep, classes_keep, features_keep)]
-        else:
-            detections = []
-
         ''' Add newly detected tracklets to tracked_stracks'''
         unconfirmed = []
         tracked_stracks = []  # type: list[STrack]
@@ -390,6 +392,13 @@ class BoTSORT(MATracker):
         STrack.multi_gmc(strack_pool, warp)
         STrack.multi_gmc(unconfirmed, warp)
 
+        '''Extract embeddings '''
+        if len(dets) > 0:
+            '''Detections'''
+            detections = self._get_detections(dets, scores_keep, classes_keep, img, strack_pool + unconfirmed)
+        else:
+            detections = []
+
         # Associate with high score detection boxes
         raw_emb_dists = matching.embedding_distance(strack_pool, detections)
         dists = matching.fuse_motion(self.kalman_filter, raw_emb_dists, strack_pool, detections, only_position=False, lambda_=self.lambda_)
@@ -426,6 +435,10 @@ class BoTSORT(MATracker):
                 track.re_activate(det, self.frame_id, new_id=False)
                 refind_stracks.append(track)
 
+        if self.reid_scheduler is not None:
+            # the unmatched detections may start tracks, they need embeddings of their own
+            self._embed_proxies(dets, detections, u_detection, img)
+
         ''' Step 3: Second association, with low score detection boxes'''
         # if len(scores):
         #     inds_high = scores < self.track_high_thresh
@@ -547,14 +560,42 @@ class BoTSORT(MATracker):
         y2 = min(int(y + h / 2), self.height - 1)
         return x1, y1, x2, y2
 
+    def _get_detections(self, dets, scores, classes, img, stracks):
+        if self.reid_scheduler is None:
+            features = self._get_features(dets, img)
+            return [STrack(xyxy, s, c, f.cpu().numpy()) for
+                    (xyxy, s, c, f) in zip(dets, scores, classes, features)]
+        # appearance on demand, the detections matched by IoU alone borrow the embedding of their track
+        detections = [STrack(xyxy, s, c) for (xyxy, s, c) in zip(dets, scores, classes)]
+        ious = matching.ious([det.tlbr for det in detections], [track.tlbr for track in stracks])
+        stale = self.reid_scheduler.is_stale([self.frame_id - track.emb_frame for track in stracks])
+        lost = [track.state == TrackState.Lost for track in stracks]
+        embed, proxy = self.reid_scheduler.select(ious, stale, lost)
+        if embed.any():
+            features = self._get_features(dets[embed], img)
+            for det, f in zip(np.flatnonzero(embed), features):
+                detections[det] = STrack(dets[det], scores[det], classes[det], f.cpu().numpy())
+        for det, track in enumerate(proxy):
+            if track >= 0:
+                detections[det].curr_feat = stracks[track].smooth_feat
+                detections[det].emb_proxy = True
+        return detections
+
+    def _embed_proxies(self, dets, detections, indices, img):
+        proxies = [i for i in indices if detections[i].emb_proxy]
+        if not proxies:
+            return
+        features = self._get_features(dets[proxies], img)
+        for i, f in zip(proxies, features):
+            det = detections[i]
+            detections[i] = STrack(dets[i], det.score, det.cls, f.cpu().numpy())
+        self.reid_scheduler.add_embedded(len(proxies))
+
     def _get_features(self, bbox_xywh, ori_img):
-        im_crops = []
-        for box in bbox_xywh:
-            x1, y1, x2, y2 = self._xywh_to_xyxy(box)
-            im = ori_img[y1:y2, x1:x2]
-            im_crops.append(im)
-        if im_crops:
-            features = self.model(im_crops)
+        # the crops are cut, resized and normalized from the frame in one batch
+        boxes = [self._xywh_to_xyxy(box) for box in bbox_xywh]
+        if boxes:
+            features = self.model(ori_img, boxes)
         else:
             features = np.array([])
         return features
@@ -3,6 +3,7 @@ import scipy
 import lap
 from scipy.spatial.distance import cdist
 
+from trackers.iou_kernels import box_iou
 from trackers.botsort import kalman_filter
 
 
@@ -62,7 +63,8 @@ def ious(atlbrs, btlbrs):
 
     ious = bbox_ious(
         np.ascontiguousarray(atlbrs, dtype=np.float32),
-        np.ascontiguousarray(btlbrs, dtype=np.float32)
+        np.ascontiguousarray(btlbrs, dtype=np.float32),
+        out=ious
     )
 
     return ious
@@ -195,40 +197,15 @@ def fuse_score(cost_matrix, detections):
     fuse_cost = 1 - fuse_sim
     return fuse_cost
 
-def bbox_ious(boxes, query_boxes):
+def bbox_ious(boxes, query_boxes, out=None):
     """
     Parameters
     ----------
     boxes: (N, 4) ndarray of float
     query_boxes: (K, 4) ndarray of float
+    out: optional preallocated (N, K) ndarray of float32
     Returns
     -------
     overlaps: (N, K) ndarray of overlap between boxes and query_boxes
     """
-    N = boxes.shape[0]
-    K = query_boxes.shape[0]
-    overlaps = np.zeros((N, K), dtype=np.float32)
-    
-    for k in range(K):
-        box_area = (
-            (query_boxes[k, 2] - query_boxes[k, 0] + 1) *
-            (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        )
-        for n in range(N):
-            iw = (
-                min(boxes[n, 2], query_boxes[k, 2]) -
-                max(boxes[n, 0], query_boxes[k, 0]) + 1
-            )
-            if iw > 0:
-                ih = (
-                    min(boxes[n, 3], query_boxes[k, 3]) -
-                    max(boxes[n, 1], query_boxes[k, 1]) + 1
-                )
-                if ih > 0:
-                    ua = float(
-                        (boxes[n, 2] - boxes[n, 0] + 1) *
-                        (boxes[n, 3] - boxes[n, 1] + 1) +
-                        box_area - iw * ih
-                    )
-                    overlaps[n, k] = iw * ih / ua
-    return overlaps
\ No newline at end of file
+    return box_iou(boxes, query_boxes, out=out, offset=1.)
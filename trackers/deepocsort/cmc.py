@@ -1,26 +1,51 @@
 import pdb
-import pickle
 import os
 
 import cv2
 import numpy as np
 
+from trackers.frame_cache import FrameCache
+
+
+def box_mask(shape, bbox):
+    """Mask of the frame that is 0 inside the rounded boxes and 1 elsewhere"""
+    mask = np.ones(shape[:2], dtype=np.uint8)
+    if bbox.shape[0] > 0:
+        bbox = np.round(bbox).astype(np.int32)
+        bbox[bbox < 0] = 0
+        for bb in bbox:
+            mask[bb[1] : bb[3], bb[0] : bb[2]] = 0
+    return mask
+
 
 class CMCComputer:
-    def __init__(self, minimum_features=10, method="sparse"):
+    """
+    Camera motion compensation between consecutive frames.
+
+    The sparse method tracks up to max_corners corners of the background with pyramidal
+    Lucas-Kanade optical flow on frames shrunk by downscale, like the GMC of BoT-SORT. A
+    downscaled frame already is a level of the full resolution pyramid, so the levels it
+    stands for are dropped from the max_level of the flow, which keeps the search range in
+    full resolution pixels. See scripts/benchmark_cmc.py for the accuracy and latency.
+    """
+
+    def __init__(self, minimum_features=10, method="sparse", downscale=2, max_corners=1000,
+                 win_size=(21, 21), max_level=3, cache_path="./cache/affine_ocsort.cache"):
         assert method in ["file", "sparse", "sift"]
 
-        os.makedirs("./cache", exist_ok=True)
-        self.cache_path = "./cache/affine_ocsort.pkl"
-        self.cache = {}
-        if os.path.exists(self.cache_path):
-            with open(self.cache_path, "rb") as fp:
-                self.cache = pickle.load(fp)
+        self.cache = FrameCache(cache_path)
+        # digest of the frames seen so far, the affine of a frame depends on the previous ones
+        self.history = ""
+        # frame served from the cache, the flow state of the next computed frame starts from it
+        self.pending = None
+        self.method = method
         self.minimum_features = minimum_features
+        self.downscale = max(1, int(downscale))
         self.prev_img = None
         self.prev_desc = None
+        self.lk_param = dict(winSize=tuple(win_size), maxLevel=max(0, max_level - int(np.log2(self.downscale))))
         self.sparse_flow_param = dict(
-            maxCorners=3000,
+            maxCorners=max_corners,
             qualityLevel=0.01,
             minDistance=1,
             blockSize=3,
@@ -64,22 +89,37 @@ class CMCComputer:
                 self.file_names[tag] = f_name
 
     def compute_affine(self, img, bbox, tag):
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        if tag in self.cache:
-            A = self.cache[tag]
+        """
+        Affine from the previous frame to img, tag "<sequence>:<frame>" names the frame. The
+        results are cached by the content of the frames of the sequence up to img, their boxes
+        and the CMC settings.
+        """
+        self.history = self.cache.digest(img, bbox, prev=self.history)
+        key = f"{tag}:{self.method}:{self.downscale}:{self.sparse_flow_param['maxCorners']}:{self.history}"
+        A = self.cache.get(key)
+        if A is not None:
+            self.pending = (img, bbox, tag)
             return A
-        mask = np.ones_like(img, dtype=np.uint8)
-        if bbox.shape[0] > 0:
-            bbox = np.round(bbox).astype(np.int32)
-            bbox[bbox < 0] = 0
-            for bb in bbox:
-                mask[bb[1] : bb[3], bb[0] : bb[2]] = 0
+        if self.pending is not None:
+            # features of the previous frame that was served from the cache
+            self.prev_img, self.prev_desc = None, None
+            self._compute(*self.pending)
+            self.pending = None
 
-        A = self.comp_function(img, mask, tag)
-        self.cache[tag] = A
+        A = self._compute(img, bbox, tag)
+        self.cache.put(key, A)
 
         return A
 
+    def _compute(self, img, bbox, tag):
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.downscale > 1 and self.method == "sparse":
+            h, w = img.shape
+            img = cv2.resize(img, (w // self.downscale, h // self.downscale))
+            bbox = bbox / self.downscale
+        mask = box_mask(img.shape, bbox)
+        return self.comp_function(img, mask, tag)
+
     def _load_file(self, name):
         affines = []
         with open(self.file_names[name], "r") as fp:
@@ -141,14 +181,14 @@ class CMCComputer:
         keypoints = cv2.goodFeaturesToTrack(frame, mask=mask, **self.sparse_flow_param)
 
         # Handle first frame
-        if self.prev_img is None:
+        if self.prev_img is None or self.prev_desc is None:
             self.prev_img = frame
             self.prev_desc = keypoints
             return A
 
-        matched_kp, status, err = cv2.calcOpticalFlowPyrLK(self.prev_img, frame, self.prev_desc, None)
+        matched_kp, status, err = cv2.calcOpticalFlowPyrLK(self.prev_img, frame, self.prev_desc, None, **self.lk_param)
         matched_kp = matched_kp.reshape(-1, 2)
-        status = status.reshape(-1)
+        status = status.reshape(-1).astype(bool)
         prev_points = self.prev_desc.reshape(-1, 2)
         prev_points = prev_points[status]
         curr_points = matched_kp[status]
@@ -160,11 +200,12 @@ class CMCComputer:
             print("Warning: not enough matching points")
         if A is None:
             A = np.eye(2, 3)
+        elif self.downscale > 1:
+            A[:, 2] *= self.downscale
 
         self.prev_img = frame
         self.prev_desc = keypoints
         return A
 
     def dump_cache(self):
-        with open(self.cache_path, "wb") as fp:
-            pickle.dump(self.cache, fp)
+        self.cache.dump()
@@ -97,6 +97,7 @@ Copyright 2014-2018 Roger R Labbe Jr.
 from __future__ import absolute_import, division
 
 import pdb
+from collections import deque
 from copy import deepcopy
 from math import log, exp, sqrt
 import sys
@@ -328,8 +329,9 @@ class KalmanFilterNew(object):
         self._likelihood = sys.float_info.min
         self._mahalanobis = None
 
-        # keep all observations
-        self.history_obs = []
+        # keep the last two observations and their count
+        self.history_obs = deque(maxlen=2)
+        self.n_obs = 0
 
         self.inv = np.linalg.inv
 
@@ -426,9 +428,16 @@ class KalmanFilterNew(object):
 
     def freeze(self):
         """
-        Save the parameters before non-observation forward
+        Save the parameters before non-observation forward. Only x, P and the last
+        measurement are kept with the length of the history, instead of a deep copy of
+        the whole filter.
         """
-        self.attr_saved = deepcopy(self.__dict__)
+        self.attr_saved = {
+            "x": self.x.copy(),
+            "P": self.P.copy(),
+            "last_measurement": np.copy(self.last_measurement),
+            "history_len": self.n_obs,
+        }
 
     def apply_affine_correction(self, m, t, new_kf):
         """
@@ -478,20 +487,23 @@ class KalmanFilterNew(object):
 
     def unfreeze(self):
         if self.attr_saved is not None:
-            new_history = deepcopy(self.history_obs)
-            self.__dict__ = self.attr_saved
-            # self.history_obs = new_history
-            self.history_obs = self.history_obs[:-1]
-            occur = [int(d is None) for d in new_history]
-            indices = np.where(np.array(occur) == 0)[0]
-            index1 = indices[-2]
-            index2 = indices[-1]
-            # box1 = new_history[index1]
+            saved, self.attr_saved = self.attr_saved, None
+            box2 = self.history_obs[-1]
+            self.x, self.P = saved["x"], saved["P"]
+            self.last_measurement = saved["last_measurement"]
+            # the track was observed when it was frozen
+            self.observed = True
+            # the observation before the freeze and the one just added
+            index1 = saved["history_len"] - 2
+            index2 = self.n_obs - 1
+            # the observations up to the one before the freeze, the virtual ones follow
+            self.history_obs.clear()
+            self.history_obs.append(self.last_measurement)
+            self.n_obs = index1 + 1
             box1 = self.last_measurement
             x1, y1, s1, r1 = box1
             w1 = np.sqrt(s1 * r1)
             h1 = np.sqrt(s1 / r1)
-            box2 = new_history[index2]
             x2, y2, s2, r2 = box2
             w2 = np.sqrt(s2 * r2)
             h2 = np.sqrt(s2 / r2)
@@ -500,27 +512,23 @@ class KalmanFilterNew(object):
             dy = (y2 - y1) / time_gap
             dw = (w2 - w1) / time_gap
             dh = (h2 - h1) / time_gap
-            for i in range(index2 - index1):
-                """
-                The default virtual trajectory generation is by linear
-                motion (constant speed hypothesis), you could modify this
-                part to implement your own.
-                """
-                x = x1 + (i + 1) * dx
-                y = y1 + (i + 1) * dy
-                w = w1 + (i + 1) * dw
-                h = h1 + (i + 1) * dh
-                s = w * h
-                r = w / float(h)
-                new_box = np.array([x, y, s, r]).reshape((4, 1))
+            """
+            The default virtual trajectory generation is by linear
+            motion (constant speed hypothesis), you could modify this
+            part to implement your own.
+            """
+            steps = np.arange(1, time_gap + 1, dtype=np.result_type(dx))[:, None]
+            x = x1 + steps * dx
+            y = y1 + steps * dy
+            w = w1 + steps * dw
+            h = h1 + steps * dh
+            trajectory = np.stack([x, y, w * h, w / h], axis=1).reshape(time_gap, 4, 1)
+            for i, new_box in enumerate(trajectory):
                 """
-                    I still use predict-update loop here to refresh the parameters,
-                    but this can be faster by directly modifying the internal parameters
-                    as suggested in the paper. I keep this naive but slow way for 
-                    easy read and understanding
+                    Re-update the restored parameters along the virtual trajectory
                 """
                 self.update(new_box)
-                if not i == (index2 - index1 - 1):
+                if not i == (time_gap - 1):
                     self.predict()
 
     def update(self, z, R=None, H=None):
@@ -549,6 +557,7 @@ class KalmanFilterNew(object):
 
         # append the observation
         self.history_obs.append(z)
+        self.n_obs += 1
 
         if z is None:
             if self.observed:
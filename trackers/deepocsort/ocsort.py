@@ -21,18 +21,9 @@ from reid_multibackend import ReIDDetectMultiBackend
 from collections import deque
 import copy
 from ..MATracker import MATracker, MATrack
-
-
-
-def k_previous_obs(observations, cur_age, k):
-    if len(observations) == 0:
-        return [-1, -1, -1, -1, -1]
-    for i in range(k):
-        dt = k - i
-        if cur_age - dt in observations:
-            return observations[cur_age - dt]
-    max_age = max(observations.keys())
-    return observations[max_age]
+from ..observation_bank import ObservationBank
+from ..frame_cache import FrameCache
+from ..reid_scheduler import ReIDScheduler
 
 
 def convert_bbox_to_z(bbox):
@@ -105,9 +96,11 @@ class KalmanBoxTracker(MATrack):
 
     count = 0
 
-    def __init__(self, bbox, cls, delta_t=3, orig=False, emb=None, alpha=0, new_kf=False):
+    def __init__(self, bbox, cls, delta_t=3, orig=False, emb=None, alpha=0, new_kf=False, observation_bank=None):
         """
         Initialises a tracker using initial bounding box.
+        The recent observations of the track live in a row of the ObservationBank shared by
+        all the tracks of an OCSort instance.
 
         """
         # define constant velocity model
@@ -192,18 +185,20 @@ class KalmanBoxTracker(MATrack):
         """
         NOTE: [-1,-1,-1,-1,-1] is a compromising placeholder for non-observation status, the same for the return of 
         function k_previous_obs. It is ugly and I do not like it. But to support generate observation array in a 
-        fast and unified way, which you would see below k_observations = np.array([k_previous_obs(...]]), let's bear it for now.
+        fast and unified way, which you would see below k_observations = ObservationBank.k_previous_obs(...), let's bear it for now.
         """
         # Used for OCR
         self.last_observation = np.array([-1, -1, -1, -1, -1])  # placeholder
-        # Used to output track after min_hits reached
-        self.history_observations = []
-        # Used for velocity
-        self.observations = dict()
+        # Used for velocity and to output track after min_hits reached
+        if observation_bank is None:
+            observation_bank = ObservationBank(ObservationBank.depth_for(delta_t), capacity=1)
+        self.observations = observation_bank
+        self.obs_row = observation_bank.attach()
         self.velocity = None
         self.delta_t = delta_t
 
         self.emb = emb
+        self.emb_age = 0  # age of the last embedding update
 
         self.frozen = False
 
@@ -216,24 +211,17 @@ class KalmanBoxTracker(MATrack):
             self.frozen = False
             self.cls = cls
             if self.last_observation.sum() >= 0:  # no previous observation
-                previous_box = None
-                for dt in range(self.delta_t, 0, -1):
-                    if self.age - dt in self.observations:
-                        previous_box = self.observations[self.age - dt]
-                        break
-                if previous_box is None:
-                    previous_box = self.last_observation
+                # the oldest observation of the last delta_t steps, else the last one
+                previous_box = self.observations.k_previous_obs([self.obs_row], [self.age], self.delta_t)[0]
                 """
                   Estimate the track speed direction with observations \Delta t steps away
                 """
                 self.velocity = speed_direction(previous_box, bbox)
             """
-              Insert new observations. This is a ugly way to maintain both self.observations
-              and self.history_observations. Bear it for the moment.
+              Insert new observations, only the last ones are kept in the ring buffer of the track.
             """
             self.last_observation = bbox
-            self.observations[self.age] = bbox
-            self.history_observations.append(bbox)
+            self.observations.add(self.obs_row, self.age, bbox)
 
             self.time_since_update = 0
             self.history = []
@@ -251,6 +239,7 @@ class KalmanBoxTracker(MATrack):
     def update_emb(self, emb, alpha=0.9):
         self.emb = alpha * self.emb + (1 - alpha) * emb
         self.emb /= np.linalg.norm(self.emb)
+        self.emb_age = self.age
 
     def get_emb(self):
         return self.emb.cpu()
@@ -258,18 +247,12 @@ class KalmanBoxTracker(MATrack):
     def apply_affine_correction(self, affine):
         m = affine[:, :2]
         t = affine[:, 2].reshape(2, 1)
-        # For OCR
-        if self.last_observation.sum() > 0:
-            ps = self.last_observation[:4].reshape(2, 2).T
-            ps = m @ ps + t
-            self.last_observation[:4] = ps.T.reshape(-1)
-
-        # Apply to each box in the range of velocity computation
-        for dt in range(self.delta_t, -1, -1):
-            if self.age - dt in self.observations:
-                ps = self.observations[self.age - dt][:4].reshape(2, 2).T
-                ps = m @ ps + t
-                self.observations[self.age - dt][:4] = ps.T.reshape(-1)
+        # Apply to each box in the range of velocity computation, and for OCR once more to the
+        # last observation, which is the same box
+        self.observations.apply_affine(self.obs_row, m, t, self.age - self.delta_t, self.age,
+                                       last=self.last_observation.sum() > 0)
+        if self.observations.count[self.obs_row]:
+            self.last_observation = self.observations.recent(self.obs_row)
 
         # Also need to change kf state, but might be frozen
         self.kf.apply_affine_correction(m, t, self.new_kf)
@@ -362,6 +345,13 @@ class OCSort(MATracker):
         new_kf_off=False,
         use_depth=False,
         use_odometry=False,
+        sequence="live",
+        embedding_cache_path="./cache/embeddings/deepocsort.cache",
+        cmc_cache_path="./cache/affine_ocsort.cache",
+        cmc_downscale=2,
+        cmc_max_corners=1000,
+        appearance_on_demand=False,
+        emb_refresh_stride=5,
         **kwargs
     ):
         """
@@ -380,10 +370,17 @@ class OCSort(MATracker):
         self.w_association_emb = w_association_emb
         self.alpha_fixed_emb = alpha_fixed_emb
         self.aw_param = aw_param
+        self.observation_bank = ObservationBank(ObservationBank.depth_for(delta_t, min_hits))
         KalmanBoxTracker.count = 0
 
         self.embedder = ReIDDetectMultiBackend(weights=model_weights, device=device, fp16=fp16)
-        self.cmc = CMCComputer()
+        # the embeddings are keyed by the ReID weights too, the cache file may be shared by several models
+        self.embedding_cache = FrameCache(embedding_cache_path)
+        self.embedding_model = os.path.basename(str(model_weights))
+        self.sequence = sequence
+        # only the detections the IoU association can not tell apart are embedded
+        self.reid_scheduler = ReIDScheduler(iou_threshold, emb_refresh_stride) if appearance_on_demand else None
+        self.cmc = CMCComputer(downscale=cmc_downscale, max_corners=cmc_max_corners, cache_path=cmc_cache_path)
         self.embedding_off = embedding_off
         self.cmc_off = cmc_off
         self.aw_off = aw_off
@@ -397,7 +394,7 @@ class OCSort(MATracker):
         Returns the a similar array, where the last column is the object ID.
         NOTE: The number of objects returned may differ from the number of detections provided.
         """
-        tag='blub'
+        tag = f"{self.sequence}:{self.frame_count + 1}"
         self.update_time(odom, self.frame_count)
         if odom is not None:
             KalmanBoxTracker.update_ego_motion(odom, self.fps)
@@ -419,14 +416,6 @@ class OCSort(MATracker):
         #scale = min(img_tensor.shape[2] / img_numpy.shape[0], img_tensor.shape[3] / img_numpy.shape[1])
         #dets[:, :4] /= scale
 
-        # Embedding
-        if self.embedding_off or dets.shape[0] == 0:
-            dets_embs = np.ones((dets.shape[0], 1))
-        else:
-            # (Ndets x X) [512, 1024, 2048]
-            #dets_embs = self.embedder.compute_embedding(img_numpy, dets[:, :4], tag)
-            dets_embs = self._get_features(dets[:, :4], img_numpy)
-
         # CMC
         if not self.cmc_off:
             transform = self.cmc.compute_affine(img_numpy, dets[:, :4], tag)
@@ -438,6 +427,10 @@ class OCSort(MATracker):
         # From [self.alpha_fixed_emb, 1], goes to 1 as detector is less confident
         dets_alpha = af + (1 - af) * (1 - trust)
 
+        # sample the depths of all the trackers at once, predict() then reads them from the sampler cache
+        if hasattr(KalmanBoxTracker, 'current_yaw_dot_filtered') and hasattr(KalmanBoxTracker, 'current_D_dot'):
+            KalmanBoxTracker.multi_get_d1(self.trackers)
+
         # get predicted locations from existing trackers.
         trks = np.zeros((len(self.trackers), 5))
         trk_embs = []
@@ -460,9 +453,31 @@ class OCSort(MATracker):
         for t in reversed(to_del):
             self.trackers.pop(t)
 
+        # Embedding
+        dets_proxy = np.full(dets.shape[0], -1)
+        if self.embedding_off or dets.shape[0] == 0:
+            dets_embs = np.ones((dets.shape[0], 1))
+        elif self.reid_scheduler is None:
+            # (Ndets x X) [512, 1024, 2048]
+            #dets_embs = self.embedder.compute_embedding(img_numpy, dets[:, :4], tag)
+            dets_embs = self._get_embeddings(dets[:, :4], img_numpy, tag)
+        else:
+            # appearance on demand, the detections matched by IoU alone borrow the embedding of their track
+            ious = iou_batch(dets, trks) if len(trks) > 0 else np.zeros((dets.shape[0], 0))
+            stale = self.reid_scheduler.is_stale([trk.age - trk.emb_age for trk in self.trackers])
+            lost = [trk.time_since_update > 1 for trk in self.trackers]
+            embed, dets_proxy = self.reid_scheduler.select(ious, stale, lost)
+            if embed.all():
+                dets_embs = self._get_embeddings(dets[:, :4], img_numpy, tag)
+            else:
+                dets_embs = torch.from_numpy(trk_embs[np.maximum(dets_proxy, 0)])
+                if embed.any():
+                    dets_embs[torch.from_numpy(embed)] = self._get_embeddings(dets[embed, :4], img_numpy, tag).to(dets_embs.dtype)
+
         velocities = np.array([trk.velocity if trk.velocity is not None else np.array((0, 0)) for trk in self.trackers])
         last_boxes = np.array([trk.last_observation for trk in self.trackers])
-        k_observations = np.array([k_previous_obs(trk.observations, trk.age, self.delta_t) for trk in self.trackers])
+        k_observations = self.observation_bank.k_previous_obs(
+            [trk.obs_row for trk in self.trackers], [trk.age for trk in self.trackers], self.delta_t)
 
         """
             First round of association
@@ -486,7 +501,8 @@ class OCSort(MATracker):
         )
         for m in matched:
             self.trackers[m[1]].update(dets[m[0], :5], dets[m[0], 5])
-            self.trackers[m[1]].update_emb(dets_embs[m[0]], alpha=dets_alpha[m[0]])
+            if dets_proxy[m[0]] < 0:
+                self.trackers[m[1]].update_emb(dets_embs[m[0]], alpha=dets_alpha[m[0]])
 
         """
             Second round of associaton by OCR
@@ -509,27 +525,34 @@ class OCSort(MATracker):
                 get a higher performance especially on MOT17/MOT20 datasets. But we keep it
                 uniform here for simplicity
                 """
-                rematched_indices = linear_assignment(-iou_left)
-                to_remove_det_indices = []
-                to_remove_trk_indices = []
-                for m in rematched_indices:
-                    det_ind, trk_ind = unmatched_dets[m[0]], unmatched_trks[m[1]]
-                    if iou_left[m[0], m[1]] < self.iou_threshold:
-                        continue
+                with association_timer("solve"):
+                    rematched_indices = linear_assignment(-iou_left)
+                with association_timer("post"):
+                    rematched_indices = rematched_indices[
+                        ~(iou_left[rematched_indices[:, 0], rematched_indices[:, 1]] < self.iou_threshold)
+                    ]
+                    det_inds, trk_inds = unmatched_dets[rematched_indices[:, 0]], unmatched_trks[rematched_indices[:, 1]]
+                for det_ind, trk_ind in zip(det_inds, trk_inds):
                     self.trackers[trk_ind].update(dets[det_ind, :5], dets[det_ind, 5])
-                    self.trackers[trk_ind].update_emb(dets_embs[det_ind], alpha=dets_alpha[det_ind])
-                    to_remove_det_indices.append(det_ind)
-                    to_remove_trk_indices.append(trk_ind)
-                unmatched_dets = np.setdiff1d(unmatched_dets, np.array(to_remove_det_indices))
-                unmatched_trks = np.setdiff1d(unmatched_trks, np.array(to_remove_trk_indices))
+                    if dets_proxy[det_ind] < 0:
+                        self.trackers[trk_ind].update_emb(dets_embs[det_ind], alpha=dets_alpha[det_ind])
+                unmatched_dets = np.setdiff1d(unmatched_dets, det_inds)
+                unmatched_trks = np.setdiff1d(unmatched_trks, trk_inds)
 
         for m in unmatched_trks:
             self.trackers[m].update(None, None)
 
+        # the unmatched detections start tracks, they need embeddings of their own
+        proxies = unmatched_dets[dets_proxy[unmatched_dets] >= 0]
+        if len(proxies) > 0:
+            dets_embs[torch.from_numpy(proxies)] = self._get_embeddings(dets[proxies, :4], img_numpy, tag).to(dets_embs.dtype)
+            self.reid_scheduler.add_embedded(len(proxies))
+
         # create and initialise new trackers for unmatched detections
         for i in unmatched_dets:
             trk = KalmanBoxTracker(
-                dets[i, :5], dets[i, 5], delta_t=self.delta_t, emb=dets_embs[i], alpha=dets_alpha[i], new_kf=not self.new_kf_off
+                dets[i, :5], dets[i, 5], delta_t=self.delta_t, emb=dets_embs[i], alpha=dets_alpha[i], new_kf=not self.new_kf_off,
+                observation_bank=self.observation_bank
             )
             self.trackers.append(trk)
         i = len(self.trackers)
@@ -549,6 +572,7 @@ class OCSort(MATracker):
             # remove dead tracklet
             if trk.time_since_update > self.max_age:
                 self.trackers.pop(i)
+        self.observation_bank.retain([trk.obs_row for trk in self.trackers])
         if len(ret) > 0:
             return np.concatenate(ret)
         return np.empty((0, 5))
@@ -561,14 +585,19 @@ class OCSort(MATracker):
         y2 = min(int(y + h / 2), self.height - 1)
         return x1, y1, x2, y2
     
+    def _get_embeddings(self, boxes, img, tag):
+        key = self.embedding_cache.key(f"{tag}:{self.embedding_model}", img, boxes)
+        embs = self.embedding_cache.get(key)
+        if embs is None:
+            embs = self._get_features(boxes, img)
+            self.embedding_cache.put(key, embs)
+        return embs
+
     def _get_features(self, bbox_xywh, ori_img):
-        im_crops = []
-        for box in bbox_xywh:
-            x1, y1, x2, y2 = self._xywh_to_xyxy(box)
-            im = ori_img[y1:y2, x1:x2]
-            im_crops.append(im)
-        if im_crops:
-            features = self.embedder(im_crops).cpu()
+        # the crops are cut, resized and normalized from the frame in one batch
+        boxes = [self._xywh_to_xyxy(box) for box in bbox_xywh]
+        if boxes:
+            features = self.embedder(ori_img, boxes).cpu()
         else:
             features = np.array([])
         
@@ -585,6 +614,9 @@ class OCSort(MATracker):
         cates = cates[remain_inds]
         dets = dets[remain_inds]
 
+        # sample the depths of all the trackers at once, predict() then reads them from the sampler cache
+        if hasattr(KalmanBoxTracker, 'current_yaw_dot_filtered') and hasattr(KalmanBoxTracker, 'current_D_dot'):
+            KalmanBoxTracker.multi_get_d1(self.trackers)
         trks = np.zeros((len(self.trackers), 5))
         to_del = []
         ret = []
@@ -600,7 +632,8 @@ class OCSort(MATracker):
 
         velocities = np.array([trk.velocity if trk.velocity is not None else np.array((0, 0)) for trk in self.trackers])
         last_boxes = np.array([trk.last_observation for trk in self.trackers])
-        k_observations = np.array([k_previous_obs(trk.observations, trk.age, self.delta_t) for trk in self.trackers])
+        k_observations = self.observation_bank.k_previous_obs(
+            [trk.obs_row for trk in self.trackers], [trk.age for trk in self.trackers], self.delta_t)
 
         matched, unmatched_dets, unmatched_trks = associate_kitti(
             dets,
@@ -630,31 +663,24 @@ class OCSort(MATracker):
             iou_left = np.array(iou_left)
             det_cates_left = cates[unmatched_dets]
             trk_cates_left = trks[unmatched_trks][:, 4]
-            num_dets = unmatched_dets.shape[0]
-            num_trks = unmatched_trks.shape[0]
-            cate_matrix = np.zeros((num_dets, num_trks))
-            for i in range(num_dets):
-                for j in range(num_trks):
-                    if det_cates_left[i] != trk_cates_left[j]:
-                        """
-                        For some datasets, such as KITTI, there are different categories,
-                        we have to avoid associate them together.
-                        """
-                        cate_matrix[i][j] = -1e6
-            iou_left = iou_left + cate_matrix
+            """
+            For some datasets, such as KITTI, there are different categories,
+            we have to avoid associate them together.
+            """
+            with association_timer("gate"):
+                iou_left = iou_left + category_mask(det_cates_left, trk_cates_left)
             if iou_left.max() > self.iou_threshold - 0.1:
-                rematched_indices = linear_assignment(-iou_left)
-                to_remove_det_indices = []
-                to_remove_trk_indices = []
-                for m in rematched_indices:
-                    det_ind, trk_ind = unmatched_dets[m[0]], unmatched_trks[m[1]]
-                    if iou_left[m[0], m[1]] < self.iou_threshold - 0.1:
-                        continue
+                with association_timer("solve"):
+                    rematched_indices = linear_assignment(-iou_left)
+                with association_timer("post"):
+                    rematched_indices = rematched_indices[
+                        ~(iou_left[rematched_indices[:, 0], rematched_indices[:, 1]] < self.iou_threshold - 0.1)
+                    ]
+                    det_inds, trk_inds = unmatched_dets[rematched_indices[:, 0]], unmatched_trks[rematched_indices[:, 1]]
+                for det_ind, trk_ind in zip(det_inds, trk_inds):
                     self.trackers[trk_ind].update(dets[det_ind, :])
-                    to_remove_det_indices.append(det_ind)
-                    to_remove_trk_indices.append(trk_ind)
-                unmatched_dets = np.setdiff1d(unmatched_dets, np.array(to_remove_det_indices))
-                unmatched_trks = np.setdiff1d(unmatched_trks, np.array(to_remove_trk_indices))
+                unmatched_dets = np.setdiff1d(unmatched_dets, det_inds)
+                unmatched_trks = np.setdiff1d(unmatched_trks, trk_inds)
 
         for i in unmatched_dets:
             trk = KalmanBoxTracker(dets[i, :])
@@ -674,7 +700,7 @@ class OCSort(MATracker):
                 if trk.hit_streak == self.min_hits:
                     # Head Padding (HP): recover the lost steps during initializing the track
                     for prev_i in range(self.min_hits - 1):
-                        prev_observation = trk.history_observations[-(prev_i + 2)]
+                        prev_observation = trk.observations.recent(trk.obs_row, prev_i + 1)
                         ret.append(
                             (
                                 np.concatenate(
@@ -690,6 +716,7 @@ class OCSort(MATracker):
             i -= 1
             if trk.time_since_update > self.max_age:
                 self.trackers.pop(i)
+        self.observation_bank.retain([trk.obs_row for trk in self.trackers])
 
         if len(ret) > 0:
             return np.concatenate(ret)
@@ -697,4 +724,7 @@ class OCSort(MATracker):
 
     def dump_cache(self):
         self.cmc.dump_cache()
-        self.embedder.dump_cache()
+        self.embedding_cache.dump()
+
+    def cache_summary(self):
+        return f"CMC cache {self.cmc.cache.summary()}, embedding cache {self.embedding_cache.summary()}"
@@ -1,3 +1,4 @@
+import os
 import torch.nn as nn
 import torch
 from pathlib import Path
@@ -17,6 +18,11 @@ from yolov8.ultralytics.yolo.utils import LOGGER
 from trackers.strongsort.deep.reid_model_factory import (show_downloadeable_models, get_model_url, get_model_name,
                                                           download_url, load_pretrained_weights)
 from trackers.strongsort.deep.models import build_model
+from trackers.reid_preprocess import crop_batch
+
+
+# batch sizes the ONNX models with a dynamic batch run at, the crops of a frame are split into them
+ONNX_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
 
 
 def check_suffix(file='yolov5s.pt', suffix=('.pt',), msg=''):
@@ -32,7 +38,7 @@ def check_suffix(file='yolov5s.pt', suffix=('.pt',), msg=''):
 
 class ReIDDetectMultiBackend(nn.Module):
     # ReID models MultiBackend class for python inference on various backends
-    def __init__(self, weights='osnet_x0_25_msmt17.pt', device=torch.device('cpu'), fp16=False):
+    def __init__(self, weights='osnet_x0_25_msmt17.pt', device=torch.device('cpu'), fp16=False, onnx_threads=None):
         super().__init__()
 
         w = weights[0] if isinstance(weights, list) else weights
@@ -51,6 +57,9 @@ class ReIDDetectMultiBackend(nn.Module):
         self.transforms += [T.Normalize(mean=self.pixel_mean, std=self.pixel_std)]
         self.preprocess = T.Compose(self.transforms)
         self.to_pil = T.ToPILImage()
+        # Normalize of the 0-255 pixels, for the crops of the batched path
+        self.pixel_mean_255 = torch.tensor(self.pixel_mean, device=device).view(1, 3, 1, 1) * 255
+        self.pixel_std_255 = torch.tensor(self.pixel_std, device=device).view(1, 3, 1, 1) * 255
 
         model_name = get_model_name(w)
 
@@ -90,7 +99,15 @@ class ReIDDetectMultiBackend(nn.Module):
             #check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
             import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            self.session = onnxruntime.InferenceSession(str(w), providers=providers)
+            options = onnxruntime.SessionOptions()
+            # the CPUs this process may run on, the runtime default counts all the cores of the host
+            if onnx_threads is None and hasattr(os, 'sched_getaffinity'):
+                onnx_threads = len(os.sched_getaffinity(0))
+            options.intra_op_num_threads = onnx_threads or 0
+            self.session = onnxruntime.InferenceSession(str(w), sess_options=options, providers=providers)
+            batch = self.session.get_inputs()[0].shape[0]
+            self.onnx_buckets = (batch,) if isinstance(batch, int) else ONNX_BUCKETS
+            self.onnx_bindings = {}  # bucket -> (IOBinding, input buffer, output buffer)
         elif self.engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
             import tensorrt as trt  # https://developer.nvidia.com/nvidia-tensorrt-download
@@ -182,12 +199,20 @@ class ReIDDetectMultiBackend(nn.Module):
         images = images.to(self.device)
 
         return images
-    
-    
-    def forward(self, im_batch):
+
+    def _preprocess_boxes(self, im, boxes):
+        # crops of the xyxy pixel boxes of the HxWx3 frame im resized into one batch, normalized in one op on the device
+        crops = crop_batch(im, boxes, self.image_size, self.device)
+        return crops.sub_(self.pixel_mean_255).div_(self.pixel_std_255)
+
+    def forward(self, im_batch, boxes=None):
+        # im_batch is a list of HxWx3 crops, or the whole HxWx3 frame when the Nx4 xyxy boxes are given
         
         # preprocess batch
-        im_batch = self._preprocess(im_batch)
+        if boxes is None:
+            im_batch = self._preprocess(im_batch)
+        else:
+            im_batch = self._preprocess_boxes(im_batch, boxes)
 
         # batch to half
         if self.fp16 and im_batch.dtype != torch.float16:
@@ -201,7 +226,7 @@ class ReIDDetectMultiBackend(nn.Module):
             features = self.model(im_batch)
         elif self.onnx:  # ONNX Runtime
             im_batch = im_batch.cpu().numpy()  # torch to numpy
-            features = self.session.run([self.session.get_outputs()[0].name], {self.session.get_inputs()[0].name: im_batch})[0]
+            features = self._onnx_run(im_batch)
         elif self.engine:  # TensorRT
             if True and im_batch.shape != self.bindings['images'].shape:
                 i_in, i_out = (self.model_.get_binding_index(x) for x in ('images', 'output'))
@@ -225,6 +250,36 @@ class ReIDDetectMultiBackend(nn.Module):
         else:
             return self.from_numpy(features)
 
+    def _onnx_binding(self, bucket):
+        # preallocated input and output buffers of the bucket, bound once to the session
+        if bucket not in self.onnx_bindings:
+            inp, out = self.session.get_inputs()[0], self.session.get_outputs()[0]
+            x = np.zeros((bucket, 3, *self.image_size), dtype=np.float16 if inp.type == 'tensor(float16)' else np.float32)
+            y = self.session.run([out.name], {inp.name: x})[0]
+            binding = self.session.io_binding()
+            binding.bind_input(inp.name, 'cpu', 0, x.dtype, x.shape, x.ctypes.data)
+            binding.bind_output(out.name, 'cpu', 0, y.dtype, y.shape, y.ctypes.data)
+            self.onnx_bindings[bucket] = (binding, x, y)
+        return self.onnx_bindings[bucket]
+
+    def _onnx_run(self, im_batch):
+        # the batch runs as chunks of the largest buckets that fit, e.g. 13 crops as 8 + 4 + 1, so the
+        # runtime reuses the memory plans of a few input shapes. On CPU the cost grows with the batch,
+        # padding to the next bucket would cost up to twice the inference. A static batch model pads
+        # the last chunk.
+        features = []
+        start = 0
+        while start < len(im_batch):
+            n = len(im_batch) - start
+            bucket = max((b for b in self.onnx_buckets if b <= n), default=self.onnx_buckets[0])
+            binding, x, y = self._onnx_binding(bucket)
+            chunk = im_batch[start:start + bucket]
+            x[:len(chunk)] = chunk
+            self.session.run_with_iobinding(binding)
+            features.append(y[:len(chunk)].copy())
+            start += len(chunk)
+        return np.concatenate(features)
+
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
@@ -0,0 +1,264 @@
+import cv2
+import numpy as np
+
+
+class DepthIndex(object):
+    """
+    Per-frame index of a depth image for fast per-box depth statistics.
+
+    The valid (non-zero, non-NaN) depth values are quantized into `bins` bins, on a log
+    scale when all the depths are positive, and counted per `cell` x `cell` pixel block.
+    Integral images of these per-bin counts give the depth histogram of any box with four
+    lookups, from which the median or a trimmed mean of all the boxes is computed at once.
+    Boxes are snapped outwards to the cell grid and values are interpolated inside a bin,
+    so these statistics are approximations; `exact_median` keeps the exact per-box median.
+    The index is built lazily on the first histogram query of the frame.
+
+    Parameters
+    ----------
+    depth_image : ndarray
+        The HxW depth image of the current frame.
+    cell : int
+        Side in pixels of the blocks the histograms are accumulated over.
+    bins : int
+        Number of depth bins.
+
+    """
+
+    _cell_offsets = {}
+
+    def __init__(self, depth_image, cell=8, bins=32):
+        self.depth_image = depth_image
+        self.cell, self.bins = cell, bins
+        self._integral = None
+
+    @classmethod
+    def _cell_offset_image(cls, height, width, cell, bins):
+        """Image of the offset of the histogram of the cell every pixel falls in, cached per image size"""
+        key = (height, width, cell, bins)
+        if key not in cls._cell_offsets:
+            grid_w = -(-width // cell)
+            rows = (np.arange(height) // cell) * grid_w
+            cls._cell_offsets[key] = ((rows[:, None] + np.arange(width) // cell) * bins).astype(np.int32)
+        return cls._cell_offsets[key]
+
+    def _build(self):
+        depth = self.depth_image
+        height, width = depth.shape[:2]
+        grid_h, grid_w = -(-height // self.cell), -(-width // self.cell)
+        valid = depth != 0
+        valid &= ~np.isnan(depth)
+        values = depth[valid].astype(np.float32)
+        integral = np.zeros((grid_h + 1, grid_w + 1, self.bins), dtype=np.int32)
+        self._integral = integral
+        if values.size == 0:
+            self.edges, self.log_scale = np.zeros(self.bins + 1), False
+            return
+        self.log_scale = values.min() > 0
+        if self.log_scale:
+            np.log(values, out=values)
+        lo, hi = float(values.min()), float(values.max())
+        self.edges = np.linspace(lo, hi, self.bins + 1)
+        values -= lo
+        values *= self.bins / (hi - lo) if hi > lo else 0.
+        bin_index = values.astype(np.int32)
+        np.minimum(bin_index, self.bins - 1, out=bin_index)
+        bin_index += self._cell_offset_image(height, width, self.cell, self.bins)[valid]
+        counts = np.bincount(bin_index, minlength=grid_h * grid_w * self.bins)
+        integral[1:, 1:] = counts.reshape(grid_h, grid_w, self.bins)
+        # running sums over whole rows and columns of cells are much faster than np.cumsum on this layout
+        for i in range(2, grid_h + 1):
+            integral[i] += integral[i - 1]
+        for j in range(2, grid_w + 1):
+            integral[:, j] += integral[:, j - 1]
+
+    @staticmethod
+    def _pixel_bounds(tlwh, height, width):
+        """Clip the tlwh boxes like the depth crops of `exact_median` and return x0, y0, x1, y1"""
+        tlwh = np.array(tlwh, dtype=np.float64).reshape(-1, 4)
+        tlwh[(tlwh < 0) | np.isnan(tlwh)] = 0
+        x0, y0 = tlwh[:, 0].astype(np.intp), tlwh[:, 1].astype(np.intp)
+        x1, y1 = (tlwh[:, 0] + tlwh[:, 2]).astype(np.intp), (tlwh[:, 1] + tlwh[:, 3]).astype(np.intp)
+        return np.minimum(x0, width), np.minimum(y0, height), np.minimum(x1, width), np.minimum(y1, height)
+
+    def box_histograms(self, tlwh):
+        """Return the Nxbins depth histograms of the N boxes in tlwh format"""
+        if self._integral is None:
+            self._build()
+        height, width = self.depth_image.shape[:2]
+        x0, y0, x1, y1 = self._pixel_bounds(tlwh, height, width)
+        # empty in pixels, before the snapping to cells can give them the cells of the image border
+        empty = (x1 <= x0) | (y1 <= y0)
+        cx0, cy0 = x0 // self.cell, y0 // self.cell
+        cx1, cy1 = -(-x1 // self.cell), -(-y1 // self.cell)
+        cx1, cy1 = np.maximum(cx1, cx0), np.maximum(cy1, cy0)
+        integral = self._integral
+        hist = integral[cy1, cx1] - integral[cy0, cx1] - integral[cy1, cx0] + integral[cy0, cx0]
+        hist[empty] = 0
+        return hist
+
+    def _to_depth(self, values):
+        return np.exp(values) if self.log_scale else values
+
+    def box_quantiles(self, tlwh, q):
+        """Return the q-th quantile (0 <= q <= 1) of the valid depths of every box, 0 for boxes without any"""
+        hist = self.box_histograms(tlwh)
+        cum = np.cumsum(hist, axis=1)
+        total = cum[:, -1]
+        target = q * total
+        k = np.minimum(np.sum(cum < target[:, None], axis=1), self.bins - 1)
+        rows = np.arange(len(hist))
+        in_bin = hist[rows, k]
+        frac = (target - (cum[rows, k] - in_bin)) / np.maximum(in_bin, 1)
+        values = self.edges[k] + frac * (self.edges[k + 1] - self.edges[k])
+        return np.where(total > 0, self._to_depth(values), 0.)
+
+    def box_trimmed_means(self, tlwh, trim=0.1):
+        """Return the mean of the valid depths of every box once the `trim` lowest and highest fractions are dropped"""
+        hist = self.box_histograms(tlwh)
+        cum = np.cumsum(hist, axis=1)
+        total = cum[:, -1:]
+        lo, hi = trim * total, (1 - trim) * total
+        weights = np.clip(cum, lo, hi) - np.clip(cum - hist, lo, hi)
+        centers = self._to_depth((self.edges[:-1] + self.edges[1:]) / 2)
+        weight_sum = weights.sum(axis=1)
+        return np.where(weight_sum > 0, (weights * centers).sum(axis=1) / np.maximum(weight_sum, 1e-12), 0.)
+
+    def exact_median(self, tlwh):
+        """Return the exact median of the valid depths of every box, 0 for boxes without any"""
+        height, width = self.depth_image.shape[:2]
+        x0, y0, x1, y1 = self._pixel_bounds(tlwh, height, width)
+        depths = np.zeros(len(x0))
+        for i in range(len(x0)):
+            track_depth = self.depth_image[y0[i]:y1[i], x0[i]:x1[i]]
+            track_depth = track_depth[(track_depth != 0) & ~np.isnan(track_depth)]
+            if len(track_depth) > 0:
+                depths[i] = np.median(track_depth)
+        return depths
+
+    def box_depths(self, tlwh, statistic='median'):
+        """
+        Robust depth of the N boxes in tlwh format, 0 for boxes without valid depth.
+        statistic is one of 'median', 'trimmed_mean' (histogram index) or 'exact_median'.
+        """
+        if statistic == 'median':
+            return self.box_quantiles(tlwh, 0.5)
+        elif statistic == 'trimmed_mean':
+            return self.box_trimmed_means(tlwh)
+        elif statistic == 'exact_median':
+            return self.exact_median(tlwh)
+        else:
+            raise ValueError('invalid depth statistic')
+
+
+class DepthSampler(object):
+    """
+    Batched depth sampling of the track boxes, shared by all the MATrack trackers.
+
+    `update` is fed every depth frame by `MATrack.update_depth_image` and `sample` returns
+    the depth of N boxes in one vectorized pass. When the boxes come with per-track keys,
+    the last sample of every track is cached: a track sampled again with the same box in
+    the same frame gets the cached depth, and if `reuse_iou` is set, a track whose box
+    overlaps its last sampled box by at least `reuse_iou` reuses that depth for up to
+    `max_reuse` frames.
+
+    Parameters
+    ----------
+    reducer : str
+        'median', 'percentile' or 'trimmed_mean' of the DepthIndex histograms,
+        'nearest_valid' for the valid depth pixel closest to the box center, or
+        'exact_median' for the exact median of the box crop.
+    percentile : float
+        Percentile (0-100) used by the 'percentile' reducer.
+    reuse_iou : Optional[float]
+        IoU above which a track reuses its cached depth, None to sample every frame.
+    max_reuse : int
+        Number of frames a cached depth can be reused for.
+
+    """
+    reducers = ('median', 'percentile', 'trimmed_mean', 'nearest_valid', 'exact_median')
+
+    def __init__(self, reducer='median', percentile=50., reuse_iou=None, max_reuse=5):
+        if reducer not in self.reducers:
+            raise ValueError('invalid depth reducer')
+        self.reducer = reducer
+        self.percentile = percentile
+        self.reuse_iou = reuse_iou
+        self.max_reuse = max_reuse
+        self.index = None
+        self.frame = 0
+        self._nearest_labels = None
+        self._cache = {}  # key: (tlwh, depth, frame it was sampled in)
+
+    def update(self, depth_image):
+        self.index = DepthIndex(depth_image)
+        self._nearest_labels = None
+        self.frame += 1
+        self._cache = {k: v for k, v in self._cache.items() if self.frame - v[2] <= self.max_reuse}
+
+    def _nearest_valid(self, tlwh):
+        depth = self.index.depth_image
+        height, width = depth.shape[:2]
+        valid = depth != 0
+        valid &= ~np.isnan(depth)
+        if not np.any(valid):
+            return np.zeros(len(tlwh))
+        if self._nearest_labels is None:
+            # every pixel is labelled with the scan order index (from 1) of its closest valid pixel
+            _, labels = cv2.distanceTransformWithLabels((~valid).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_5,
+                                                        labelType=cv2.DIST_LABEL_PIXEL)
+            self._nearest_labels = labels, np.flatnonzero(valid)
+        labels, valid_pixels = self._nearest_labels
+        center = np.nan_to_num(tlwh[:, :2] + tlwh[:, 2:] / 2)
+        cx = np.clip(center[:, 0], 0, width - 1).astype(np.intp)
+        cy = np.clip(center[:, 1], 0, height - 1).astype(np.intp)
+        return depth.ravel()[valid_pixels[labels[cy, cx] - 1]].astype(np.float64)
+
+    def _reduce(self, tlwh):
+        if self.reducer == 'median':
+            return self.index.box_quantiles(tlwh, 0.5)
+        elif self.reducer == 'percentile':
+            return self.index.box_quantiles(tlwh, self.percentile / 100.)
+        elif self.reducer == 'trimmed_mean':
+            return self.index.box_trimmed_means(tlwh)
+        elif self.reducer == 'nearest_valid':
+            return self._nearest_valid(tlwh)
+        return self.index.exact_median(tlwh)
+
+    @staticmethod
+    def _paired_iou(a, b):
+        w = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+        h = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+        inter = np.maximum(w, 0) * np.maximum(h, 0)
+        union = a[:, 2] * a[:, 3] + b[:, 2] * b[:, 3] - inter
+        return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.)
+
+    def sample(self, tlwh, keys=None):
+        """
+        Return the depths of the N boxes in tlwh format, 0 for boxes without valid depth.
+        keys are optional per-box hashables (e.g. the tracks) that identify the cache entries.
+        """
+        tlwh = np.asarray(tlwh, dtype=np.float64).reshape(-1, 4)
+        depths = np.zeros(len(tlwh))
+        if self.index is None or len(tlwh) == 0:
+            return depths
+        todo = np.ones(len(tlwh), dtype=bool)
+        if keys is not None and self._cache:
+            entries = [self._cache.get(k) for k in keys]
+            cached = [i for i, e in enumerate(entries) if e is not None]
+            if cached:
+                cached_boxes = np.array([entries[i][0] for i in cached])
+                cached_depths = np.array([entries[i][1] for i in cached])
+                same_frame = np.array([entries[i][2] == self.frame for i in cached])
+                reuse = same_frame & np.all(cached_boxes == tlwh[cached], axis=1)
+                if self.reuse_iou is not None:
+                    reuse |= ~same_frame & (self._paired_iou(cached_boxes, tlwh[cached]) >= self.reuse_iou)
+                cached = np.asarray(cached)[reuse]
+                depths[cached] = cached_depths[reuse]
+                todo[cached] = False
+        if np.any(todo):
+            depths[todo] = self._reduce(tlwh[todo])
+            if keys is not None:
+                for i in np.flatnonzero(todo):
+                    self._cache[keys[i]] = (tlwh[i], depths[i], self.frame)
+        return depths
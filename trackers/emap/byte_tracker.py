@@ -12,6 +12,7 @@ from yolov8.ultralytics.yolo.utils.ops import xywh2xyxy, xyxy2xywh
 from trackers.emap.kalman_filter import KalmanFilter
 from trackers.emap import matching
 from trackers.emap.basetrack import BaseTrack, TrackState
+from trackers.emap.track_table import TrackField, TrackTable
 import time
 from torch.utils.tensorboard import SummaryWriter
 import datetime
@@ -23,6 +24,16 @@ FOCAL_LENGTH = 480.0
 
 class STrack(BaseTrack, MATrack):
     shared_kalman = KalmanFilter(IMG_WIDTH, IMG_HEIGHT, FOCAL_LENGTH) #TODO check the parameters
+    # once activated, these attributes are views over the track's row in the TrackTable
+    mean = TrackField()
+    covariance = TrackField()
+    state = TrackField(TrackState.New)
+    score = TrackField(0)
+    cls = TrackField()
+    frame_id = TrackField(0)
+    start_frame = TrackField(0)
+    _table, _row = None, None
+
     def __init__(self, tlwh, score, cls):
         MATrack.__init__(self)
         # wait activate
@@ -51,23 +62,54 @@ class STrack(BaseTrack, MATrack):
     @staticmethod
     def multi_predict(stracks):
         if len(stracks) > 0:
-            multi_mean = np.asarray([st.mean.copy() for st in stracks])
-            multi_covariance = np.asarray([st.covariance for st in stracks])
-            for i, st in enumerate(stracks):
-                if st.state != TrackState.Tracked:
-                    multi_mean[i][7] = 0
+            table, rows = TrackTable.rows_of(stracks)
+            if table is not None:
+                multi_mean = table.mean[rows]
+                multi_covariance = table.covariance[rows]
+                multi_mean[table.state[rows] != TrackState.Tracked, 7] = 0
+            else:
+                multi_mean = np.asarray([st.mean.copy() for st in stracks])
+                multi_covariance = np.asarray([st.covariance for st in stracks])
+                for i, st in enumerate(stracks):
+                    if st.state != TrackState.Tracked:
+                        multi_mean[i][7] = 0
             # create a n*3 array of yaw_dot, current_D_dot and depth
-            control_input = np.array([[STrack.current_yaw_dot, STrack.current_D_dot, st.get_d1() ]for st in stracks])
+            control_input = np.c_[np.full((len(stracks), 2), [STrack.current_yaw_dot, STrack.current_D_dot]), STrack.multi_get_d1(stracks)]
             # print("control input 'emap' is ", control_input)
             multi_mean, multi_covariance = STrack.shared_kalman.multi_predict(multi_mean, multi_covariance, control_input)
+            STrack._scatter(stracks, table, rows, multi_mean, multi_covariance)
+
+    @staticmethod
+    def multi_update(stracks, detections):
+        """Correct the Kalman states of the matched stracks with their detections in one batched call"""
+        if len(stracks) > 0:
+            table, rows = TrackTable.rows_of(stracks)
+            if table is not None:
+                multi_mean = table.mean[rows]
+                multi_covariance = table.covariance[rows]
+            else:
+                multi_mean = np.asarray([st.mean for st in stracks])
+                multi_covariance = np.asarray([st.covariance for st in stracks])
+            measurements = np.asarray([STrack.tlwh_to_xyah(det.tlwh) for det in detections])
+            multi_mean, multi_covariance = STrack.shared_kalman.multi_update(multi_mean, multi_covariance, measurements)
+            STrack._scatter(stracks, table, rows, multi_mean, multi_covariance)
+
+    @staticmethod
+    def _scatter(stracks, table, rows, multi_mean, multi_covariance):
+        if table is not None:
+            table.mean[rows] = multi_mean
+            table.covariance[rows] = multi_covariance
+        else:
             for i, (mean, cov) in enumerate(zip(multi_mean, multi_covariance)):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
-        """Start a new tracklet"""
+    def activate(self, kalman_filter, frame_id, track_table=None):
+        """Start a new tracklet, its state is stored in track_table if one is given"""
         self.kalman_filter = kalman_filter
         self.track_id = self.next_id()
+        if track_table is not None:
+            track_table.attach(self)
         
         self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
 
@@ -79,11 +121,12 @@ class STrack(BaseTrack, MATrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False): #TODO kalamn update should be called with odom
+    def re_activate(self, new_track, frame_id, new_id=False, kalman_update=True): #TODO kalamn update should be called with odom
         #initialize the measurement mask to all trues with size 5
 
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh))
+        if kalman_update:
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh))
         self.tracklet_len = 0
         self.state = TrackState.Tracked
         self.is_activated = True
@@ -94,22 +137,22 @@ class STrack(BaseTrack, MATrack):
         self.cls = new_track.cls
 
 
-    def update(self, new_track, frame_id):
+    def update(self, new_track, frame_id, kalman_update=True):
         """
         Update a matched track
         :type new_track: STrack
         :type frame_id: int
-        :type update_feature: bool
+        :type kalman_update: bool, False if the state was already corrected by STrack.multi_update
         :return:
         """
         self.frame_id = frame_id
         self.tracklet_len += 1
         # self.cls = cls
-        measurement = self.tlwh_to_xyah(new_track.tlwh)
-        
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, measurement)
-        self.mean_history.append(self.mean)
+        if kalman_update:
+            measurement = self.tlwh_to_xyah(new_track.tlwh)
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, measurement)
+        self.mean_history.append(self.mean.copy())
         if new_track is not None:
             self.state = TrackState.Tracked
             self.is_activated = True
@@ -186,11 +229,15 @@ class STrack(BaseTrack, MATrack):
 
 
 class BYTETracker(MATracker):
-    def __init__(self, track_thresh=0.45, match_thresh=0.8, track_buffer=25, frame_rate=30, use_depth=False, use_odometry=False):
+    def __init__(self, track_thresh=0.45, match_thresh=0.8, track_buffer=25, frame_rate=30, use_depth=False, use_odometry=False,
+                 max_tracks=4096):
         super().__init__(use_depth, use_odometry)
         self.tracked_stracks = []  # type: list[STrack]
         self.lost_stracks = []  # type: list[STrack]
-        self.removed_stracks = []  # type: list[STrack]
+        # only the max_tracks most recently removed tracks are kept
+        self.removed_stracks = deque(maxlen=max_tracks)  # type: deque[STrack]
+        # the tracked and lost tracks live in the rows of the track table
+        self.track_table = TrackTable(max_capacity=max_tracks)
         self.frame_id = 0
         self.write_log = False
         self.track_buffer=track_buffer
@@ -298,14 +345,15 @@ class BYTETracker(MATracker):
         dists = matching.fuse_score(dists, detections)
         matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.match_thresh)
 
+        STrack.multi_update([strack_pool[i] for i, _ in matches], [detections[i] for _, i in matches])
         for itracked, idet in matches:
             track = strack_pool[itracked]
             det = detections[idet]
             if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
+                track.update(detections[idet], self.frame_id, kalman_update=False)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, kalman_update=False)
                 refind_stracks.append(track)
 
         ''' Step 3: Second association, with low score detection boxes'''
@@ -318,14 +366,15 @@ class BYTETracker(MATracker):
         r_tracked_stracks = [strack_pool[i] for i in u_track if strack_pool[i].state == TrackState.Tracked]
         dists = matching.iou_distance(r_tracked_stracks, detections_second)
         matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)
+        STrack.multi_update([r_tracked_stracks[i] for i, _ in matches], [detections_second[i] for _, i in matches])
         for itracked, idet in matches:
             track = r_tracked_stracks[itracked]
             det = detections_second[idet]
             if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
+                track.update(det, self.frame_id, kalman_update=False)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, kalman_update=False)
                 refind_stracks.append(track)
 
         for it in u_track:
@@ -342,8 +391,9 @@ class BYTETracker(MATracker):
         #if not self.args.mot20:
         dists = matching.fuse_score(dists, detections)
         matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)
+        STrack.multi_update([unconfirmed[i] for i, _ in matches], [detections[i] for _, i in matches])
         for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
+            unconfirmed[itracked].update(detections[idet], self.frame_id, kalman_update=False)
             activated_starcks.append(unconfirmed[itracked])
         for it in u_unconfirmed:
             track = unconfirmed[it]
@@ -355,8 +405,11 @@ class BYTETracker(MATracker):
             track = detections[inew]
             if track.score < self.det_thresh:
                 continue
-            track.activate(self.kalman_filter, self.frame_id)
+            track.activate(self.kalman_filter, self.frame_id, self.track_table)
             activated_starcks.append(track)
+        # tracks evicted from a full track table are removed like the expired ones
+        evicted = self.track_table.pop_evicted()
+        removed_stracks.extend(evicted)
         """ Step 5: Update state"""
         for track in self.lost_stracks:
             if self.frame_id - track.end_frame > self.max_time_lost:
@@ -377,15 +430,16 @@ class BYTETracker(MATracker):
         self.lost_stracks.extend(lost_stracks)
         self.lost_stracks = sub_stracks(self.lost_stracks, self.removed_stracks)
         self.removed_stracks.extend(removed_stracks)
+        if evicted:
+            self.tracked_stracks = sub_stracks(self.tracked_stracks, evicted)
+            self.lost_stracks = sub_stracks(self.lost_stracks, evicted)
         self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(self.tracked_stracks, self.lost_stracks)
+        # free the table rows of the removed and duplicate tracks
+        self.track_table.retain(self.tracked_stracks + self.lost_stracks)
+        self.track_table.compact()
         # get scores of lost tracks
         output_stracks = [track for track in self.tracked_stracks if track.is_activated]
         outputs = []
-        #copy self.lost_stracks and change the class of the tracks to -1
-        local_lost_stracks = copy.deepcopy(self.lost_stracks)
-        for track in local_lost_stracks:
-            track.cls = -1
-        test_all_stracks = joint_stracks(self.tracked_stracks, local_lost_stracks)
         for t in output_stracks:
             output= []
             tlwh = t.tlwh
@@ -87,6 +87,35 @@ class KalmanFilter(object):
         self.control_mat[0, 0] = robot_yaw_to_pixel_coeff*self.dt
         return self.control_mat
     
+    def calculate_multi_control_mat(self, mean):
+        """Vectorized version of `calculate_control_mat`. Returns the Nx8 matrix whose
+        rows are the transposed B matrices of the N tracks."""
+        u1 = mean[:, 0] - self.image_width/2
+        robot_yaw_to_pixel_coeff = (u1**2/self.focal_length**2 + 1)*self.focal_length
+        control_mat = np.zeros((len(mean), 2 * self.ndim))
+        control_mat[:, 0] = robot_yaw_to_pixel_coeff*self.dt
+        return control_mat
+
+    def calculate_multi_depth_control_mat(self, mean, control_signal):
+        """Vectorized version of `calculate_depth_control_mat`. Returns an Nx8 matrix, rows
+        of the tracks with no valid depth (control_signal[:, 2] == 0) are left zero."""
+        depth_control_mat = np.zeros((len(mean), 2 * self.ndim))
+        has_depth = control_signal[:, 2] != 0
+        if not np.any(has_depth):
+            return depth_control_mat
+        mean, depth = mean[has_depth], control_signal[has_depth, 2]
+        u1 = mean[:, 0] - self.image_width/2
+        v1 = mean[:, 1] - self.image_height/2
+        bottom_y = v1 + mean[:, 3]/2 #bottom right corner y wrt image center
+        u_coeff = u1*np.sqrt(u1**2 + self.focal_length**2)/(self.focal_length * depth)
+        v_coeff = v1*np.sqrt(v1**2 + self.focal_length**2)/(self.focal_length * depth)
+        h_coeff = (bottom_y*np.sqrt(bottom_y**2 + self.focal_length**2) - v1*np.sqrt(v1**2 + self.focal_length**2))\
+                   /(self.focal_length * depth)
+        depth_control_mat[has_depth, 0] = u_coeff
+        depth_control_mat[has_depth, 1] = v_coeff
+        depth_control_mat[has_depth, 3] = h_coeff
+        return depth_control_mat
+
     def calculate_depth_control_mat(self, mean, control_signal):
         if control_signal[2] == 0:
             return np.zeros((2 * self.ndim, 1))
@@ -268,25 +297,22 @@ class KalmanFilter(object):
             self._q4 * (mean[:, 3])]
         
         sqr = np.square(np.r_[std_pos, std_vel]).T
-        
-        for i in range(len(mean)):
-            this_motion_cov = np.diag(sqr[i])
-            this_motion_mat = self.calculate_motion_mat(mean[i])
-            this_control_mat = self.calculate_control_mat(mean[i])
-            mean_rot_applied = np.dot(control_signal[i][0], this_control_mat.T)[0]
-            depth_control_mat = self.calculate_depth_control_mat(mean[i], control_signal[i])
-            mean_trans_applied = np.dot(control_signal[i][1], depth_control_mat.T)[0]
-            if use_control_signal:
-                mean[i] = np.dot(mean[i], this_motion_mat.T) + mean_rot_applied + mean_trans_applied
-                # if np.sum(mean_rot_applied) > 20 or np.sum(mean_trans_applied) > 20:
-                # print("mean_rot_applied: ", mean_rot_applied[0])
-                # print("mean_trans_applied", mean_trans_applied[0:7].reshape(7,1))
-                covariance[i] = np.linalg.multi_dot((
-                    this_motion_mat, covariance[i], this_motion_mat.T)) + this_motion_cov
-            else:
-                mean[i] = np.dot(mean[i], this_motion_mat.T)
-                covariance[i] = np.linalg.multi_dot((
-                    this_motion_mat, covariance[i], this_motion_mat.T)) + this_motion_cov
+        # batched Q: one diagonal 8x8 noise matrix per track
+        motion_cov = np.zeros_like(covariance)
+        diag = np.arange(2 * self.ndim)
+        motion_cov[:, diag, diag] = sqr
+
+        this_motion_mat = self.calculate_motion_mat(mean) # F matrix, shared by all the tracks
+        if use_control_signal:
+            # B*u for the robot yaw rate and the forward translation (D_dot)
+            mean_rot_applied = control_signal[:, 0:1] * self.calculate_multi_control_mat(mean)
+            depth_control_mat = self.calculate_multi_depth_control_mat(mean, control_signal)
+            mean_trans_applied = control_signal[:, 1:2] * depth_control_mat
+            mean = np.dot(mean, this_motion_mat.T) + mean_rot_applied + mean_trans_applied
+        else:
+            mean = np.dot(mean, this_motion_mat.T)
+        # P_pred = F * P * F.T + Q for all the tracks at once
+        covariance = np.matmul(this_motion_mat, np.matmul(covariance, this_motion_mat.T)) + motion_cov
 
         return mean, covariance
 
@@ -340,6 +366,71 @@ class KalmanFilter(object):
 
         return new_mean, new_covariance
     
+    def multi_project(self, mean, covariance):
+        """Project state distributions to measurement space (Vectorized version).
+
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional mean matrix of the object states.
+        covariance : ndarray
+            The Nx8x8 dimensional covariance matrices of the object states.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the Nx4 projected means and Nx4x4 innovation covariances.
+
+        """
+        std = np.stack([
+            self._r1 * mean[:, 3],
+            self._r1 * mean[:, 3],
+            1e-1 * np.ones_like(mean[:, 3]),
+            self._r1 * mean[:, 3]], axis=1)
+        innovation_cov = np.zeros((len(mean), self.ndim, self.ndim))
+        diag = np.arange(self.ndim)
+        innovation_cov[:, diag, diag] = np.square(std)
+
+        mean = np.dot(mean, self._update_mat.T)
+        covariance = np.matmul(self._update_mat, np.matmul(covariance, self._update_mat.T))
+        return mean, covariance + innovation_cov
+
+    def multi_update(self, mean, covariance, measurement):
+        """Run Kalman filter correction step for N tracks at once.
+
+        The Kalman gain is obtained from one batched Cholesky solve of the
+        innovation covariances instead of N explicit matrix inversions.
+
+        Parameters
+        ----------
+        mean : ndarray
+            The Nx8 dimensional predicted mean matrix.
+        covariance : ndarray
+            The Nx8x8 dimensional predicted covariance matrices.
+        measurement : ndarray
+            The Nx4 dimensional measurement matrix, each row in format
+            (x, y, a, h).
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Returns the measurement-corrected state distributions.
+
+        """
+        projected_mean, projected_cov = self.multi_project(mean, covariance)
+        PHT = np.matmul(covariance, self._update_mat.T)
+        # S * K.T = (P * H.T).T, solved as L * L.T * K.T = (P * H.T).T
+        chol_factor = np.linalg.cholesky(projected_cov)
+        z = np.linalg.solve(chol_factor, np.swapaxes(PHT, 1, 2))
+        kalman_gain = np.swapaxes(np.linalg.solve(np.swapaxes(chol_factor, 1, 2), z), 1, 2)
+        innovation = measurement - projected_mean
+
+        new_mean = mean + np.einsum('nij,nj->ni', kalman_gain, innovation)
+        # simplified covariance update equation: (I - K * H) * P = P - K * (H * P)
+        new_covariance = covariance - np.matmul(kalman_gain, np.matmul(self._update_mat, covariance))
+
+        return new_mean, new_covariance
+
     def update_dummy(self, mean, covariance, yaw_dot): #FIXME: this is a dummy update function
         mean[4:] = 1/(5+1000*yaw_dot) * mean[4:]
         mean[5] = 1/(10+1000*yaw_dot) * mean[5]
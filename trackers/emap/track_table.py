@@ -0,0 +1,160 @@
+import numpy as np
+
+from trackers.emap.basetrack import TrackState
+
+
+class TrackField(object):
+    """
+    STrack attribute that lives in the TrackTable row of the track once the track is
+    activated, and in the track instance itself before that (plain detections) or
+    after its row has been released.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.local_name = '_local_' + name
+
+    def __get__(self, track, owner=None):
+        if track is None:
+            return self
+        if track._row is None:
+            return track.__dict__.get(self.local_name, self.default)
+        return getattr(track._table, self.name)[track._row]
+
+    def __set__(self, track, value):
+        if track._row is None:
+            track.__dict__[self.local_name] = value
+        else:
+            getattr(track._table, self.name)[track._row] = value
+
+
+class TrackTable(object):
+    """
+    Structure-of-arrays storage of the live EMAP tracks.
+
+    Every activated STrack owns one row of the preallocated mean[N,8], covariance[N,8,8],
+    state, score, cls, frame_id and start_frame arrays, so the Kalman filter can gather
+    and scatter the states of all the tracks with a single fancy-indexing operation.
+    Freed rows are recycled through a free-list, the arrays grow by doubling up to the
+    hard `max_capacity` limit and shrink back in `compact` once most rows are unused.
+    At the limit, the track that was lost the longest ago (or, without lost tracks, the
+    least recently updated one) is evicted to make room, so a long session never fails;
+    the tracker collects the evicted tracks with `pop_evicted`.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of rows allocated up front.
+    max_capacity : int
+        Hard limit on the number of live tracks, allocating past it evicts a track.
+    ndim : int
+        Dimension of the Kalman filter state.
+
+    """
+    fields = ('mean', 'covariance', 'state', 'score', 'cls', 'frame_id', 'start_frame')
+
+    def __init__(self, capacity=64, max_capacity=4096, ndim=8):
+        self.initial_capacity = min(capacity, max_capacity)
+        self.max_capacity = max_capacity
+        self.ndim = ndim
+        self._allocate_arrays(self.initial_capacity)
+        self.owners = [None] * self.capacity
+        self._free = list(range(self.capacity - 1, -1, -1))
+        self.evicted = []
+
+    def _allocate_arrays(self, capacity):
+        self.capacity = capacity
+        self.mean = np.zeros((capacity, self.ndim))
+        self.covariance = np.zeros((capacity, self.ndim, self.ndim))
+        self.state = np.full(capacity, TrackState.Removed, dtype=np.int8)
+        self.score = np.zeros(capacity)
+        self.cls = np.zeros(capacity)
+        self.frame_id = np.zeros(capacity, dtype=np.int64)
+        self.start_frame = np.zeros(capacity, dtype=np.int64)
+        self.in_use = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.in_use))
+
+    def _resize(self, capacity, rows):
+        """Move `rows` to the front of freshly allocated arrays of the given capacity"""
+        old = {name: getattr(self, name) for name in self.fields}
+        owners = [self.owners[row] for row in rows]
+        self._allocate_arrays(capacity)
+        for name in self.fields:
+            getattr(self, name)[:len(rows)] = old[name][rows]
+        self.in_use[:len(rows)] = True
+        self.owners = owners + [None] * (capacity - len(rows))
+        for new_row, track in enumerate(owners):
+            track._row = new_row
+        self._free = list(range(capacity - 1, len(rows) - 1, -1))
+
+    def attach(self, track):
+        """Give the track a row and move its current attribute values into it"""
+        if not self._free:
+            if self.capacity >= self.max_capacity:
+                self._evict()
+            else:
+                self._resize(min(2 * self.capacity, self.max_capacity), np.flatnonzero(self.in_use))
+        values = {name: getattr(track, name) for name in self.fields}
+        row = self._free.pop()
+        self.in_use[row] = True
+        self.owners[row] = track
+        track._table, track._row = self, row
+        for name, value in values.items():
+            if value is None:
+                getattr(self, name)[row] = 0
+            else:
+                setattr(track, name, value)
+        return row
+
+    def release(self, track):
+        """Copy the row of the track back into the track instance and free the row"""
+        row = track._row
+        values = {name: getattr(self, name)[row].copy() for name in self.fields}
+        track._table, track._row = None, None
+        for name, value in values.items():
+            setattr(track, name, value)
+        self.in_use[row] = False
+        self.state[row] = TrackState.Removed
+        self.owners[row] = None
+        self._free.append(row)
+
+    def _evict(self):
+        """Release the row of the oldest lost track, or of the least recently updated one, and mark it removed"""
+        rows = np.flatnonzero(self.in_use & (self.state == TrackState.Lost))
+        if len(rows) == 0:
+            rows = np.flatnonzero(self.in_use)
+        track = self.owners[rows[np.argmin(self.frame_id[rows])]]
+        self.release(track)
+        track.mark_removed()
+        self.evicted.append(track)
+
+    def pop_evicted(self):
+        """Return and forget the tracks evicted since the last call"""
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    def retain(self, stracks):
+        """Release the rows of all the tracks that are not in stracks"""
+        live = np.zeros(self.capacity, dtype=bool)
+        live[[t._row for t in stracks if t._table is self]] = True
+        for row in np.flatnonzero(self.in_use & ~live):
+            self.release(self.owners[row])
+
+    def compact(self):
+        """Shrink the arrays once less than a quarter of the rows are in use"""
+        rows = np.flatnonzero(self.in_use)
+        if self.capacity > self.initial_capacity and len(rows) < self.capacity // 4:
+            self._resize(max(self.initial_capacity, self.capacity // 2), rows)
+
+    @staticmethod
+    def rows_of(stracks):
+        """Return (table, rows) if all the stracks live in the same table, otherwise (None, None)"""
+        table = stracks[0]._table
+        if table is None or any(t._table is not table for t in stracks):
+            return None, None
+        return table, np.fromiter((t._row for t in stracks), dtype=np.intp, count=len(stracks))
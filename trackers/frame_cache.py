@@ -0,0 +1,137 @@
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FrameCache(object):
+    """
+    Bounded LRU cache of per-frame results, e.g. the CMC affines and the ReID embeddings of the
+    detections, backed by an append-only file so that offline re-runs of a sequence read them
+    back instead of computing them again.
+
+    The keys hold the content digest of the frame and of the inputs the result depends on, see
+    `key`, so a live run never reads back the result of another frame. Every `put` appends a
+    (key, value) record to the file, flushed every flush_interval seconds so that a crashed run
+    keeps its records; at load the last record of a key wins. The least recently
+    used entries are evicted once the pickled values exceed max_bytes, and the file is rewritten
+    with the live entries once it grows past twice that size.
+
+    Parameters
+    ----------
+    path : str or None
+        File of the records, None keeps the cache in memory only.
+    max_bytes : int
+        Size cap of the pickled values.
+    flush_interval : float
+        Seconds after which a put flushes the appended records to the file.
+
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 2 ** 20, flush_interval=1.):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            if os.path.exists(path):
+                self._load()
+
+    @staticmethod
+    def digest(*arrays, prev="", stride=8):
+        """
+        Content hash of the arrays, chained to the prev digest. Images are sampled every stride
+        rows and columns, hashing a 1080p frame takes about 0.3ms.
+        """
+        h = hashlib.blake2b(prev.encode(), digest_size=16)
+        for a in arrays:
+            a = np.asarray(a)
+            if a.ndim >= 2 and a.dtype == np.uint8:
+                a = a[::stride, ::stride]
+            h.update(str((a.shape, a.dtype.str)).encode())
+            h.update(np.ascontiguousarray(a).data)
+        return h.hexdigest()
+
+    def key(self, tag, *arrays, prev=""):
+        """Key of the result of the arrays, tag e.g. "<sequence>:<frame>" names the frame"""
+        return f"{tag}:{self.digest(*arrays, prev=prev)}"
+
+    def _load(self):
+        with open(self.path, "r+b") as fp:
+            while True:
+                start = fp.tell()
+                try:
+                    key, value = pickle.load(fp)
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                    break  # end of the file or a record cut short by a crash
+                self._insert(key, value, fp.tell() - start)
+            fp.truncate(start)  # the next records are appended after the last complete one
+
+    def _insert(self, key, value, size):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        record = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        self._insert(key, value, len(record))
+        if self.path is None:
+            return
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        self._file.write(record)
+        if self._file.tell() > 2 * self.max_bytes:
+            self.compact()
+        elif time.monotonic() - self.last_flush >= self.flush_interval:
+            self.dump()
+
+    def compact(self):
+        """Rewrite the file with the live entries only, oldest first"""
+        if self.path is None:
+            return
+        self.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fp:
+            for key, (value, _) in self.entries.items():
+                pickle.dump((key, value), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def dump(self):
+        """Flush the appended records to the file"""
+        self.last_flush = time.monotonic()
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def summary(self):
+        return f"{len(self)} entries, {self.nbytes / 2 ** 20:.1f}MB, {self.hits} hits, {self.misses} misses"
@@ -0,0 +1,111 @@
+"""
+Broadcasting IoU, GIoU and DIoU kernels shared by all the trackers.
+
+All the kernels take an (N, >=4) and a (K, >=4) array of boxes in (x1, y1, x2, y2)
+format and return the (N, K) pairwise overlap matrix. The result is written into
+`out` when a preallocated buffer is given. `offset` is added to every box side; the
+ByteTrack family of trackers uses the pixel-inclusive convention (offset=1) of the
+original cython_bbox implementation, SORT/OC-SORT use continuous coordinates (offset=0).
+"""
+import numpy as np
+
+
+def _intersection(boxes, query_boxes, offset):
+    b = boxes[:, None, :]
+    q = query_boxes[None, :, :]
+    w = np.minimum(b[..., 2], q[..., 2]) - np.maximum(b[..., 0], q[..., 0]) + offset
+    h = np.minimum(b[..., 3], q[..., 3]) - np.maximum(b[..., 1], q[..., 1]) + offset
+    np.maximum(w, 0., out=w)
+    np.maximum(h, 0., out=h)
+    w *= h
+    return w
+
+
+def _area(boxes, offset):
+    return (boxes[:, 2] - boxes[:, 0] + offset) * (boxes[:, 3] - boxes[:, 1] + offset)
+
+
+def _prepare(boxes, query_boxes, out):
+    if out is not None:
+        dtype = out.dtype
+    else:
+        dtype = np.result_type(np.asarray(boxes).dtype, np.asarray(query_boxes).dtype, np.float32)
+    boxes = np.asarray(boxes, dtype=dtype)
+    query_boxes = np.asarray(query_boxes, dtype=dtype)
+    if boxes.size == 0:
+        boxes = boxes.reshape(0, 4)
+    if query_boxes.size == 0:
+        query_boxes = query_boxes.reshape(0, 4)
+    if out is None:
+        out = np.empty((len(boxes), len(query_boxes)), dtype=dtype)
+    return boxes, query_boxes, out
+
+
+def _iou(boxes, query_boxes, out, offset):
+    inter = _intersection(boxes, query_boxes, offset)
+    union = _area(boxes, offset)[:, None] + _area(query_boxes, offset)[None, :] - inter
+    out.fill(0)
+    np.divide(inter, union, out=out, where=inter > 0)
+    return out, inter
+
+
+def _enclosing_box(boxes, query_boxes, offset):
+    b = boxes[:, None, :]
+    q = query_boxes[None, :, :]
+    wc = np.maximum(b[..., 2], q[..., 2]) - np.minimum(b[..., 0], q[..., 0]) + offset
+    hc = np.maximum(b[..., 3], q[..., 3]) - np.minimum(b[..., 1], q[..., 1]) + offset
+    return wc, hc
+
+
+def box_iou(boxes, query_boxes, out=None, offset=0.):
+    """
+    Parameters
+    ----------
+    boxes: (N, 4) ndarray of float
+    query_boxes: (K, 4) ndarray of float
+    out: optional (N, K) ndarray the overlaps are written into
+    offset: float added to the width and height of every box
+    Returns
+    -------
+    overlaps: (N, K) ndarray of IoU between boxes and query_boxes
+    """
+    boxes, query_boxes, out = _prepare(boxes, query_boxes, out)
+    if out.size == 0:
+        return out
+    return _iou(boxes, query_boxes, out, offset)[0]
+
+
+def box_giou(boxes, query_boxes, out=None, offset=0.):
+    """
+    Generalized IoU, see https://arxiv.org/pdf/1902.09630.pdf. Values are in (-1, 1].
+    """
+    boxes, query_boxes, out = _prepare(boxes, query_boxes, out)
+    if out.size == 0:
+        return out
+    iou, inter = _iou(boxes, query_boxes, np.empty_like(out), offset)
+    wc, hc = _enclosing_box(boxes, query_boxes, offset)
+    assert((wc > 0).all() and (hc > 0).all())
+    area_enclose = wc * hc
+    np.subtract(iou, (area_enclose - inter) / area_enclose, out=out)
+    return out
+
+
+def box_diou(boxes, query_boxes, out=None, offset=0.):
+    """
+    Distance IoU, see https://arxiv.org/pdf/1911.08287.pdf. Values are in (-1, 1].
+    """
+    boxes, query_boxes, out = _prepare(boxes, query_boxes, out)
+    if out.size == 0:
+        return out
+    iou, _ = _iou(boxes, query_boxes, np.empty_like(out), offset)
+    b = boxes[:, None, :]
+    q = query_boxes[None, :, :]
+    centerx1 = (b[..., 0] + b[..., 2]) / 2.0
+    centery1 = (b[..., 1] + b[..., 3]) / 2.0
+    centerx2 = (q[..., 0] + q[..., 2]) / 2.0
+    centery2 = (q[..., 1] + q[..., 3]) / 2.0
+    inner_diag = (centerx1 - centerx2) ** 2 + (centery1 - centery2) ** 2
+    wc, hc = _enclosing_box(boxes, query_boxes, offset)
+    outer_diag = wc ** 2 + hc ** 2
+    np.subtract(iou, inner_diag / outer_diag, out=out)
+    return out
@@ -1,6 +1,7 @@
 from trackers.strongsort.utils.parser import get_config
 
-def create_tracker(tracker_type, tracker_config, reid_weights, device, half, use_depth = True, use_odometry = True):
+def create_tracker(tracker_type, tracker_config, reid_weights, device, half, use_depth = True, use_odometry = True, sequence = "live", cache = True):
+    # sequence names the frames in the keys of the Deep OC-SORT caches, cache False keeps them in memory only (live runs)
     try:
         cfg = get_config()
         cfg.merge_from_file(tracker_config)
@@ -84,7 +85,9 @@ def create_tracker(tracker_type, tracker_config, reid_weights, device, half, use
             frame_rate=cfg.botsort.frame_rate,
             lambda_=cfg.botsort.lambda_,
             use_depth=use_depth,
-            use_odometry=use_odometry
+            use_odometry=use_odometry,
+            appearance_on_demand=cfg.botsort.appearance_on_demand,
+            emb_refresh_stride=cfg.botsort.emb_refresh_stride
         )
         return botsort
     elif tracker_type == 'deepocsort':
@@ -101,7 +104,13 @@ def create_tracker(tracker_type, tracker_config, reid_weights, device, half, use
             asso_func=cfg.deepocsort.asso_func,
             inertia=cfg.deepocsort.inertia,
             use_depth=use_depth,
-            use_odometry=use_odometry
+            use_odometry=use_odometry,
+            appearance_on_demand=cfg.deepocsort.appearance_on_demand,
+            emb_refresh_stride=cfg.deepocsort.emb_refresh_stride,
+            cmc_downscale=cfg.deepocsort.cmc_downscale,
+            cmc_max_corners=cfg.deepocsort.cmc_max_corners,
+            sequence=sequence,
+            **({} if cache else dict(embedding_cache_path=None, cmc_cache_path=None))
         )
         return botsort
     else:
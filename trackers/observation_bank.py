@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class ObservationBank(object):
+    """
+    Fixed-depth ring buffers of the most recent observations of the OC-SORT style tracks.
+
+    Every track owns a row holding its last `depth` observed boxes with the track age at
+    which they were observed, which replaces the ever growing observations dict and
+    history_observations list of the tracks. The depth must cover the velocity window
+    (delta_t) and the head padding of the tracker (min_hits), see `depth_for`. The boxes
+    keep the dtype of the first observation, so the results match the former lists of
+    detection rows. Freed rows are recycled through a free-list and the arrays grow by
+    doubling, like the KalmanBoxBank of OC-SORT.
+
+    Parameters
+    ----------
+    depth : int
+        Number of observations kept per track.
+    dim : int
+        Length of an observation, [x1, y1, x2, y2, score].
+    capacity : int
+        Number of rows allocated up front.
+
+    """
+    # age of the empty slots, never inside a window of ages
+    EMPTY = np.iinfo(np.int64).min // 2
+
+    def __init__(self, depth, dim=5, capacity=64):
+        self.depth, self.dim = max(1, int(depth)), dim
+        self.capacity = 0
+        self.boxes = None  # allocated with the dtype of the first observation
+        self.ages = np.zeros((0, self.depth), dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.in_use = np.zeros(0, dtype=bool)
+        self._free = []
+        self._grow(capacity)
+
+    @staticmethod
+    def depth_for(delta_t, min_hits=0):
+        """Depth covering the delta_t + 1 ages of the velocity window and the min_hits observations of the head padding"""
+        return max(delta_t + 1, min_hits)
+
+    def _grow(self, capacity):
+        ages, count, in_use = self.ages, self.count, self.in_use
+        self.ages = np.full((capacity, self.depth), self.EMPTY, dtype=np.int64)
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.in_use = np.zeros(capacity, dtype=bool)
+        self.ages[:self.capacity], self.count[:self.capacity], self.in_use[:self.capacity] = ages, count, in_use
+        if self.boxes is not None:
+            boxes = self.boxes
+            self.boxes = np.zeros((capacity, self.depth, self.dim), dtype=boxes.dtype)
+            self.boxes[:self.capacity] = boxes
+        self._free = list(range(capacity - 1, self.capacity - 1, -1)) + self._free
+        self.capacity = capacity
+
+    def attach(self):
+        """Allocate the empty row of a new track"""
+        if not self._free:
+            self._grow(max(1, 2 * self.capacity))
+        row = self._free.pop()
+        self.in_use[row] = True
+        self.ages[row] = self.EMPTY
+        self.count[row] = 0
+        return row
+
+    def release(self, row):
+        self.in_use[row] = False
+        self._free.append(row)
+
+    def retain(self, rows):
+        """Release all the rows that are not in rows"""
+        live = np.zeros(self.capacity, dtype=bool)
+        live[rows] = True
+        for row in np.flatnonzero(self.in_use & ~live):
+            self.release(row)
+
+    def add(self, row, age, bbox):
+        """Record the box observed at the given track age"""
+        if self.boxes is None:
+            self.boxes = np.zeros((self.capacity, self.depth, self.dim), dtype=np.asarray(bbox).dtype)
+        slot = self.count[row] % self.depth
+        self.boxes[row, slot] = bbox
+        self.ages[row, slot] = age
+        self.count[row] += 1
+
+    def __len__(self):
+        return int(np.count_nonzero(self.in_use))
+
+    def recent(self, row, k=0):
+        """The k-th previous observation of the row, 0 being the last one, with k < depth"""
+        return self.boxes[row, (self.count[row] - 1 - k) % self.depth].copy()
+
+    def _placeholder(self, n, missing):
+        dtype = np.array([-1]).dtype if self.boxes is None else self.boxes.dtype
+        if np.any(missing):
+            # same promotion as an array of the boxes and the integer placeholders
+            dtype = np.result_type(dtype, np.array([-1]).dtype)
+        return np.full((n, self.dim), -1, dtype=dtype)
+
+    def k_previous_obs(self, rows, cur_ages, k):
+        """
+        Observation of every row k steps before its current age: the oldest observation made
+        in the last k ages or else the last one, [-1, -1, -1, -1, -1] for the rows without any
+        observation. Returns an (n, dim) array.
+        """
+        rows = np.asarray(rows, dtype=np.intp).reshape(-1)
+        missing = self.count[rows] == 0
+        out = self._placeholder(len(rows), missing)
+        if len(rows) == 0 or np.all(missing):
+            return out
+        ages = self.ages[rows]
+        cur_ages = np.asarray(cur_ages, dtype=np.int64).reshape(-1, 1)
+        in_window = (ages >= cur_ages - k) & (ages < cur_ages)
+        oldest = np.argmin(np.where(in_window, ages, np.iinfo(np.int64).max), axis=1)
+        last = (self.count[rows] - 1) % self.depth
+        slots = np.where(np.any(in_window, axis=1), oldest, last)
+        found = ~missing
+        out[found] = self.boxes[rows[found], slots[found]]
+        return out
+
+    def apply_affine(self, row, m, t, min_age, max_age, last=False):
+        """
+        Apply the camera motion compensation x' = m x + t to the corners of the observations of
+        the row made between min_age and max_age, and once more to the last observation if last
+        is set, like the in-place corrections of the shared observation arrays of Deep OC-SORT.
+        """
+        if self.count[row] == 0:
+            return
+        slots = list(np.flatnonzero((self.ages[row] >= min_age) & (self.ages[row] <= max_age)))
+        if last:
+            slots.insert(0, (self.count[row] - 1) % self.depth)
+        for slot in slots:
+            ps = self.boxes[row, slot, :4].reshape(2, 2).T
+            ps = m @ ps + t
+            self.boxes[row, slot, :4] = ps.T.reshape(-1)
@@ -344,7 +344,7 @@ class KalmanFilterNew(object):
     def calculate_control_mat(self, mean):
         u1 = mean[0] - self.image_width/2
         robot_yaw_to_pixel_coeff = (u1**2/self.focal_length**2 + 1)*self.focal_length
-        self.control_mat[0, 0] = robot_yaw_to_pixel_coeff*self.dt
+        self.control_mat[0] = robot_yaw_to_pixel_coeff*self.dt
         return self.control_mat
     
     def calculate_depth_control_mat(self, mean, control_signal):
@@ -365,9 +365,9 @@ class KalmanFilterNew(object):
         
         
         depth_control_mat = np.zeros((7, 1))
-        depth_control_mat[0, 0] = u_coeff
-        depth_control_mat[1, 0] = v_coeff
-        depth_control_mat[2, 0] = w_coeff*h_coeff
+        depth_control_mat[0] = u_coeff
+        depth_control_mat[1] = v_coeff
+        depth_control_mat[2] = w_coeff*h_coeff
         
           #0#h_coeff FIXME: this is not correct, this is not h_coeff because the state definition here is not x, y, w, h
         return depth_control_mat
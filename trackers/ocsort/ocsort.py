@@ -9,18 +9,8 @@ from yolov8.ultralytics.yolo.utils.ops import xywh2xyxy
 from collections import deque
 import copy
 from ..MATracker import MATracker, MATrack
-
-
-
-def k_previous_obs(observations, cur_age, k):
-    if len(observations) == 0:
-        return [-1, -1, -1, -1, -1]
-    for i in range(k):
-        dt = k - i
-        if cur_age - dt in observations:
-            return observations[cur_age-dt]
-    max_age = max(observations.keys())
-    return observations[max_age]
+from .state_bank import KalmanBoxBank, KalmanBoxFilter
+from ..observation_bank import ObservationBank
 
 
 def convert_bbox_to_z(bbox):
@@ -51,6 +41,15 @@ def convert_x_to_bbox(x, score=None):
       return np.array([x[0]-w/2., x[1]-h/2., x[0]+w/2., x[1]+h/2., score]).reshape((1, 5))
 
 
+def convert_x_to_bboxes(x):
+    """
+    Batched convert_x_to_bbox, takes the (N, 7) states and returns the (N, 4) boxes [x1,y1,x2,y2]
+    """
+    w = np.sqrt(x[:, 2] * x[:, 3])
+    h = x[:, 2] / w
+    return np.stack([x[:, 0]-w/2., x[:, 1]-h/2., x[:, 0]+w/2., x[:, 1]+h/2.], axis=1)
+
+
 def speed_direction(bbox1, bbox2):
     cx1, cy1 = (bbox1[0]+bbox1[2]) / 2.0, (bbox1[1]+bbox1[3])/2.0
     cx2, cy2 = (bbox2[0]+bbox2[2]) / 2.0, (bbox2[1]+bbox2[3])/2.0
@@ -66,32 +65,25 @@ class KalmanBoxTracker(MATrack):
     count = 0
 
 
-    def __init__(self, bbox, cls, delta_t=3, orig=False):
+    def __init__(self, bbox, cls, delta_t=3, bank=None, observation_bank=None):
         """
         Initialises a tracker using initial bounding box.
+        The constant velocity Kalman filter of the track lives in a row of the KalmanBoxBank
+        and its recent observations in a row of the ObservationBank shared by all the tracks
+        of an OCSort instance.
 
         """
 
         # define constant velocity model
         super().__init__()
-        if not orig:
-          from .kalmanfilter import KalmanFilterNew as KalmanFilter
-          self.kf = KalmanFilter(dim_x=7, dim_z=4)
-        else:
-          from filterpy.kalman import KalmanFilter
-          self.kf = KalmanFilter(dim_x=7, dim_z=4)
-        self.kf.F = np.array([[1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1], [
-                            0, 0, 0, 1, 0, 0, 0],  [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]])
-        self.kf.H = np.array([[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0],
-                            [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]])
-
-        self.kf.R[2:, 2:] *= 10.
-        self.kf.P[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
-        self.kf.P *= 10.
-        self.kf.Q[-1, -1] *= 0.01
-        self.kf.Q[4:, 4:] *= 0.01
-
-        self.kf.x[:4] = convert_bbox_to_z(bbox)
+        if bank is None:
+          bank = KalmanBoxBank(capacity=1)
+        if observation_bank is None:
+          observation_bank = ObservationBank(ObservationBank.depth_for(delta_t), capacity=1)
+        self.kf = KalmanBoxFilter(bank, convert_bbox_to_z(bbox))
+        self.observations = observation_bank
+        self.obs_row = observation_bank.attach()
+
         self.time_since_update = 0
         self.id = KalmanBoxTracker.count
         KalmanBoxTracker.count += 1
@@ -105,71 +97,96 @@ class KalmanBoxTracker(MATrack):
         """
         NOTE: [-1,-1,-1,-1,-1] is a compromising placeholder for non-observation status, the same for the return of 
         function k_previous_obs. It is ugly and I do not like it. But to support generate observation array in a 
-        fast and unified way, which you would see below k_observations = np.array([k_previous_obs(...]]), let's bear it for now.
+        fast and unified way, which you would see below k_observations = ObservationBank.k_previous_obs(...), let's bear it for now.
         """
         self.last_observation = np.array([-1, -1, -1, -1, -1])  # placeholder
-        self.observations = dict()
-        self.history_observations = []
         self.velocity = None
         self.delta_t = delta_t
 
-    def update(self, bbox, cls):
+    def update(self, bbox, cls, kalman_update=True):
         """
         Updates the state vector with observed bbox.
+        With kalman_update=False only the track bookkeeping is done and the Kalman correction
+        is left to a later KalmanBoxTracker.multi_update call.
         """
         
         if bbox is not None:
             self.conf = bbox[-1]
             self.cls = cls
             if self.last_observation.sum() >= 0:  # no previous observation
-                previous_box = None
-                for i in range(self.delta_t):
-                    dt = self.delta_t - i
-                    if self.age - dt in self.observations:
-                        previous_box = self.observations[self.age-dt]
-                        break
-                if previous_box is None:
-                    previous_box = self.last_observation
+                # the oldest observation of the last delta_t steps, else the last one
+                previous_box = self.observations.k_previous_obs([self.obs_row], [self.age], self.delta_t)[0]
                 """
                   Estimate the track speed direction with observations \Delta t steps away
                 """
                 self.velocity = speed_direction(previous_box, bbox)
             
             """
-              Insert new observations. This is a ugly way to maintain both self.observations
-              and self.history_observations. Bear it for the moment.
+              Insert new observations, only the last ones are kept in the ring buffer of the track.
             """
             self.last_observation = bbox
-            self.observations[self.age] = bbox
-            self.history_observations.append(bbox)
+            self.observations.add(self.obs_row, self.age, bbox)
 
             self.time_since_update = 0
             self.history = []
             self.hits += 1
             self.hit_streak += 1
-            self.kf.update(convert_bbox_to_z(bbox))
+            if kalman_update:
+                self.kf.update(convert_bbox_to_z(bbox))
+            else:
+                self.kf.observe(convert_bbox_to_z(bbox))
         else:
             self.kf.update(bbox)
 
+    @staticmethod
+    def multi_update(trackers, bboxes):
+        """
+        Kalman correction of all the trackers at once with their observed bboxes,
+        after their bookkeeping was done by update(bbox, cls, kalman_update=False).
+        """
+        if len(trackers) == 0:
+            return
+        z = np.array([convert_bbox_to_z(bbox) for bbox in bboxes])
+        KalmanBoxFilter.multi_reupdate([trk.kf for trk in trackers])
+        trackers[0].kf.bank.update([trk.kf.row for trk in trackers], z)
+
     def predict(self):
         """
         Advances the state vector and returns the predicted bounding box estimate.
         """
-        if((self.kf.x[6]+self.kf.x[2]) <= 0):
-            self.kf.x[6] *= 0.0
-        
+        return KalmanBoxTracker.multi_predict([self])[:1]
+
+    @staticmethod
+    def multi_predict(trackers):
+        """
+        Advances the state vectors of all the trackers at once and returns their (N, 4)
+        predicted bounding boxes. The trackers must share the same KalmanBoxBank.
+        """
+        if len(trackers) == 0:
+            return np.empty((0, 4))
+        bank = trackers[0].kf.bank
+        rows = np.fromiter((trk.kf.row for trk in trackers), dtype=np.intp, count=len(trackers))
+        x = bank.x[rows]
+        stop = rows[(x[:, 6]+x[:, 2]) <= 0]
+        bank.x[stop, 6] *= 0.0
+
         #if KalmanBoxTracker has attributes current_yaw_dot and current_D_dot then use them as control input
         if hasattr(KalmanBoxTracker, 'current_yaw_dot') and hasattr(KalmanBoxTracker, 'current_D_dot'):
-            control_input = np.array([KalmanBoxTracker.current_yaw_dot, KalmanBoxTracker.current_D_dot, self.get_d1()])
+            control_input = np.zeros((len(trackers), 3))
+            control_input[:, 0] = KalmanBoxTracker.current_yaw_dot
+            control_input[:, 1] = KalmanBoxTracker.current_D_dot
+            control_input[:, 2] = KalmanBoxTracker.multi_get_d1(trackers)
         else:
             control_input = None
-        self.kf.predict(control_input = control_input)
-        self.age += 1
-        if(self.time_since_update > 0):
-            self.hit_streak = 0
-        self.time_since_update += 1
-        self.history.append(convert_x_to_bbox(self.kf.x))
-        return self.history[-1]
+        bank.predict(rows, control_input)
+        boxes = convert_x_to_bboxes(bank.x[rows])
+        for trk, box in zip(trackers, boxes):
+            trk.age += 1
+            if(trk.time_since_update > 0):
+                trk.hit_streak = 0
+            trk.time_since_update += 1
+            trk.history.append(box[None])
+        return boxes
 
     def get_state(self):
         """
@@ -216,6 +233,8 @@ class OCSort(MATracker):
         self.asso_func = ASSO_FUNCS[asso_func]
         self.inertia = inertia
         self.use_byte = use_byte
+        self.bank = KalmanBoxBank()
+        self.observation_bank = ObservationBank(ObservationBank.depth_for(delta_t, min_hits))
         KalmanBoxTracker.count = 0
     
     def update(self, dets, _, depth_image = None, odom = None, masks = None):
@@ -251,13 +270,9 @@ class OCSort(MATracker):
 
         # get predicted locations from existing trackers.
         trks = np.zeros((len(self.trackers), 5))
-        to_del = []
         ret = []
-        for t, trk in enumerate(trks):
-            pos = self.trackers[t].predict()[0]
-            trk[:] = [pos[0], pos[1], pos[2], pos[3], 0]
-            if np.any(np.isnan(pos)):
-                to_del.append(t)
+        trks[:, :4] = KalmanBoxTracker.multi_predict(self.trackers)
+        to_del = np.flatnonzero(np.any(np.isnan(trks[:, :4]), axis=1))
         trks = np.ma.compress_rows(np.ma.masked_invalid(trks))
         for t in reversed(to_del):
             self.trackers.pop(t)
@@ -265,16 +280,20 @@ class OCSort(MATracker):
         velocities = np.array(
             [trk.velocity if trk.velocity is not None else np.array((0, 0)) for trk in self.trackers])
         last_boxes = np.array([trk.last_observation for trk in self.trackers])
-        k_observations = np.array(
-            [k_previous_obs(trk.observations, trk.age, self.delta_t) for trk in self.trackers])
+        k_observations = self.observation_bank.k_previous_obs(
+            [trk.obs_row for trk in self.trackers], [trk.age for trk in self.trackers], self.delta_t)
 
         """
             First round of association
         """
         matched, unmatched_dets, unmatched_trks = associate(
             dets, trks, self.iou_threshold, velocities, k_observations, self.inertia)
+        # the Kalman corrections of all the matched trackers run in one batch after the association
+        updated, measurements = [], []
         for m in matched:
-            self.trackers[m[1]].update(dets[m[0], :5], dets[m[0], 5])
+            self.trackers[m[1]].update(dets[m[0], :5], dets[m[0], 5], kalman_update=False)
+            updated.append(self.trackers[m[1]])
+            measurements.append(dets[m[0], :5])
 
         """
             Second round of associaton by OCR
@@ -290,15 +309,16 @@ class OCSort(MATracker):
                     get a higher performance especially on MOT17/MOT20 datasets. But we keep it
                     uniform here for simplicity
                 """
-                matched_indices = linear_assignment(-iou_left)
-                to_remove_trk_indices = []
-                for m in matched_indices:
-                    det_ind, trk_ind = m[0], unmatched_trks[m[1]]
-                    if iou_left[m[0], m[1]] < self.iou_threshold:
-                        continue
-                    self.trackers[trk_ind].update(dets_second[det_ind, :5], dets_second[det_ind, 5])
-                    to_remove_trk_indices.append(trk_ind)
-                unmatched_trks = np.setdiff1d(unmatched_trks, np.array(to_remove_trk_indices))
+                with association_timer('solve'):
+                    matched_indices = linear_assignment(-iou_left)
+                with association_timer('post'):
+                    matched_indices = matched_indices[~(iou_left[matched_indices[:, 0], matched_indices[:, 1]] < self.iou_threshold)]
+                    det_inds, trk_inds = matched_indices[:, 0], unmatched_trks[matched_indices[:, 1]]
+                for det_ind, trk_ind in zip(det_inds, trk_inds):
+                    self.trackers[trk_ind].update(dets_second[det_ind, :5], dets_second[det_ind, 5], kalman_update=False)
+                    updated.append(self.trackers[trk_ind])
+                    measurements.append(dets_second[det_ind, :5])
+                unmatched_trks = np.setdiff1d(unmatched_trks, trk_inds)
 
         if unmatched_dets.shape[0] > 0 and unmatched_trks.shape[0] > 0:
             left_dets = dets[unmatched_dets]
@@ -311,25 +331,27 @@ class OCSort(MATracker):
                     get a higher performance especially on MOT17/MOT20 datasets. But we keep it
                     uniform here for simplicity
                 """
-                rematched_indices = linear_assignment(-iou_left)
-                to_remove_det_indices = []
-                to_remove_trk_indices = []
-                for m in rematched_indices:
-                    det_ind, trk_ind = unmatched_dets[m[0]], unmatched_trks[m[1]]
-                    if iou_left[m[0], m[1]] < self.iou_threshold:
-                        continue
-                    self.trackers[trk_ind].update(dets[det_ind, :5], dets[det_ind, 5])
-                    to_remove_det_indices.append(det_ind)
-                    to_remove_trk_indices.append(trk_ind)
-                unmatched_dets = np.setdiff1d(unmatched_dets, np.array(to_remove_det_indices))
-                unmatched_trks = np.setdiff1d(unmatched_trks, np.array(to_remove_trk_indices))
+                with association_timer('solve'):
+                    rematched_indices = linear_assignment(-iou_left)
+                with association_timer('post'):
+                    rematched_indices = rematched_indices[
+                        ~(iou_left[rematched_indices[:, 0], rematched_indices[:, 1]] < self.iou_threshold)]
+                    det_inds, trk_inds = unmatched_dets[rematched_indices[:, 0]], unmatched_trks[rematched_indices[:, 1]]
+                for det_ind, trk_ind in zip(det_inds, trk_inds):
+                    self.trackers[trk_ind].update(dets[det_ind, :5], dets[det_ind, 5], kalman_update=False)
+                    updated.append(self.trackers[trk_ind])
+                    measurements.append(dets[det_ind, :5])
+                unmatched_dets = np.setdiff1d(unmatched_dets, det_inds)
+                unmatched_trks = np.setdiff1d(unmatched_trks, trk_inds)
 
         for m in unmatched_trks:
             self.trackers[m].update(None, None)
+        KalmanBoxTracker.multi_update(updated, measurements)
 
         # create and initialise new trackers for unmatched detections
         for i in unmatched_dets:
-            trk = KalmanBoxTracker(dets[i, :5], dets[i, 5], delta_t=self.delta_t)
+            trk = KalmanBoxTracker(dets[i, :5], dets[i, 5], delta_t=self.delta_t, bank=self.bank,
+                                   observation_bank=self.observation_bank)
             self.trackers.append(trk)
         i = len(self.trackers)
         for trk in reversed(self.trackers):
@@ -348,6 +370,8 @@ class OCSort(MATracker):
             # remove dead tracklet
             if(trk.time_since_update > self.max_age):
                 self.trackers.pop(i)
+        self.bank.retain([trk.kf.row for trk in self.trackers])
+        self.observation_bank.retain([trk.obs_row for trk in self.trackers])
         if(len(ret) > 0):
             return np.concatenate(ret)
         return np.empty((0, 5))
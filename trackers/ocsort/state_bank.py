@@ -0,0 +1,309 @@
+from collections import deque
+
+import numpy as np
+
+
+class KalmanBoxBank(object):
+    """
+    Structure-of-arrays bank of the constant velocity box Kalman filters of the OC-SORT tracks.
+
+    The state x = [u, v, s, r, u', v', s'] of every track is a row of x[N, 7] and its
+    covariance a slice of P[N, 7, 7]. All the tracks share the same F, H, Q and R, so
+    predict and update run for any set of rows at once with stacked matrix products,
+    including the EMAP ego-motion control terms of `KalmanFilterNew.predict`. Freed rows
+    are recycled through a free-list and the arrays grow by doubling. x_saved and P_saved
+    hold the snapshot of the rows frozen for the observation-centric re-update (ORU).
+
+    Parameters
+    ----------
+    capacity : int
+        Number of rows allocated up front.
+    image_width, image_height, focal_length : float
+        Camera model of the ego-motion control terms.
+    dt : float
+        Time step of the control terms.
+
+    """
+    dim_x, dim_z = 7, 4
+
+    def __init__(self, capacity=64, image_width=960, image_height=540, focal_length=480.0, dt=1):
+        self.image_width, self.image_height, self.focal_length = image_width, image_height, focal_length
+        self.dt = dt
+        self.F = np.array([[1, 0, 0, 0, 1, 0, 0], [0, 1, 0, 0, 0, 1, 0], [0, 0, 1, 0, 0, 0, 1], [
+                          0, 0, 0, 1, 0, 0, 0],  [0, 0, 0, 0, 1, 0, 0], [0, 0, 0, 0, 0, 1, 0], [0, 0, 0, 0, 0, 0, 1]])
+        self.H = np.array([[1, 0, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0, 0],
+                           [0, 0, 1, 0, 0, 0, 0], [0, 0, 0, 1, 0, 0, 0]])
+        self.R = np.eye(self.dim_z)
+        self.R[2:, 2:] *= 10.
+        self.Q = np.eye(self.dim_x)
+        self.Q[-1, -1] *= 0.01
+        self.Q[4:, 4:] *= 0.01
+        self.P0 = np.eye(self.dim_x)
+        self.P0[4:, 4:] *= 1000.  # give high uncertainty to the unobservable initial velocities
+        self.P0 *= 10.
+        self._I = np.eye(self.dim_x)
+        self.capacity = 0
+        self.x = np.zeros((0, self.dim_x))
+        self.P = np.zeros((0, self.dim_x, self.dim_x))
+        self.x_saved = np.zeros((0, self.dim_x))
+        self.P_saved = np.zeros((0, self.dim_x, self.dim_x))
+        self.in_use = np.zeros(0, dtype=bool)
+        self._free = []
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        x, P, x_saved, P_saved, in_use = self.x, self.P, self.x_saved, self.P_saved, self.in_use
+        self.x = np.zeros((capacity, self.dim_x))
+        self.P = np.zeros((capacity, self.dim_x, self.dim_x))
+        self.x_saved = np.zeros((capacity, self.dim_x))
+        self.P_saved = np.zeros((capacity, self.dim_x, self.dim_x))
+        self.in_use = np.zeros(capacity, dtype=bool)
+        self.x[:self.capacity], self.P[:self.capacity], self.in_use[:self.capacity] = x, P, in_use
+        self.x_saved[:self.capacity], self.P_saved[:self.capacity] = x_saved, P_saved
+        self._free = list(range(capacity - 1, self.capacity - 1, -1)) + self._free
+        self.capacity = capacity
+
+    def __len__(self):
+        return int(np.count_nonzero(self.in_use))
+
+    def attach(self, z):
+        """Allocate the row of a new track initialised at the measurement z = [u, v, s, r]"""
+        if not self._free:
+            self._grow(max(1, 2 * self.capacity))
+        row = self._free.pop()
+        self.in_use[row] = True
+        self.x[row] = 0.
+        self.x[row, :self.dim_z] = np.asarray(z).reshape(-1)
+        self.P[row] = self.P0
+        return row
+
+    def release(self, row):
+        self.in_use[row] = False
+        self._free.append(row)
+
+    def retain(self, rows):
+        """Release all the rows that are not in rows"""
+        live = np.zeros(self.capacity, dtype=bool)
+        live[rows] = True
+        for row in np.flatnonzero(self.in_use & ~live):
+            self.release(row)
+
+    def _control(self, x, control_input):
+        """Rotation and translation terms of the ego-motion of the camera, see KalmanFilterNew.predict"""
+        control = np.zeros_like(x)
+        u1 = x[:, 0] - self.image_width/2
+        robot_yaw_to_pixel_coeff = (u1**2/self.focal_length**2 + 1)*self.focal_length
+        control[:, 0] = control_input[:, 0] * (robot_yaw_to_pixel_coeff*self.dt)
+
+        depth = control_input[:, 2]
+        trans = np.zeros_like(x)
+        has_depth = depth != 0
+        if np.any(has_depth):
+            xd, d = x[has_depth], depth[has_depth]
+            u1 = xd[:, 0] - self.image_width/2
+            v1 = xd[:, 1] - self.image_height/2
+            w = np.sqrt(xd[:, 2] * xd[:, 3])
+            h = xd[:, 2] / w
+            bottom_y = v1+h/2.
+            right_x = u1+w/2.
+            u_coeff = u1*np.sqrt(u1**2 + self.focal_length**2)/(self.focal_length * d)
+            v_coeff = v1*np.sqrt(v1**2 + self.focal_length**2)/(self.focal_length * d)
+            h_coeff = (bottom_y*np.sqrt(bottom_y**2 + self.focal_length**2) - v1*np.sqrt(v1**2 + self.focal_length**2))\
+                      /(self.focal_length * d)
+            w_coeff = (right_x*np.sqrt(right_x**2 + self.focal_length**2) - u1*np.sqrt(u1**2 + self.focal_length**2))\
+                      /(self.focal_length * d)
+            depth_control_mat = np.zeros_like(xd)
+            depth_control_mat[:, 0] = u_coeff
+            depth_control_mat[:, 1] = v_coeff
+            depth_control_mat[:, 2] = w_coeff*h_coeff
+            trans[has_depth] = depth_control_mat
+        trans *= control_input[:, 1:2]
+        # to get the correct predicted s it should be multiplied with D_dot twice
+        trans[:, 2] *= control_input[:, 1]
+        return control, trans
+
+    def predict(self, rows, control_input=None):
+        """
+        Predict the rows one step ahead, x = Fx + Bu and P = FPF' + Q.
+        control_input is an optional (n, 3) array of (yaw_dot, D_dot, depth) per row, it is
+        only applied to the tracks whose center is inside the image.
+        """
+        x = self.x[rows]
+        P = self.P[rows]
+        Fx = np.matmul(self.F, x[:, :, None])[:, :, 0]
+        if control_input is not None:
+            control_input = np.asarray(control_input, dtype=np.float64).reshape(-1, 3)
+            inside = (x[:, 0] > 0) & (x[:, 0] < self.image_width) & (x[:, 1] > 0) & (x[:, 1] < self.image_height)
+            if np.any(inside):
+                rot, trans = self._control(x[inside], control_input[inside])
+                Fx[inside] = Fx[inside] + rot + trans
+        self.x[rows] = Fx
+        self.P[rows] = np.matmul(np.matmul(self.F, P), self.F.T) + self.Q
+
+    def update(self, rows, z):
+        """Correct the rows with the (n, 4) measurements z = [u, v, s, r]"""
+        x = self.x[rows][:, :, None]
+        P = self.P[rows]
+        z = np.asarray(z).reshape(-1, self.dim_z, 1)
+        H, R = self.H, self.R
+        y = z - np.matmul(H, x)
+        PHT = np.matmul(P, H.T)
+        S = np.matmul(H, PHT) + R
+        SI = np.linalg.inv(S)
+        K = np.matmul(PHT, SI)
+        x = x + np.matmul(K, y)
+        # P = (I-KH)P(I-KH)' + KRK', the numerically stable form
+        I_KH = self._I - np.matmul(K, H)
+        self.P[rows] = np.matmul(np.matmul(I_KH, P), np.swapaxes(I_KH, 1, 2)) + \
+            np.matmul(np.matmul(K, R), np.swapaxes(K, 1, 2))
+        self.x[rows] = x[:, :, 0]
+
+    def freeze(self, rows):
+        """Snapshot x and P of the rows before their non-observation forward"""
+        self.x_saved[rows] = self.x[rows]
+        self.P_saved[rows] = self.P[rows]
+
+    def reupdate(self, rows, trajectories):
+        """
+        Observation-centric re-update (ORU): restore the frozen x and P of the rows and run the
+        update-predict steps of their virtual trajectories, one (gap, 4, 1) array of boxes per
+        row, with the rows still re-updating at each step corrected together.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        self.x[rows] = self.x_saved[rows]
+        self.P[rows] = self.P_saved[rows]
+        gaps = np.array([len(trajectory) for trajectory in trajectories])
+        for i in range(gaps.max(initial=0)):
+            active = np.flatnonzero(gaps > i)
+            self.update(rows[active], np.array([trajectories[k][i] for k in active]))
+            ahead = rows[gaps > i + 1]
+            if len(ahead):
+                self.predict(ahead)
+
+
+class KalmanBoxFilter(object):
+    """
+    Kalman filter of one OC-SORT track, a row of a KalmanBoxBank behind the part of the
+    KalmanFilterNew interface KalmanBoxTracker uses: x and P, predict, update and the
+    freeze/unfreeze observation-centric re-update (ORU) of the tracks that were lost.
+    """
+
+    def __init__(self, bank, z):
+        self.bank = bank
+        self.row = bank.attach(z)
+        # keep the last two observations, None when the track was not observed, and their count
+        self.history_obs = deque(maxlen=2)
+        self.n_obs = 0
+        # n_obs when the track was frozen, None while it is observed, and its last observation
+        self.frozen_len = None
+        self.frozen_obs = None
+        # virtual trajectory waiting for the re-update of the bank, see multi_reupdate
+        self.trajectory = None
+        self.observed = False
+
+    @property
+    def x(self):
+        """(7, 1) view of the state of the track"""
+        return self.bank.x[self.row, :, None]
+
+    @x.setter
+    def x(self, value):
+        self.bank.x[self.row] = np.asarray(value).reshape(-1)
+
+    @property
+    def P(self):
+        return self.bank.P[self.row]
+
+    @P.setter
+    def P(self, value):
+        self.bank.P[self.row] = value
+
+    def predict(self, control_input=None):
+        self.bank.predict([self.row], None if control_input is None else [control_input])
+
+    def update(self, z):
+        """Add the measurement z, None when the track was not observed"""
+        self.observe(z)
+        if z is not None:
+            KalmanBoxFilter.multi_reupdate([self])
+            self.bank.update([self.row], z)
+
+    def observe(self, z):
+        """
+        Bookkeeping of update without the correction itself, which KalmanBoxBank.update runs for
+        many tracks. The ORU of a track observed again is left to multi_reupdate as well.
+        """
+        self.history_obs.append(z)
+        self.n_obs += 1
+        if z is None:
+            if self.observed:
+                """
+                    Got no observation so freeze the current parameters for future
+                    potential online smoothing.
+                """
+                self.freeze()
+            self.observed = False
+            return
+        if not self.observed:
+            """
+                Get observation, use online smoothing to re-update parameters
+            """
+            self.unfreeze()
+        self.observed = True
+
+    @staticmethod
+    def multi_reupdate(filters):
+        """Run the pending ORU of the filters, which must share the same KalmanBoxBank, in one batch"""
+        pending = [kf for kf in filters if kf.trajectory is not None]
+        if not pending:
+            return
+        pending[0].bank.reupdate([kf.row for kf in pending], [kf.trajectory for kf in pending])
+        for kf in pending:
+            kf.trajectory = None
+
+    def freeze(self):
+        """
+            Save the parameters before non-observation forward, only x and P are
+            kept, in the snapshot rows of the bank
+        """
+        self.bank.freeze([self.row])
+        self.frozen_len = self.n_obs
+        self.frozen_obs = self.history_obs[-2]
+
+    def unfreeze(self):
+        """
+            Generate the virtual trajectory between the last observation before the
+            track was lost and the new one, the re-update itself is batched in multi_reupdate
+        """
+        if self.frozen_len is not None:
+            # the observation before the freeze and the one just added
+            index1 = self.frozen_len - 2
+            index2 = self.n_obs - 1
+            box1 = self.frozen_obs
+            x1, y1, s1, r1 = box1
+            w1 = np.sqrt(s1 * r1)
+            h1 = np.sqrt(s1 / r1)
+            box2 = self.history_obs[-1]
+            x2, y2, s2, r2 = box2
+            w2 = np.sqrt(s2 * r2)
+            h2 = np.sqrt(s2 / r2)
+            time_gap = index2 - index1
+            dx = (x2-x1)/time_gap
+            dy = (y2-y1)/time_gap
+            dw = (w2-w1)/time_gap
+            dh = (h2-h1)/time_gap
+            """
+                The default virtual trajectory generation is by linear
+                motion (constant speed hypothesis)
+            """
+            steps = np.arange(1, time_gap + 1, dtype=np.result_type(dx))[:, None]
+            x = x1 + steps * dx
+            y = y1 + steps * dy
+            w = w1 + steps * dw
+            h = h1 + steps * dh
+            self.trajectory = np.stack([x, y, w * h, w / h], axis=1).reshape(time_gap, 4, 1)
+            # the observations are now box1 followed by the virtual ones
+            self.history_obs.clear()
+            self.history_obs.append(box1)
+            self.history_obs.extend(self.trajectory[-2:])
+            self.frozen_len = self.frozen_obs = None
@@ -0,0 +1,43 @@
+"""
+Batched crop and resize of the ReID inputs, shared by the ReIDDetectMultiBackend of every tracker.
+
+The xyxy pixel boxes of the detections are cut from the whole frame and resized into one
+NCHW float batch of 0-255 pixels, without a PIL image and a transform per crop. The boxes are
+clamped to at least one pixel inside the frame, so boxes that are off the frame or less than a
+pixel wide give the crop of the nearest border pixel instead of an empty crop.
+"""
+import cv2
+import numpy as np
+import torch
+from torchvision.ops import roi_align
+
+
+def clamp_boxes(boxes, height, width):
+    """Integer xyxy boxes clamped to at least 1x1 pixels inside the height x width frame"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    boxes = np.nan_to_num(boxes).astype(np.int64)
+    x1 = np.clip(boxes[:, 0], 0, width - 1)
+    y1 = np.clip(boxes[:, 1], 0, height - 1)
+    x2 = np.clip(boxes[:, 2], x1 + 1, width)
+    y2 = np.clip(boxes[:, 3], y1 + 1, height)
+    return np.stack([x1, y1, x2, y2], axis=1)
+
+
+def crop_batch(im, boxes, image_size, device):
+    """
+    Crops of the xyxy boxes of the HxWx3 frame im resized to image_size (h, w), a float Nx3xhxw
+    batch of 0-255 pixels on device. Numpy frames are resized by OpenCV, frame tensors, possibly
+    on the GPU already, by a single roi_align.
+    """
+    h, w = image_size
+    boxes = clamp_boxes(boxes, im.shape[0], im.shape[1])
+    if isinstance(im, np.ndarray):
+        # OpenCV resizes the uint8 crops in place, the batch moves to the device before the float conversion
+        crops = np.empty((len(boxes), h, w, 3), dtype=np.uint8)
+        for crop, (x1, y1, x2, y2) in zip(crops, boxes):
+            cv2.resize(im[y1:y2, x1:x2], (w, h), dst=crop, interpolation=cv2.INTER_LINEAR)
+        return torch.from_numpy(crops).to(device).permute(0, 3, 1, 2).float()
+    boxes = torch.as_tensor(boxes, dtype=torch.float32, device=device)
+    rois = torch.cat([torch.zeros_like(boxes[:, :1]), boxes], dim=1)
+    im = im.to(device).permute(2, 0, 1).unsqueeze(0).float()
+    return roi_align(im, rois, output_size=(h, w), sampling_ratio=-1, aligned=True)
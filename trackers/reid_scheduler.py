@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class ReIDScheduler(object):
+    """
+    Appearance on demand: picks the detections of a frame that need a ReID embedding.
+
+    A detection that overlaps exactly one track, which overlaps no other detection, is matched by
+    IoU alone; it borrows the embedding of that track instead of being embedded. All the other
+    detections are embedded: the ones overlapping several tracks or none, a new track or the
+    re-identification of a lost track, and the ones of a track whose embedding was last refreshed
+    refresh_stride frames ago or more. The trackers do not update the embedding of a track with a
+    borrowed one, and embed a borrowing detection after all if it is left unmatched.
+
+        embed, proxy = scheduler.select(ious, scheduler.is_stale(elapsed), lost)
+
+    Parameters
+    ----------
+    iou_threshold : float
+        Minimum IoU of a detection and a track to be candidates of each other.
+    refresh_stride : int
+        Frames after which the embedding of a track is refreshed, 1 embeds every detection.
+
+    """
+
+    def __init__(self, iou_threshold=0.3, refresh_stride=5):
+        self.iou_threshold = iou_threshold
+        self.refresh_stride = max(1, int(refresh_stride))
+        self.embedded = 0  # crops embedded in the last frame
+        self.skipped = 0  # crops skipped in the last frame
+        self.total_embedded = 0
+        self.total_skipped = 0
+
+    def is_stale(self, elapsed):
+        """Tracks whose embedding was refreshed elapsed frames ago and is due"""
+        return np.asarray(elapsed, dtype=np.int64).reshape(-1) >= self.refresh_stride
+
+    def select(self, ious, stale, lost=None):
+        """
+        ious is the (detections, tracks) IoU matrix of the detections and the predicted tracks,
+        stale and lost flag the tracks. Returns the mask of the detections to embed, and for every
+        detection the index of the track that lends its embedding, -1 for the embedded ones.
+        """
+        n_dets = ious.shape[0]
+        proxy = np.full(n_dets, -1, dtype=np.int64)
+        if ious.shape[1] > 0 and self.refresh_stride > 1:
+            candidates = ious > self.iou_threshold
+            track = np.argmax(candidates, axis=1)
+            unique = (candidates.sum(axis=1) == 1) & (candidates.sum(axis=0)[track] == 1)
+            unique &= ~np.asarray(stale, dtype=bool)[track]
+            if lost is not None:
+                unique &= ~np.asarray(lost, dtype=bool)[track]
+            proxy[unique] = track[unique]
+        embed = proxy < 0
+        self.embedded = int(np.count_nonzero(embed))
+        self.skipped = n_dets - self.embedded
+        self.total_embedded += self.embedded
+        self.total_skipped += self.skipped
+        return embed, proxy
+
+    def add_embedded(self, n):
+        """Count the n borrowing detections embedded after all"""
+        self.embedded += n
+        self.skipped -= n
+        self.total_embedded += n
+        self.total_skipped -= n
+
+    def summary(self):
+        return (f'embedded {self.embedded}, skipped {self.skipped} crops '
+                f'(total {self.total_embedded} embedded, {self.total_skipped} skipped)')
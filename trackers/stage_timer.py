@@ -0,0 +1,37 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """
+    Accumulated wall time of the named stages of a tracker step, e.g. the cost matrices,
+    the assignment solve and the match bookkeeping of the association.
+
+        with timer('solve'):
+            matched_indices = linear_assignment(cost)
+        print(timer.summary())
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+
+    def mean(self, stage):
+        """Mean time of the stage in seconds"""
+        return self.totals[stage] / max(self.calls[stage], 1)
+
+    def summary(self):
+        return ', '.join(f'{stage} {1e3 * self.mean(stage):.3f}ms' for stage in self.totals)
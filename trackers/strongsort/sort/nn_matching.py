@@ -95,6 +95,11 @@ class NearestNeighborDistanceMetric(object):
     """
     A nearest neighbor distance metric that, for each target, returns
     the closest distance to any sample that has been observed so far.
+
+    The samples are kept in a gallery tensor of shape (targets, budget, M),
+    one ring buffer of samples per target row with a validity mask, so that
+    `distance` computes the whole cost matrix with one batched matmul and a
+    masked min-reduction, on the CPU or on the GPU.
     Parameters
     ----------
     metric : str
@@ -105,24 +110,47 @@ class NearestNeighborDistanceMetric(object):
     budget : Optional[int]
         If not None, fix samples per class to at most this number. Removes
         the oldest samples when the budget is reached.
+    device : Optional[torch.device]
+        Device of the gallery, the CPU by default.
     Attributes
     ----------
     samples : Dict[int -> List[ndarray]]
         A dictionary that maps from target identities to the list of samples
-        that have been observed so far.
+        that have been observed so far, oldest first.
     """
 
-    def __init__(self, metric, matching_threshold, budget=None):
-        if metric == "euclidean":
-            self._metric = _nn_euclidean_distance
-        elif metric == "cosine":
-            self._metric = _nn_cosine_distance
-        else:
+    def __init__(self, metric, matching_threshold, budget=None, device=None):
+        if metric not in ("euclidean", "cosine"):
             raise ValueError(
                 "Invalid metric; must be either 'euclidean' or 'cosine'")
+        self.metric = metric
         self.matching_threshold = matching_threshold
         self.budget = budget
-        self.samples = {}
+        self.device = torch.device('cpu') if device is None else torch.device(device)
+        self._rows = {}  # target -> row of the gallery
+        self._free = []  # rows of the targets that left the scene
+        self._gallery = None  # (rows, slots, M) samples, unit length for the cosine metric
+        self._valid = None  # (rows, slots) mask of the written slots
+        self._count = np.zeros(0, dtype=np.int64)  # samples written per row
+
+    def _reserve(self, rows, slots, dim):
+        # grow the gallery by doubling, the slots only grow without a budget
+        if self._gallery is None:
+            n_rows, n_slots = 0, 0
+        else:
+            n_rows, n_slots, _ = self._gallery.shape
+        if rows <= n_rows and slots <= n_slots:
+            return
+        new_rows, new_slots = max(rows, 2 * n_rows, 16), max(slots, n_slots)
+        if self.budget is None and slots > n_slots:
+            new_slots = max(slots, 2 * n_slots, 16)
+        gallery = torch.zeros((new_rows, new_slots, dim), dtype=torch.float32, device=self.device)
+        valid = torch.zeros((new_rows, new_slots), dtype=torch.bool, device=self.device)
+        if self._gallery is not None:
+            gallery[:n_rows, :n_slots] = self._gallery
+            valid[:n_rows, :n_slots] = self._valid
+        self._gallery, self._valid = gallery, valid
+        self._count = np.concatenate([self._count, np.zeros(new_rows - n_rows, dtype=np.int64)])
 
     def partial_fit(self, features, targets, active_targets):
         """Update the distance metric with new data.
@@ -135,11 +163,47 @@ class NearestNeighborDistanceMetric(object):
         active_targets : List[int]
             A list of targets that are currently present in the scene.
         """
-        for feature, target in zip(features, targets):
-            self.samples.setdefault(target, []).append(feature)
-            if self.budget is not None:
-                self.samples[target] = self.samples[target][-self.budget:]
-        self.samples = {k: self.samples[k] for k in active_targets}
+        # free the rows of the targets that left the scene
+        active = set(active_targets)
+        for target in [k for k in self._rows if k not in active]:
+            row = self._rows.pop(target)
+            self._valid[row] = False
+            self._count[row] = 0
+            self._free.append(row)
+        targets = np.asarray(targets).reshape(-1)
+        mask = np.isin(targets, list(active))
+        if not mask.any():
+            return
+        features = np.asarray(features, dtype=np.float32).reshape(len(targets), -1)[mask]
+        targets = targets[mask]
+        if self.metric == "cosine":
+            features = features / np.linalg.norm(features, axis=1, keepdims=True)
+
+        # row of every target, reusing the freed rows
+        uniques, inverse, counts = np.unique(targets, return_inverse=True, return_counts=True)
+        for target in uniques:
+            if target not in self._rows:
+                self._rows[target] = self._free.pop() if self._free else len(self._rows)
+        rows = np.array([self._rows[target] for target in uniques], dtype=np.int64)
+        if self.budget is not None:
+            slots = self.budget
+        else:
+            written = np.array([self._count[row] if row < len(self._count) else 0 for row in rows])
+            slots = int((written + counts).max())
+        self._reserve(int(rows.max()) + 1, slots, features.shape[1])
+
+        # rank of every feature among the ones of its target, only the last budget ones are kept
+        order = np.argsort(inverse, kind='stable')
+        rank = np.empty(len(targets), dtype=np.int64)
+        rank[order] = np.arange(len(targets)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank >= counts[inverse] - slots
+        row = rows[inverse][keep]
+        slot = (self._count[row] + rank[keep]) % self._gallery.shape[1]
+        row_t = torch.from_numpy(row).to(self.device)
+        slot_t = torch.from_numpy(slot).to(self.device)
+        self._gallery[row_t, slot_t] = torch.from_numpy(features[keep]).to(self.device)
+        self._valid[row_t, slot_t] = True
+        self._count[rows] += counts
 
     def distance(self, features, targets):
         """Compute distance between features and targets.
@@ -156,7 +220,35 @@ class NearestNeighborDistanceMetric(object):
             element (i, j) contains the closest squared distance between
             `targets[i]` and `features[j]`.
         """
-        cost_matrix = np.zeros((len(targets), len(features)))
-        for i, target in enumerate(targets):
-            cost_matrix[i, :] = self._metric(self.samples[target], features)
-        return cost_matrix
\ No newline at end of file
+        if len(targets) == 0 or len(features) == 0 or self._gallery is None:
+            return np.zeros((len(targets), len(features)))
+        y = torch.from_numpy(np.asarray(features, dtype=np.float32)).to(self.device)
+        rows = torch.as_tensor([self._rows.get(target, -1) for target in targets], device=self.device)
+        valid = self._valid[rows] & (rows >= 0)[:, None]  # (targets, slots)
+        n_rows, n_slots, dim = self._gallery.shape
+        if self.metric == "cosine":
+            y = y / y.norm(dim=1, keepdim=True)
+        if 2 * len(targets) >= len(self._rows):
+            # one matmul of the whole gallery, cheaper than gathering the samples of most targets
+            products = torch.matmul(self._gallery.view(-1, dim), y.T).view(n_rows, n_slots, -1)[rows]
+        else:
+            # the few targets of a matching cascade level
+            products = torch.matmul(self._gallery[rows].view(-1, dim), y.T).view(len(targets), n_slots, -1)
+        if self.metric == "cosine":
+            products.masked_fill_(~valid[:, :, None], float('-inf'))
+            distances = 1. - products.max(dim=1)[0]
+        else:
+            x2 = self._gallery[rows].square().sum(dim=2)
+            distances = (x2[:, :, None] + y.square().sum(dim=1) - 2. * products).clamp_(min=0.)
+            distances = distances.masked_fill_(~valid[:, :, None], float('inf')).min(dim=1)[0]
+        return distances.cpu().numpy().astype(np.float64)
+
+    @property
+    def samples(self):
+        samples = {}
+        for target, row in self._rows.items():
+            count = int(self._count[row])
+            n_slots = self._gallery.shape[1]
+            slots = [i % n_slots for i in range(max(0, count - n_slots), count)]
+            samples[target] = list(self._gallery[row, slots].cpu().numpy())
+        return samples
@@ -34,7 +34,7 @@ class StrongSORT(object):
         
         self.max_dist = max_dist
         metric = NearestNeighborDistanceMetric(
-            "cosine", self.max_dist, nn_budget)
+            "cosine", self.max_dist, nn_budget, device=self.model.device)
         self.tracker = Tracker(
             metric, max_iou_dist=max_iou_dist, max_age=max_age, n_init=n_init, max_unmatched_preds=max_unmatched_preds, mc_lambda=mc_lambda, ema_alpha=ema_alpha)
 
@@ -137,13 +137,10 @@ class StrongSORT(object):
         return t, l, w, h
 
     def _get_features(self, bbox_xywh, ori_img):
-        im_crops = []
-        for box in bbox_xywh:
-            x1, y1, x2, y2 = self._xywh_to_xyxy(box)
-            im = ori_img[y1:y2, x1:x2]
-            im_crops.append(im)
-        if im_crops:
-            features = self.model(im_crops)
+        # the crops are cut, resized and normalized from the frame in one batch
+        boxes = [self._xywh_to_xyxy(box) for box in bbox_xywh]
+        if boxes:
+            features = self.model(ori_img, boxes)
         else:
             features = np.array([])
         return features
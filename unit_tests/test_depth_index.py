@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.depth import DepthIndex
+
+
+@pytest.fixture(scope='module')
+def index():
+    # image sizes that are not multiples of the cell, the last row and column of cells are partial
+    depth = np.random.default_rng(0).uniform(5, 50, (101, 203)).astype(np.float32)
+    depth[:24, :32] = 0  # invalid over whole cells
+    return DepthIndex(depth, cell=8)
+
+
+@pytest.mark.parametrize('statistic', ['median', 'trimmed_mean'])
+def test_empty_boxes_have_no_depth(index, statistic):
+    boxes = np.array([
+        [2000, 2000, 10, 10],  # off the image, clipped to x0 == x1 == width
+        [250, 20, 30, 30],  # off the right border only
+        [20, 150, 30, 30],  # off the bottom border only
+        [40, 40, 0, 25],  # zero width
+        [40, 40, 25, 0],  # zero height
+        [40.2, 40, 0.5, 25],  # sub-pixel width
+        [-50, -50, 20, 20],  # before the image, clipped to the invalid corner
+        [0, 0, 30, 20],  # only invalid depths
+    ])
+    assert np.array_equal(index.exact_median(boxes), np.zeros(len(boxes)))
+    assert np.array_equal(index.box_depths(boxes, statistic), np.zeros(len(boxes)))
+
+
+def test_sub_cell_boxes_match_exact_median():
+    # one depth value, so that the bins do not approximate and only the cell snapping is tested
+    depth = np.full((101, 203), 12., dtype=np.float32)
+    depth[:50, :100] = 0
+    index = DepthIndex(depth, cell=8)
+    boxes = np.array([[41, 51, 3, 3], [200, 97, 3, 4], [201, 99, 1, 1], [90, 41, 3, 3], [202.5, 100, 0.4, 1]])
+    assert np.allclose(index.box_depths(boxes), index.exact_median(boxes), rtol=1e-4)
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'scripts'))
+import kitti_loader_utils as utils
+from benchmark_depth import depth_args, loop_generate_depth, loop_upsample_velodyne, synthetic_scan
+
+
+@pytest.fixture(scope='module')
+def scan():
+    return synthetic_scan(np.random.default_rng(0))
+
+
+@pytest.mark.parametrize('upsample, filtering', [(1, 1), (1, 2), (2, 1)])
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_generate_depth_matches_loop(scan, upsample, filtering):
+    args = depth_args(scan, upsample)
+    args['params']['filtering'] = filtering
+    depth = utils.generate_depth(**args)
+    assert depth.shape == (args['height'], args['width'])
+    assert np.count_nonzero(depth) > 1000
+    assert np.array_equal(depth, loop_generate_depth(**args))
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_upsample_velodyne_matches_loop(scan):
+    args = depth_args(scan, 2)
+    velodata_cam = (args['M_velo2cam'] @ scan.T).T
+    velodata_cam = velodata_cam[velodata_cam[:, 2] >= 0.1]
+    assert np.array_equal(utils.upsample_velodyne(velodata_cam, args['params']),
+                          loop_upsample_velodyne(velodata_cam, args['params']))
+
+
+def test_zbuffer_keeps_closest_point():
+    rows = np.array([0, 0, 1, 1, 1, 5, -1])
+    cols = np.array([0, 0, 2, 2, 2, 0, 0])
+    values = np.array([3., 2., 4., 0., 6., 1., 1.])
+    buffer = utils.zbuffer(rows, cols, values, (2, 3))
+    # out of bounds points are dropped and a 0 resets its pixel like the sequential z-buffer
+    assert np.array_equal(buffer, [[2., 0., 0.], [0., 0., 6.]])
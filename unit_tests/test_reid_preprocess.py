@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.reid_preprocess import clamp_boxes, crop_batch
+
+
+def test_off_frame_and_empty_boxes_give_border_crops():
+    im = np.random.default_rng(0).integers(0, 256, (60, 80, 3), dtype=np.uint8)
+    boxes = np.array([
+        [100, 100, 120, 130],  # off the frame, clamped to the bottom right pixel
+        [-30, -20, -5, -1],  # off the frame, clamped to the top left pixel
+        [10, 10, 10, 30],  # zero width
+        [10.2, 10, 10.7, 30],  # under a pixel wide
+        [5, 5, 25, 45],
+    ])
+    crops = crop_batch(im, boxes, (16, 8), torch.device('cpu'))
+    assert crops.shape == (5, 3, 16, 8)
+    assert torch.all(crops[0] == torch.from_numpy(im[59, 79]).float()[:, None, None])
+    assert torch.all(crops[1] == torch.from_numpy(im[0, 0]).float()[:, None, None])
+    assert np.array_equal(clamp_boxes(boxes, 60, 80)[2:4], [[10, 10, 11, 30], [10, 10, 11, 30]])
+    # the tensor frames of roi_align take the same boxes
+    assert crop_batch(torch.from_numpy(im), boxes, (16, 8), torch.device('cpu')).shape == (5, 3, 16, 8)
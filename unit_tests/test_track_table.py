@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from trackers.emap.basetrack import BaseTrack, TrackState
+from trackers.emap.track_table import TrackField, TrackTable
+
+
+class Track(BaseTrack):
+    _table, _row = None, None
+    mean = TrackField()
+    covariance = TrackField()
+    state = TrackField(TrackState.New)
+    score = TrackField()
+    cls = TrackField()
+    frame_id = TrackField(0)
+    start_frame = TrackField(0)
+
+    def __init__(self, frame_id, state, score=0.123456789012):
+        self.frame_id, self.state, self.score, self.cls = frame_id, state, score, 0.
+
+
+def test_full_table_evicts_the_oldest_lost_track():
+    table = TrackTable(capacity=2, max_capacity=3)
+    tracks = [Track(5, TrackState.Tracked), Track(3, TrackState.Lost), Track(4, TrackState.Lost)]
+    for track in tracks:
+        table.attach(track)
+    new = Track(6, TrackState.Tracked)
+    table.attach(new)
+    assert table.pop_evicted() == [tracks[1]]
+    assert tracks[1]._row is None and tracks[1].state == TrackState.Removed and tracks[1].frame_id == 3
+    assert len(table) == 3 and table.capacity == 3
+    # without lost tracks the least recently updated track goes
+    tracks[2].state = TrackState.Tracked
+    table.attach(Track(7, TrackState.Tracked))
+    assert table.pop_evicted() == [tracks[2]]
+    assert table.pop_evicted() == []
+
+
+def test_scores_keep_their_precision():
+    table = TrackTable()
+    track = Track(1, TrackState.Tracked)
+    table.attach(track)
+    assert track.score == 0.123456789012
+    assert table.score.dtype == np.float64 and table.cls.dtype == np.float64
@@ -4,6 +4,7 @@ from __future__ import print_function
 import glob
 import math
 import os
+import queue
 import time
 from pathlib import Path
 from threading import Thread
@@ -38,7 +39,7 @@ import threading
 
 class LoadStreams:
     # YOLOv8 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='file.streams', imgsz=640, stride=32, auto=True, transforms=None, vid_stride=1, time_out = 2):
+    def __init__(self, sources='file.streams', imgsz=640, stride=32, auto=True, transforms=None, vid_stride=1, time_out = 2, realtime=False):
         is_ros = isinstance(sources, image_converter)
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
@@ -47,8 +48,10 @@ class LoadStreams:
         self.vid_stride = vid_stride  # video frame-rate stride
         self.depth_image = None
         self.time_out = time_out
-        self.lock = threading.Lock()
-        self.lock_extra = threading.Lock()
+        # ROS real-time mode: every frame is the newest synchronized bundle, the stale ones are skipped
+        self.realtime = realtime and is_ros
+        self.skipped_frames = 0
+        self.ros_frames = queue.Queue(maxsize=1)  # the next ROS bundle, decoded while the current frame is tracked
         if not is_ros:
             sources = Path(sources).read_text().rsplit() if os.path.isfile(sources) else [sources]
         else:
@@ -88,15 +91,17 @@ class LoadStreams:
                 # if s.cv_image_queue.qsize() > 0:
                 #     while(s.cv_image_queue.qsize() > 0):
                 #         self.imgs[i] = s.cv_image_queue.get()
-                self.imgs[i] = s.cv_image_queue.get()
+                self.ros_bundle = s.get_synced()  # color, depth, odom and gt of one stamp
+                self.imgs[i] = self.ros_bundle["color"]
                 w = int(self.imgs[i].shape[0])
                 h = int(self.imgs[i].shape[1])
             if not is_ros:
                 self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
-            else:
+            elif not self.realtime:
                 self.threads[i] = Thread(target=self.update, args=([i, None, s]), daemon=True)
             LOGGER.info(f"{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)")
-            self.threads[i].start()
+            if self.threads[i] is not None:  # the real-time mode takes the bundles in __next__
+                self.threads[i].start()
         LOGGER.info('')  # newline
 
         # check for common shapes
@@ -112,16 +117,8 @@ class LoadStreams:
         
         is_ros = isinstance(stream, image_converter)
         if is_ros:
-            while True:            
-                my_im = stream.cv_image_queue.get()
-                my_im = cv2.resize(my_im, (0,0), fx=1., fy=1.)
-                im = my_im
-                self.imgs[i] = im
-                if self.lock_extra.locked():
-                    self.lock_extra.release()
-                self.lock.acquire()
-                #check sim_reset_queue size
-                
+            while True:
+                self.ros_frames.put(stream.get_synced())  # waits until __next__ took the previous bundle
         else:
             n, f = 0, self.frames[i]  # frame number, frame array
             while cap.isOpened() and n < f:
@@ -144,15 +141,29 @@ class LoadStreams:
 
     def __next__(self):
         #if it's a ros node the output will also include the simulation reset signal
-        if isinstance(self.sources[0], image_converter):
-            lock_success = self.lock_extra.acquire(timeout=self.time_out)
-            if not lock_success:
+        if self.realtime:
+            # taken when the previous frame is done, so the latency stays bounded however slow the detection
+            bundle = self.sources[0].get_synced(timeout=self.time_out, latest=True)
+            if bundle is None:
                 raise StopIteration
+            self.ros_bundle = bundle
+            self.imgs[0] = bundle["color"]
+        elif isinstance(self.sources[0], image_converter):
+            try:
+                self.ros_bundle = self.ros_frames.get(timeout=self.time_out)
+            except queue.Empty:
+                raise StopIteration
+            self.imgs[0] = self.ros_bundle["color"]
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+        if not all(x.is_alive() for x in self.threads if x is not None) or cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
-        im0 = self.imgs.copy()
+        if isinstance(self.sources[0], image_converter):
+            bundle = self.ros_bundle  # the image and the extra outputs of the same stamp
+            self.skipped_frames += bundle["skipped"]
+            im0 = [bundle["color"]]
+        else:
+            im0 = self.imgs.copy()
 
 
 
@@ -176,7 +187,7 @@ class LoadStreams:
                 
             # if self.sources[0].depth_image_queue.qsize() > 0:
             #     while(self.sources[0].depth_image_queue.qsize() > 0):
-            depth_image = self.sources[0].depth_image_queue.get()
+            depth_image = bundle["depth"]
             self.depth_image = depth_image
 
             #do the same for the odom queue
@@ -186,17 +197,17 @@ class LoadStreams:
             # while self.sources[0].odom_queue.qsize() == 0: pass #FIXME: this is a hack to make sure the odom queue is not empty (for logging)
             # if self.sources[0].odom_queue.qsize() > 0:
             #     while(self.sources[0].odom_queue.qsize() > 0):
-            odom = self.sources[0].odom_queue.get()
+            odom = bundle["odom"]
             self.odom = odom
             self.gt = []
             # if self.sources[0].gt_queue.qsize() > 0:
             #     while(self.sources[0].gt_queue.qsize() > 0):
-            gt = self.sources[0].gt_queue.get()
+            gt = bundle["gt"]
             self.gt = gt
             
             #make a dictionary that has the reset signal and the depth image
-            self.extra_output = { "depth_image": self.depth_image, "odom": self.odom, "gt": self.gt}
-            self.lock.release()
+            self.extra_output = { "depth_image": self.depth_image, "odom": self.odom, "gt": self.gt,
+                                  "skipped_frames": bundle["skipped"], "stamp": bundle["stamp"]}
             return self.sources, im, im0, None,'', self.extra_output
         else:
             return self.sources, im, im0, None, ''